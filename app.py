@@ -1,36 +1,66 @@
-from flask import Flask, request, jsonify, Response, send_file, redirect
+from flask import Flask, request, jsonify, Response, send_file, redirect, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-from pdf2image import convert_from_path
+import fitz
 import os
 import shutil
-from PIL import Image
 import google.generativeai as genai
+from google.generativeai import caching
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
-import base64
-from io import BytesIO
+from google.cloud import texttospeech
+import pybase64
 import time
-import traceback
-import json
-import requests
+import threading
+import queue
+import logging
+import logging.handlers
+import atexit
+import orjson
+import msgpack
+import httpx
 from dotenv import load_dotenv
 import re
-import zipfile
-import io
+from zipstream import ZipStream, ZIP_STORED, ZIP_DEFLATED
 import os.path
 from tempfile import NamedTemporaryFile
+from werkzeug.utils import safe_join
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+import multiprocessing
+from collections import deque
+from cachetools import TTLCache
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Debug output locally, warnings and errors only in production (FLASK_ENV is
+# set in app.yaml). LOG_LEVEL overrides either.
+# Request threads only put records on a queue; a listener thread writes them
+# out, so handlers never block on stderr.
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'WARNING' if os.getenv('FLASK_ENV') == 'production' else 'DEBUG'),
+    handlers=[queue_handler]
+)
+log_listener.start()
+atexit.register(log_listener.stop)
+logger = logging.getLogger(__name__)
+
 # Import our modules
 from database import (
-    calculate_file_hash, 
-    add_pdf, 
+    copy_and_hash, 
+    add_pdf_for_user, 
     associate_pdf_with_user, 
     get_user_pdfs,
     get_pdf_by_hash,
     get_pdf_by_path,
-    get_pdf_versions_by_name
+    get_pdf_versions_by_name,
+    set_pdf_cache_name
 )
 from auth import (
     register_user, 
@@ -39,24 +69,51 @@ from auth import (
     login_required
 )
 from cloud_storage import (
-    generate_signed_url,
+    cached_signed_url,
     upload_file,
     upload_from_file,
     upload_from_filename,
-    check_if_file_exists,
-    generate_unique_filepath,
+    upload_in_background,
+    copy_to_gcs_in_background,
+    cached_exists,
+    exists_cache_stats,
     create_bucket_if_not_exists,
     download_as_string,
-    list_files_with_prefix,
-    get_storage_client
+    cached_list_files,
+    get_storage_client,
+    get_bucket,
+    load_credentials,
+    try_download
+)
+from page_render import render_page, render_page_range
+from response_cache import (
+    gemini_cache_key,
+    tts_cache_key,
+    page_explanation_key,
+    get_cached_response,
+    store_cached_response
 )
 
+class ORJSONProvider(JSONProvider):
+    """Flask JSON provider backed by orjson (jsonify, request.json)"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+# Behind a proxy that understands X-Sendfile, let it serve local media files.
+# Otherwise send_file hands the open file to the server's wsgi.file_wrapper,
+# which gunicorn serves with sendfile(2).
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', 'false').lower() == 'true'
 CORS(app)
 
 # Configure API keys
 GOOGLE_API_KEY = os.getenv('GEMINI_API_KEY')
-print(f"Google API Key: {GOOGLE_API_KEY[:10]}...")
+logger.debug("Google API Key: %s...", GOOGLE_API_KEY[:10])
 
 # Configure Google Generative AI
 genai.configure(api_key=GOOGLE_API_KEY)
@@ -82,17 +139,87 @@ model = genai.GenerativeModel(
     safety_settings=safety_settings
 )
 
+# Same model, but answering with JSON - used for batched page explanations
+json_generation_config = {**generation_config, "response_mime_type": "application/json"}
+
+json_model = genai.GenerativeModel(
+    model_name="gemini-1.5-pro",
+    generation_config=json_generation_config,
+    safety_settings=safety_settings
+)
+
+# Page explanations are requested EXPLAIN_BATCH_SIZE pages per Gemini call.
+# The whole JSON answer has to fit in the 8192 output tokens, so keep it small.
+EXPLAIN_BATCH_SIZE = int(os.getenv('EXPLAIN_BATCH_SIZE', '5'))
+
+# Pages whose audio is synthesized and uploaded at the same time while a PDF
+# is processed (each page's TTS chunks are parallel on top of that)
+SPEECH_PAGE_WORKERS = int(os.getenv('SPEECH_PAGE_WORKERS', '4'))
+
+# Shared pool for short blocking I/O calls (GCS reads and writes, TTS chunks,
+# Gemini summaries) made from request handlers. Only calls that don't submit
+# more work to it run here, so it can't deadlock on itself. The pipeline
+# stages of /process-pdf wait on each other and keep their own threads.
+IO_WORKERS = int(os.getenv('IO_WORKERS', '32'))
+io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='io')
+atexit.register(io_pool.shutdown, wait=False)
+
+# Page images summarized per Gemini request when a quiz has to be generated
+# from images
+QUIZ_SUMMARY_BATCH_SIZE = 10
+
+# Explicit context caching for per-page explanations (off by default).
+# Caching needs a pinned model version, and Gemini rejects caches below a
+# minimum token count, so small PDFs are sent page by page as before.
+GEMINI_CONTEXT_CACHE = os.getenv('GEMINI_CONTEXT_CACHE', 'false').lower() == 'true'
+GEMINI_CACHE_MODEL = 'models/gemini-1.5-pro-002'
+GEMINI_CACHE_MIN_TOKENS = int(os.getenv('GEMINI_CACHE_MIN_TOKENS', '32768'))
+GEMINI_CACHE_TTL = timedelta(seconds=600)
+
+def create_pdf_context_cache(pdf_path, pdf_id, system_instruction):
+    """Upload a PDF to Gemini and cache it together with the system instruction.
+    
+    Returns the CachedContent, or None if caching is disabled, the PDF is too
+    small to be cached, or the upload/cache creation fails.
+    """
+    if not GEMINI_CONTEXT_CACHE:
+        return None
+    
+    try:
+        logger.debug("Uploading PDF to Gemini for context caching: %s", pdf_id)
+        pdf_file = genai.upload_file(pdf_path, mime_type='application/pdf', display_name=pdf_id)
+        while pdf_file.state.name == 'PROCESSING':
+            time.sleep(1)
+            pdf_file = genai.get_file(pdf_file.name)
+        
+        token_count = model.count_tokens([pdf_file]).total_tokens
+        if token_count < GEMINI_CACHE_MIN_TOKENS:
+            logger.debug("PDF is only %s tokens, skipping context cache", token_count)
+            return None
+        
+        cache = caching.CachedContent.create(
+            model=GEMINI_CACHE_MODEL,
+            display_name=pdf_id,
+            system_instruction=system_instruction,
+            contents=[pdf_file],
+            ttl=GEMINI_CACHE_TTL
+        )
+        logger.debug("Created Gemini context cache %s (%s tokens)", cache.name, token_count)
+        return cache
+    except Exception as e:
+        logger.exception("Error creating Gemini context cache: %s", e)
+        return None
+
 # Initialize Google Cloud Storage
 try:
     bucket = create_bucket_if_not_exists()
     if bucket:
-        print("Google Cloud Storage initialized successfully")
+        logger.info("Google Cloud Storage initialized successfully")
     else:
-        print("Continuing without Google Cloud Storage - will use local storage only")
+        logger.warning("Continuing without Google Cloud Storage - will use local storage only")
 except Exception as e:
-    print(f"Error initializing Google Cloud Storage: {str(e)}")
-    traceback.print_exc()
-    print("Continuing without Google Cloud Storage - will use local storage only")
+    logger.exception("Error initializing Google Cloud Storage: %s", e)
+    logger.warning("Continuing without Google Cloud Storage - will use local storage only")
 
 # Main upload folder - used for temporary storage before GCS upload
 UPLOAD_FOLDER = 'uploads'
@@ -106,6 +233,378 @@ GCS_AUDIO_PREFIX = 'audio/'
 GCS_TEXT_PREFIX = 'text/'
 GCS_QUIZ_PREFIX = 'quiz/'
 
+# Regexes used on the request path, compiled once
+_CLEAN_NAME_RE = re.compile(r'[^\w\-]')
+_PAGE_JPG_RE = re.compile(r'page_(\d+)\.jpg$')
+_PAGE_MD_RE = re.compile(r'page_(\d+)\.md$')
+_SENTENCE_END_RE = re.compile(r'(?<=[.!?])\s+')
+_TRAILING_COMMA_RE = re.compile(r',\s*([}\]])')
+# Longer than any prefix _ANSWER_PREFIX_RE removes
+ANSWER_PREFIX_HOLD_CHARS = 64
+_ANSWER_PREFIX_RE = re.compile(r'^(?:Think and Response\.?|Based on the context,|According to the context,)\s*', re.IGNORECASE)
+
+def jpeg_part(jpeg_bytes):
+    """A prompt part for an already encoded JPEG.
+    
+    Gemini gets the JPEG as it is. A PIL image would be re-encoded by the SDK
+    as lossless WebP, which takes longer and uploads several times the bytes.
+    """
+    return {'mime_type': 'image/jpeg', 'data': jpeg_bytes}
+
+def generate_text_cached(contents, gen_model=model, config=generation_config):
+    """Run a Gemini prompt, reusing the stored answer for an identical prompt"""
+    cache_key = gemini_cache_key(gen_model.model_name, contents, config)
+    cached_text = get_cached_response('gemini', cache_key)
+    if cached_text:
+        logger.debug("Using cached Gemini response %s", cache_key[:16])
+        return cached_text.decode('utf-8')
+    
+    text = gen_model.generate_content(contents=contents).text
+    store_cached_response('gemini', cache_key, text, content_type='text/plain')
+    return text
+
+def stream_text_cached(contents, gen_model=model, config=generation_config):
+    """Like generate_text_cached, but yield the answer in pieces as Gemini streams it"""
+    cache_key = gemini_cache_key(gen_model.model_name, contents, config)
+    cached_text = get_cached_response('gemini', cache_key)
+    if cached_text:
+        logger.debug("Using cached Gemini response %s", cache_key[:16])
+        yield cached_text.decode('utf-8')
+        return
+    
+    pieces = []
+    for chunk in gen_model.generate_content(contents=contents, stream=True):
+        if chunk.text:
+            pieces.append(chunk.text)
+            yield chunk.text
+    store_cached_response('gemini', cache_key, ''.join(pieces), content_type='text/plain')
+
+# Google TTS rejects requests over 5000 bytes of input, so long explanations
+# are synthesized in sentence-aligned chunks and the MP3s are concatenated
+TTS_CHUNK_CHARS = 4800
+
+def head_join(parts, sep, limit):
+    """Equivalent to sep.join(parts)[:limit], without joining parts past the limit"""
+    head = []
+    size = 0
+    for part in parts:
+        if head:
+            head.append(sep)
+            size += len(sep)
+        head.append(part)
+        size += len(part)
+        if size >= limit:
+            break
+    return "".join(head)[:limit]
+
+# Pooled HTTP/2 client for outbound REST calls - parallel TTS chunks are
+# multiplexed over one TLS connection instead of a handshake per request
+http_client = httpx.Client(
+    http2=True,
+    timeout=30,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+)
+atexit.register(http_client.close)
+
+def split_speech_text(speech_text, limit=TTS_CHUNK_CHARS):
+    """Group sentences into chunks of at most `limit` characters"""
+    groups = []
+    current = ""
+    for sentence in _SENTENCE_END_RE.split(speech_text):
+        # A single run-on sentence longer than the limit is cut hard
+        while len(sentence) > limit:
+            if current:
+                groups.append(current)
+                current = ""
+            groups.append(sentence[:limit])
+            sentence = sentence[limit:]
+        if current and len(current) + 1 + len(sentence) > limit:
+            groups.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        groups.append(current)
+    return groups
+
+# Text-to-Speech over gRPC returns raw MP3 bytes (no base64 JSON) on one
+# multiplexed channel. It authenticates with the service account, so without
+# one the REST API is used with the API key instead.
+_tts_client = None
+_tts_client_lock = threading.Lock()
+
+def get_tts_client():
+    """The shared gRPC Text-to-Speech client, or None if no service account is set up"""
+    global _tts_client
+    with _tts_client_lock:
+        if _tts_client is None:
+            credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
+            _tts_client = False
+            if credentials_path and os.path.exists(credentials_path):
+                try:
+                    # Share the key GCS already parsed instead of reading it again
+                    _tts_client = texttospeech.TextToSpeechClient(credentials=load_credentials(credentials_path))
+                except Exception as e:
+                    logger.error("Error creating Text-to-Speech client, using the REST API: %s", e)
+        return _tts_client or None
+
+def synthesize_chunk(speech_text):
+    """Synthesize one chunk of text (under the API limit) to MP3 bytes"""
+    tts_client = get_tts_client()
+    if tts_client is not None:
+        response = tts_client.synthesize_speech(
+            input=texttospeech.SynthesisInput(text=speech_text),
+            voice=texttospeech.VoiceSelectionParams(
+                language_code="en-IN",
+                name="en-IN-Chirp3-HD-Achernar",
+                ssml_gender=texttospeech.SsmlVoiceGender.NEUTRAL
+            ),
+            audio_config=texttospeech.AudioConfig(
+                audio_encoding=texttospeech.AudioEncoding.MP3,
+                effects_profile_id=["large-automotive-class-device"],
+                speaking_rate=1
+            )
+        )
+        return response.audio_content
+    
+    # Otherwise use the Google Cloud Text-to-Speech REST API directly with API key
+    tts_url = f"https://texttospeech.googleapis.com/v1/text:synthesize?key={GOOGLE_API_KEY}"
+    
+    payload = {
+        "input": {
+            "text": speech_text
+        },
+        "voice": {
+            "languageCode": "en-IN",
+            "name": "en-IN-Chirp3-HD-Achernar", 
+            "ssmlGender": "NEUTRAL"
+        },
+        "audioConfig": {
+            "audioEncoding": "MP3",
+            "effectsProfileId": [
+                "large-automotive-class-device"
+            ],
+            "speakingRate": 1
+        }
+    }
+    
+    tts_response = http_client.post(tts_url, json=payload)
+    
+    # Log the response
+    logger.debug("TTS response status: %s", tts_response.status_code)
+    if tts_response.status_code != 200:
+        logger.error("TTS error response: %s", tts_response.text)
+    tts_response.raise_for_status()  # Will raise an exception for 4XX/5XX responses
+    
+    # Extract audio content from response
+    response_json = tts_response.json()
+    if "audioContent" not in response_json:
+        logger.error("No audioContent in TTS response. Response: %s", response_json)
+        raise Exception("No audioContent in TTS response")
+    
+    return pybase64.b64decode(response_json["audioContent"], validate=False)
+
+def synthesize_speech(explanation, page_num):
+    """Convert a page explanation to MP3 bytes with Google Text-to-Speech.
+    
+    Audio is cached in GCS keyed by the spoken text (the voice settings are
+    fixed), so synthesizing the same explanation again is a single download.
+    Raises an exception if no audio could be produced.
+    """
+    # Remove markdown emphasis for speech but keep it for display. Unwrapping
+    # **bold** and then dropping stray asterisks deletes every '*', which
+    # str.replace does in one pass without the regex engine.
+    speech_text = explanation.replace("*", "")
+    
+    # Ensure the text is not empty
+    if not speech_text.strip():
+        speech_text = f"Page {page_num} content could not be processed properly."
+    
+    cache_key = tts_cache_key(speech_text)
+    cached_audio = get_cached_response('tts', cache_key)
+    if cached_audio:
+        logger.debug("Using cached TTS audio for page %s", page_num)
+        return cached_audio
+    
+    # Synthesize the chunks in parallel; MP3 frames can simply be concatenated
+    chunks = split_speech_text(speech_text)
+    logger.debug("Sending TTS request for page %s (%s chunk(s))...", page_num, len(chunks))
+    if len(chunks) == 1:
+        audio_parts = [synthesize_chunk(chunks[0])]
+    else:
+        audio_parts = list(io_pool.map(synthesize_chunk, chunks))
+    audio_data = b"".join(audio_parts)
+    
+    # Check if audio data is valid
+    if len(audio_data) == 0:
+        logger.error("Empty audio data returned from TTS API")
+        raise Exception("Empty audio data returned from TTS API")
+    
+    store_cached_response('tts', cache_key, audio_data, content_type='audio/mpeg')
+    return audio_data
+
+# metadata.json and the database row of a processed PDF are written once at
+# processing time, so page views can reuse them for a few minutes
+_META_CACHE = TTLCache(maxsize=1024, ttl=300)
+_PDF_INFO_CACHE = TTLCache(maxsize=1024, ttl=300)
+_cache_lock = threading.Lock()
+
+def fetch_pdf_metadata(pdf_name):
+    """Get the parsed metadata.json of a PDF from GCS, or None if it has none"""
+    with _cache_lock:
+        metadata = _META_CACHE.get(pdf_name)
+    if metadata is not None:
+        return metadata
+    
+    metadata_content = try_download(f"{GCS_PDF_PREFIX}{pdf_name}/metadata.json")
+    if not metadata_content:
+        return None
+    metadata = orjson.loads(metadata_content)
+    remember_pdf_metadata(pdf_name, metadata)
+    return metadata
+
+def remember_pdf_metadata(pdf_name, metadata):
+    """Record metadata that was just uploaded so the next read skips GCS"""
+    with _cache_lock:
+        _META_CACHE[pdf_name] = metadata
+
+def get_pdf_info(pdf_name):
+    """Cached get_pdf_by_path (misses are not cached)"""
+    with _cache_lock:
+        pdf_info = _PDF_INFO_CACHE.get(pdf_name)
+    if pdf_info is None:
+        pdf_info = get_pdf_by_path(pdf_name)
+        if pdf_info:
+            with _cache_lock:
+                _PDF_INFO_CACHE[pdf_name] = pdf_info
+    return pdf_info
+
+# Subfolders a fully processed PDF has in local storage
+PDF_ASSET_DIRS = ('image_files', 'text_files', 'audio_files')
+
+def pdf_path(pdf_name, *parts):
+    """Local path of a PDF's upload folder or a file in it, or None if pdf_name would escape UPLOAD_FOLDER"""
+    return safe_join(UPLOAD_FOLDER, pdf_name, *parts)
+
+def classify_pdf_dir(path):
+    """Report which asset subfolders a local PDF folder has (one scandir pass)"""
+    flags = dict.fromkeys(PDF_ASSET_DIRS, False)
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name in flags and entry.is_dir(follow_symlinks=False):
+                    flags[entry.name] = True
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return flags
+
+def max_local_page(image_folder):
+    """Return the highest page number among page_N.jpg files, or 0 if none"""
+    try:
+        with os.scandir(image_folder) as entries:
+            return max((int(match.group(1)) for entry in entries
+                        if (match := _PAGE_JPG_RE.search(entry.name))), default=0)
+    except (FileNotFoundError, NotADirectoryError):
+        return 0
+
+# One-second cache for the local filesystem checks of the quiz and download
+# routes, which clients tend to call repeatedly
+_path_cache = TTLCache(maxsize=4096, ttl=1)
+_path_cache_lock = threading.Lock()
+
+def path_exists_cached(path):
+    """os.path.exists, cached briefly"""
+    key = ('exists', path)
+    with _path_cache_lock:
+        exists = _path_cache.get(key)
+    if exists is None:
+        exists = os.path.exists(path)
+        with _path_cache_lock:
+            _path_cache[key] = exists
+    return exists
+
+def list_files_cached(folder):
+    """Names of the regular files in a folder ([] if it is missing), cached briefly"""
+    key = ('files', folder)
+    with _path_cache_lock:
+        names = _path_cache.get(key)
+    if names is None:
+        try:
+            with os.scandir(folder) as entries:
+                names = [entry.name for entry in entries if entry.is_file()]
+        except (FileNotFoundError, NotADirectoryError):
+            names = []
+        with _path_cache_lock:
+            _path_cache[key] = names
+    return names
+
+def forget_local_path(path):
+    """Drop cached results for a file or folder that was just written"""
+    with _path_cache_lock:
+        _path_cache.pop(('exists', path), None)
+        _path_cache.pop(('files', path), None)
+        _path_cache.pop(('files', os.path.dirname(path)), None)
+
+def remove_temp_files(temp_folder, temp_pdf_path):
+    """Delete the working files of a processed PDF"""
+    try:
+        shutil.rmtree(temp_folder)
+        os.remove(temp_pdf_path)
+        forget_local_path(temp_folder)
+        logger.debug("Temporary files cleaned up")
+    except Exception as e:
+        logger.exception("Error cleaning up temporary files: %s", e)
+
+def build_media_index(subfolder):
+    """Map file names in UPLOAD_FOLDER/*/<subfolder>/ to their local paths"""
+    index = {}
+    with os.scandir(UPLOAD_FOLDER) as pdf_folders:
+        for pdf_folder in pdf_folders:
+            if not pdf_folder.is_dir(follow_symlinks=False):
+                continue
+            try:
+                with os.scandir(os.path.join(pdf_folder.path, subfolder)) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            index.setdefault(entry.name, entry.path)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+    return index
+
+# Locally stored audio/image files by file name, built once at startup so the
+# /get-audio and /get-image fallbacks don't scan every PDF folder per request
+AUDIO_INDEX = build_media_index('audio_files')
+IMAGE_INDEX = build_media_index('image_files')
+
+# Rasterization settings for uploaded PDFs - pages only feed Gemini and the
+# page viewer, so a low DPI is plenty and keeps JPEGs small
+RENDER_DPI = int(os.getenv('RENDER_DPI', '110'))
+
+# PDFs with at least this many pages are rendered by a pool of processes,
+# RENDER_CHUNK_PAGES pages per task, instead of page by page in the request
+PARALLEL_RENDER_MIN_PAGES = int(os.getenv('PARALLEL_RENDER_MIN_PAGES', '50'))
+RENDER_CHUNK_PAGES = 8
+# Render processes per gunicorn worker. Every worker has its own pool, so the
+# default leaves most cores to the web workers; 0 renders in the request
+RENDER_PROCESSES = int(os.getenv('RENDER_PROCESSES', str(max(1, (os.cpu_count() or 1) // 4))))
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def get_render_pool():
+    """The shared render process pool, or None if it is disabled or there is one CPU"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None and RENDER_PROCESSES > 0 and (os.cpu_count() or 1) > 1:
+            # Spawned (not forked) workers start clean of the server's threads
+            # and gevent state, and only import page_render. Under gevent the
+            # executor's manager thread is a greenlet; it waits on the result
+            # pipes through the patched selectors, so it yields to the hub
+            _render_pool = ProcessPoolExecutor(
+                max_workers=RENDER_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _render_pool
+
 # User authentication routes
 @app.route('/auth/register', methods=['POST'])
 def register():
@@ -177,97 +676,105 @@ def get_existing_pdfs():
         # Get all PDFs for this user
         user_pdfs = get_user_pdfs(user_id)
         
-        pdfs = []
-        for pdf in user_pdfs:
-            # Check if this PDF exists in GCS - handle missing credentials
-            gcs_available = get_storage_client() is not None
-            gcs_exists = False
+        # Check if this PDF exists in GCS - handle missing credentials
+        gcs_available = get_storage_client() is not None
+        
+        def describe(pdf):
+            """The listing entry for one of the user's PDFs, or None if its files are gone"""
             metadata = {}
             
             if gcs_available:
                 # First check if the PDF exists in GCS
                 gcs_pdf_path = f"{GCS_PDF_PREFIX}{pdf['file_path']}/original.pdf"
-                gcs_metadata_path = f"{GCS_PDF_PREFIX}{pdf['file_path']}/metadata.json"
                 
-                gcs_exists = check_if_file_exists(gcs_pdf_path)
+                # metadata.json is uploaded next to original.pdf, so a successful
+                # metadata download also tells us the PDF is in GCS
+                try:
+                    gcs_metadata = fetch_pdf_metadata(pdf['file_path'])
+                except Exception as e:
+                    logger.error("Error loading metadata from GCS: %s", e)
+                    gcs_metadata = None
+                if gcs_metadata is not None:
+                    gcs_exists = True
+                    metadata = gcs_metadata
+                else:
+                    gcs_exists = cached_exists(gcs_pdf_path)
                 
                 if gcs_exists:
-                    # Get metadata if exists in GCS
-                    try:
-                        metadata_content = download_as_string(gcs_metadata_path)
-                        if metadata_content:
-                            metadata = json.loads(metadata_content.decode('utf-8'))
-                    except Exception as e:
-                        print(f"Error loading metadata from GCS: {str(e)}")
-                    
-                    pdfs.append({
+                    return {
                         'name': pdf['file_path'],
                         'total_pages': pdf['page_count'],
                         'date_processed': str(pdf['uploaded_at']),
                         'original_filename': metadata.get('original_filename', pdf['title'])
-                    })
-                    continue
+                    }
             
             # Fallback to checking local storage
             folder_path = os.path.join(UPLOAD_FOLDER, pdf['file_path'])
             
             # Check if it has the required structure
-            has_images = os.path.exists(os.path.join(folder_path, 'image_files'))
-            has_text = os.path.exists(os.path.join(folder_path, 'text_files'))
-            has_audio = os.path.exists(os.path.join(folder_path, 'audio_files'))
+            if not all(classify_pdf_dir(folder_path).values()):
+                return None
             
-            if has_images and has_text and has_audio:
-                # Get metadata if exists
-                metadata_path = os.path.join(folder_path, 'metadata.json')
-                metadata = {}
-                if os.path.exists(metadata_path):
-                    with open(metadata_path, 'r') as f:
-                        metadata = json.load(f)
-                
-                pdfs.append({
+            # Get metadata if exists
+            metadata_path = os.path.join(folder_path, 'metadata.json')
+            try:
+                with open(metadata_path, 'rb') as f:
+                    metadata = orjson.loads(f.read())
+            except FileNotFoundError:
+                pass
+            
+            # Upload metadata to GCS for future use (if GCS is available)
+            # without holding up the response
+            if gcs_available:
+                gcs_metadata_path = f"{GCS_PDF_PREFIX}{pdf['file_path']}/metadata.json"
+                upload_in_background(upload_file, orjson.dumps(metadata).decode(), gcs_metadata_path, content_type='application/json')
+                remember_pdf_metadata(pdf['file_path'], metadata)
+                logger.debug("Queued metadata upload to GCS: %s", gcs_metadata_path)
+            
+            return {
                 'name': pdf['file_path'],
                 'total_pages': pdf['page_count'],
                 'date_processed': str(pdf['uploaded_at']),
                 'original_filename': metadata.get('original_filename', pdf['title'])
-            })
-                
-                # Try to upload metadata to GCS for future use (if GCS is available)
-                if gcs_available:
-                    try:
-                        gcs_metadata_path = f"{GCS_PDF_PREFIX}{pdf['file_path']}/metadata.json"
-                        upload_file(json.dumps(metadata), gcs_metadata_path, content_type='application/json')
-                        print(f"Uploaded metadata to GCS: {gcs_metadata_path}")
-                    except Exception as e:
-                        print(f"Error uploading metadata to GCS: {str(e)}")
+            }
+        
+        # The per-PDF checks are mostly GCS round trips on a cold cache, so
+        # run them side by side; map keeps the user's PDFs in order
+        pdfs = [entry for entry in io_pool.map(describe, user_pdfs) if entry]
         
-        print(f"Found {len(pdfs)} existing PDFs for user {user_id}")
+        logger.debug("Found %s existing PDFs for user %s", len(pdfs), user_id)
         return jsonify({'pdfs': pdfs})
     except Exception as e:
-        print(f"Error getting existing PDFs: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error getting existing PDFs: %s", e)
         return jsonify({'error': str(e)}), 500
 
 # Route to check if a PDF exists by path
 @app.route('/check-pdf/<path:pdf_name>', methods=['GET'])
 def check_pdf_exists(pdf_name):
     try:
+        # Names that would resolve outside UPLOAD_FOLDER can't be a PDF
+        if pdf_path(pdf_name) is None:
+            return jsonify({'error': 'PDF not found'}), 404
         # Check if the PDF folder exists
-        pdf_folder = os.path.join(UPLOAD_FOLDER, pdf_name)
-        if os.path.exists(pdf_folder) and os.path.isdir(pdf_folder):
-            # Check if it has the required structure
-            has_images = os.path.exists(os.path.join(pdf_folder, 'image_files'))
-            has_text = os.path.exists(os.path.join(pdf_folder, 'text_files'))
-            has_audio = os.path.exists(os.path.join(pdf_folder, 'audio_files'))
-            
-            if has_images and has_text and has_audio:
-                return jsonify({'exists': True})
+        pdf_folder = pdf_path(pdf_name)
+        # Check if it has the required structure (a missing folder has none)
+        if all(classify_pdf_dir(pdf_folder).values()):
+            return jsonify({'exists': True})
         
         return jsonify({'exists': False})
     except Exception as e:
-        print(f"Error checking if PDF exists: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error checking if PDF exists: %s", e)
         return jsonify({'error': str(e)}), 500
 
+def numbered_versions(clean_name, existing):
+    """clean_name, clean_name_2, clean_name_3, ... for as long as each one is in existing"""
+    versions = [clean_name]
+    counter = 2
+    while f"{clean_name}_{counter}" in existing:
+        versions.append(f"{clean_name}_{counter}")
+        counter += 1
+    return versions
+
 # Route to check if a PDF exists by original filename
 @app.route('/check-pdf-by-filename/<path:filename>', methods=['GET'])
 def check_pdf_exists_by_filename(filename):
@@ -279,7 +786,7 @@ def check_pdf_exists_by_filename(filename):
             filename_no_ext = filename
             
         # Clean the name (same logic as in process-pdf)
-        clean_name = re.sub(r'[^\w\-]', '_', filename_no_ext).lower()
+        clean_name = _CLEAN_NAME_RE.sub('_', filename_no_ext).lower()
         
         # Check for versions in database
         versions = get_pdf_versions_by_name(clean_name)
@@ -299,13 +806,16 @@ def check_pdf_exists_by_filename(filename):
             gcs_base_path = f"{GCS_PDF_PREFIX}{clean_name}"
             gcs_pdf_path = f"{gcs_base_path}/original.pdf"
             
-            if check_if_file_exists(gcs_pdf_path):
-                # Check for versions with the same base name
-                versions = [clean_name]
-                counter = 2
-                while check_if_file_exists(f"{GCS_PDF_PREFIX}{clean_name}_{counter}/original.pdf"):
-                    versions.append(f"{clean_name}_{counter}")
-                    counter += 1
+            if cached_exists(gcs_pdf_path):
+                # Check for versions with the same base name, from one listing
+                # of everything under the name instead of a lookup per version
+                existing = {
+                    name[len(GCS_PDF_PREFIX):-len('/original.pdf')]
+                    for name in cached_list_files(gcs_base_path)
+                    if name.endswith('/original.pdf')
+                }
+                existing.add(clean_name)
+                versions = numbered_versions(clean_name, existing)
                     
                 return jsonify({
                     'exists': True,
@@ -319,11 +829,9 @@ def check_pdf_exists_by_filename(filename):
         
         if exists:
             # Get all versions (including this one and ones with _2, _3, etc.)
-            versions = [clean_name]
-            counter = 2
-            while os.path.exists(os.path.join(UPLOAD_FOLDER, f"{clean_name}_{counter}")):
-                versions.append(f"{clean_name}_{counter}")
-                counter += 1
+            with os.scandir(UPLOAD_FOLDER) as entries:
+                existing = {entry.name for entry in entries if entry.name.startswith(clean_name)}
+            versions = numbered_versions(clean_name, existing)
                 
             return jsonify({
                 'exists': True,
@@ -333,225 +841,151 @@ def check_pdf_exists_by_filename(filename):
         
         return jsonify({'exists': False})
     except Exception as e:
-        print(f"Error checking if PDF exists by filename: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error checking if PDF exists by filename: %s", e)
         return jsonify({'error': str(e)}), 500
 
 # Use existing PDF content
 @app.route('/use-existing/<path:pdf_name>', methods=['GET'])
 def use_existing_pdf(pdf_name):
     try:
-        print(f"Request to use existing PDF: {pdf_name}")
+        # Names that would resolve outside UPLOAD_FOLDER can't be a PDF
+        if pdf_path(pdf_name) is None:
+            return jsonify({'error': 'PDF not found'}), 404
+        logger.debug("Request to use existing PDF: %s", pdf_name)
         
         # Check if GCS is available
         gcs_available = get_storage_client() is not None
         
         # Prepare variables
-        pages = []
         metadata = {}
         total_pages = 0
         
         # Get metadata if GCS is available
         if gcs_available:
-            gcs_metadata_path = f"{GCS_PDF_PREFIX}{pdf_name}/metadata.json"
-            
             try:
-                if check_if_file_exists(gcs_metadata_path):
-                    metadata_content = download_as_string(gcs_metadata_path)
-                    if metadata_content:
-                        metadata = json.loads(metadata_content)
-                        print(f"Loaded metadata from GCS: {metadata}")
+                metadata = fetch_pdf_metadata(pdf_name) or {}
+                if metadata:
+                    logger.debug("Loaded metadata from GCS: %s", metadata)
                 else:
-                    print(f"No metadata file found in GCS at {gcs_metadata_path}")
+                    logger.debug("No metadata file found in GCS for %s", pdf_name)
             except Exception as e:
-                print(f"Error loading metadata from GCS: {str(e)}")
+                logger.error("Error loading metadata from GCS: %s", e)
         
         # Try to find metadata in local folder as fallback
         if not metadata:
-            local_metadata_path = os.path.join(UPLOAD_FOLDER, pdf_name, 'metadata.json')
+            local_metadata_path = pdf_path(pdf_name, 'metadata.json')
             if os.path.exists(local_metadata_path):
-                with open(local_metadata_path, 'r') as f:
-                    metadata = json.load(f)
-                print(f"Loaded metadata from local file: {metadata}")
+                with open(local_metadata_path, 'rb') as f:
+                    metadata = orjson.loads(f.read())
+                logger.debug("Loaded metadata from local file: %s", metadata)
                 
-                # Try to upload to GCS if available
+                # Upload to GCS in the background if available
                 if gcs_available:
-                    try:
-                        gcs_metadata_path = f"{GCS_PDF_PREFIX}{pdf_name}/metadata.json"
-                        upload_file(json.dumps(metadata), gcs_metadata_path, content_type='application/json')
-                        print(f"Uploaded metadata to GCS: {gcs_metadata_path}")
-                    except Exception as e:
-                        print(f"Error uploading metadata to GCS: {str(e)}")
+                    gcs_metadata_path = f"{GCS_PDF_PREFIX}{pdf_name}/metadata.json"
+                    upload_in_background(upload_file, orjson.dumps(metadata).decode(), gcs_metadata_path, content_type='application/json')
+                    remember_pdf_metadata(pdf_name, metadata)
+                    logger.debug("Queued metadata upload to GCS: %s", gcs_metadata_path)
         
         # Get page count from database if possible
-        pdf_info = get_pdf_by_path(pdf_name)
+        pdf_info = get_pdf_info(pdf_name)
         total_pages = pdf_info.get('page_count', 0) if pdf_info else 0
         
-        # If database doesn't have page count and GCS is available, try to determine from GCS
+        # Newer uploads also record the page count in metadata.json
+        if total_pages == 0 and metadata.get('page_count'):
+            total_pages = int(metadata['page_count'])
+            logger.debug("Determined total pages from metadata: %s", total_pages)
+        
+        # Last resort for old uploads: list the page images in GCS
         if total_pages == 0 and gcs_available:
             try:
                 # List all image files in GCS with this prefix
                 image_prefix = f"{GCS_IMAGE_PREFIX}{pdf_name}/"
-                image_files = list_files_with_prefix(image_prefix)
+                image_files = cached_list_files(image_prefix)
                 
                 # Extract page numbers from file paths
                 page_numbers = []
                 for file_path in image_files:
                     # Extract page number from file path like "images/pdf_name/page_1.jpg"
-                    match = re.search(r'page_(\d+)\.jpg$', file_path)
+                    match = _PAGE_JPG_RE.search(file_path)
                     if match:
                         page_numbers.append(int(match.group(1)))
                 
                 if page_numbers:
                     total_pages = max(page_numbers)
-                    print(f"Determined total pages from GCS: {total_pages}")
+                    logger.debug("Determined total pages from GCS: %s", total_pages)
                 else:
-                    print("No page files found in GCS")
+                    logger.debug("No page files found in GCS")
             except Exception as e:
-                print(f"Error listing files in GCS: {str(e)}")
+                logger.error("Error listing files in GCS: %s", e)
         
         # If we still don't have total pages, try local files as a last resort
         if total_pages == 0:
-            pdf_folder = os.path.join(UPLOAD_FOLDER, pdf_name)
+            pdf_folder = pdf_path(pdf_name)
             image_folder = os.path.join(pdf_folder, 'image_files')
             
-            if os.path.exists(image_folder):
-                page_files = []
-                for file in os.listdir(image_folder):
-                    if file.endswith('.jpg') and '_page_' in file:
-                        page_files.append(file)
-                
-                # Sort page files by page number
-                page_files.sort(key=lambda f: int(f.split('_page_')[1].split('.')[0]))
-                
-                if page_files:
-                    total_pages = int(page_files[-1].split('_page_')[1].split('.')[0])
-                    print(f"Determined total pages from local files: {total_pages}")
+            total_pages = max_local_page(image_folder)
+            if total_pages:
+                logger.debug("Determined total pages from local files: %s", total_pages)
         
         # If we still don't have pages, return an error
         if total_pages == 0:
             return jsonify({'error': 'Could not determine page count for PDF'}), 404
         
-        # Now fetch data for each page
-        for page_num in range(1, total_pages + 1):
-            print(f"Processing page {page_num}")
+        def load_page(page_num):
+            """Load the explanation and media URLs for one page"""
+            logger.debug("Processing page %s", page_num)
             
-            # Get image URL
-            image_url = f"/pdf/{pdf_name}/image/{page_num}"
+            # Media URLs - signed GCS URLs let the browser fetch the bytes
+            # directly; otherwise the /pdf routes serve (and upload) local files
+            image_url = None
+            audio_url = None
+            if gcs_available:
+                image_url = cached_signed_url(f"{GCS_IMAGE_PREFIX}{pdf_name}/page_{page_num}.jpg",
+                                              expiration_minutes=30, must_exist=True)
+                audio_url = cached_signed_url(f"{GCS_AUDIO_PREFIX}{pdf_name}/page_{page_num}.mp3",
+                                              expiration_minutes=30, must_exist=True)
             
-            # Get audio URL
-            audio_url = f"/pdf/{pdf_name}/audio/{page_num}"
+            if not image_url:
+                image_url = f"/pdf/{pdf_name}/image/{page_num}"
+            if not audio_url:
+                audio_url = f"/pdf/{pdf_name}/audio/{page_num}"
             
-            # Prepare variables for content
             explanation = ""
-            image_data = ""
-            audio_data = ""
             
             # Get explanation - first try GCS if available
             if gcs_available:
-                gcs_text_path = f"{GCS_TEXT_PREFIX}{pdf_name}/page_{page_num}.md"
-                
-                try:
-                    if check_if_file_exists(gcs_text_path):
-                        explanation_bytes = download_as_string(gcs_text_path)
-                        if explanation_bytes:
-                            explanation = explanation_bytes.decode('utf-8')
-                            print(f"Loaded explanation from GCS for page {page_num}")
-                except Exception as e:
-                    print(f"Error loading explanation from GCS for page {page_num}: {str(e)}")
+                explanation_bytes = try_download(f"{GCS_TEXT_PREFIX}{pdf_name}/page_{page_num}.md")
+                if explanation_bytes:
+                    explanation = explanation_bytes.decode('utf-8')
+                    logger.debug("Loaded explanation from GCS for page %s", page_num)
             
             # If not found in GCS, try local file
             if not explanation:
-                local_text_path = os.path.join(UPLOAD_FOLDER, pdf_name, 'text_files', f"{pdf_name}_page_{page_num}.md")
+                local_text_path = pdf_path(pdf_name, 'text_files', f"{pdf_name}_page_{page_num}.md")
                 if os.path.exists(local_text_path):
                     with open(local_text_path, 'r') as f:
                         explanation = f.read()
-                    print(f"Loaded explanation from local file for page {page_num}")
+                    logger.debug("Loaded explanation from local file for page %s", page_num)
                     
-                    # Upload to GCS for future use if available
+                    # Upload to GCS for future use if available, without
+                    # making this request wait for the write
                     if gcs_available:
-                        try:
-                            gcs_text_path = f"{GCS_TEXT_PREFIX}{pdf_name}/page_{page_num}.md"
-                            print(f"Explanation content type: {type(explanation).__name__}, length: {len(explanation)}")
-                            upload_file(explanation, gcs_text_path, content_type='text/markdown')
-                            print(f"Uploaded explanation to GCS: {gcs_text_path}")
-                        except Exception as e:
-                            print(f"Error uploading explanation to GCS: {str(e)}")
-                            traceback.print_exc()
-            
-            # For the first page only, include the base64 image and audio data
-            if page_num == 1:
-                # Get image data - first try GCS if available
-                if gcs_available:
-                    try:
-                        gcs_image_path = f"{GCS_IMAGE_PREFIX}{pdf_name}/page_{page_num}.jpg"
-                        if check_if_file_exists(gcs_image_path):
-                            image_bytes = download_as_string(gcs_image_path)
-                            if image_bytes:
-                                image_data = base64.b64encode(image_bytes).decode()
-                                print(f"Loaded image data from GCS for page {page_num}")
-                    except Exception as e:
-                        print(f"Error loading image data from GCS for page {page_num}: {str(e)}")
-                
-                # If not found in GCS, try local file
-                if not image_data:
-                    local_image_path = os.path.join(UPLOAD_FOLDER, pdf_name, 'image_files', f"{pdf_name}_page_{page_num}.jpg")
-                    if os.path.exists(local_image_path):
-                        with open(local_image_path, 'rb') as f:
-                            image_bytes = f.read()
-                            image_data = base64.b64encode(image_bytes).decode()
-                        print(f"Loaded image data from local file for page {page_num}")
-                        
-                        # Upload to GCS for future use if available
-                        if gcs_available:
-                            try:
-                                gcs_image_path = f"{GCS_IMAGE_PREFIX}{pdf_name}/page_{page_num}.jpg"
-                                upload_file(image_bytes, gcs_image_path, content_type='image/jpeg')
-                                print(f"Uploaded image to GCS: {gcs_image_path}")
-                            except Exception as e:
-                                print(f"Error uploading image to GCS: {str(e)}")
-                
-                # Get audio data - first try GCS if available
-                if gcs_available:
-                    try:
-                        gcs_audio_path = f"{GCS_AUDIO_PREFIX}{pdf_name}/page_{page_num}.mp3"
-                        if check_if_file_exists(gcs_audio_path):
-                            audio_bytes = download_as_string(gcs_audio_path)
-                            if audio_bytes:
-                                audio_data = base64.b64encode(audio_bytes).decode()
-                                print(f"Loaded audio data from GCS for page {page_num}")
-                    except Exception as e:
-                        print(f"Error loading audio data from GCS for page {page_num}: {str(e)}")
-                
-                # If not found in GCS, try local file
-                if not audio_data:
-                    local_audio_path = os.path.join(UPLOAD_FOLDER, pdf_name, 'audio_files', f"{pdf_name}_page_{page_num}.mp3")
-                    if os.path.exists(local_audio_path):
-                        with open(local_audio_path, 'rb') as f:
-                            audio_bytes = f.read()
-                            audio_data = base64.b64encode(audio_bytes).decode()
-                        print(f"Loaded audio data from local file for page {page_num}")
-                        
-                        # Upload to GCS for future use if available
-                        if gcs_available:
-                            try:
-                                gcs_audio_path = f"{GCS_AUDIO_PREFIX}{pdf_name}/page_{page_num}.mp3"
-                                upload_file(audio_bytes, gcs_audio_path, content_type='audio/mpeg')
-                                print(f"Uploaded audio to GCS: {gcs_audio_path}")
-                            except Exception as e:
-                                print(f"Error uploading audio to GCS: {str(e)}")
+                        gcs_text_path = f"{GCS_TEXT_PREFIX}{pdf_name}/page_{page_num}.md"
+                        upload_in_background(upload_file, explanation, gcs_text_path, content_type='text/markdown')
+                        logger.debug("Queued explanation upload to GCS: %s", gcs_text_path)
             
-            # Add page data to response
-            pages.append({
+            return {
                 'page_number': page_num,
-                'image': image_data,
                 'explanation': explanation,
-                'audio': audio_data,
                 'audio_url': audio_url,
                 'image_url': image_url
-            })
+            }
+        
+        # Pages are independent GCS/disk lookups, so fetch them concurrently.
+        # map() keeps the results in page order.
+        pages = list(io_pool.map(load_page, range(1, total_pages + 1)))
         
-        print(f"Successfully loaded {len(pages)} pages for PDF {pdf_name}")
+        logger.debug("Successfully loaded %s pages for PDF %s", len(pages), pdf_name)
         
         return jsonify({
             'total_pages': total_pages,
@@ -559,15 +993,17 @@ def use_existing_pdf(pdf_name):
             'pages': pages
         })
     except Exception as e:
-        print(f"Error using existing PDF: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error using existing PDF: %s", e)
         return jsonify({'error': str(e)}), 500
 
 # Routes to serve files from the PDF structure
 @app.route('/pdf/<path:pdf_name>/audio/<int:page_num>', methods=['GET'])
 def get_pdf_audio(pdf_name, page_num):
     try:
-        print(f"Audio request for PDF: {pdf_name}, Page: {page_num}")
+        # Names that would resolve outside UPLOAD_FOLDER can't be a PDF
+        if pdf_path(pdf_name) is None:
+            return jsonify({'error': 'PDF not found'}), 404
+        logger.debug("Audio request for PDF: %s, Page: %s", pdf_name, page_num)
         
         # GCS path for the audio file
         gcs_path = f"{GCS_AUDIO_PREFIX}{pdf_name}/page_{page_num}.mp3"
@@ -578,164 +1014,102 @@ def get_pdf_audio(pdf_name, page_num):
         
         if gcs_available:
             # Check if file exists in GCS
-            gcs_exists = check_if_file_exists(gcs_path)
-            print(f"File exists in GCS: {gcs_exists}")
+            gcs_exists = cached_exists(gcs_path)
+            logger.debug("File exists in GCS: %s", gcs_exists)
             
             if gcs_exists:
                 # Generate a signed URL for the audio file
-                signed_url = generate_signed_url(gcs_path, expiration_minutes=30)
+                signed_url = cached_signed_url(gcs_path, expiration_minutes=30)
                 if signed_url:
-                    print(f"Redirecting to signed URL: {signed_url[:50]}...")
+                    logger.debug("Redirecting to signed URL: %s...", signed_url[:50])
                     return redirect(signed_url)
                 else:
-                    print("Failed to generate signed URL")
+                    logger.error("Failed to generate signed URL")
         
         # Fallback to checking local files if not in GCS or signed URL failed
         # Try different potential local paths
         possible_paths = [
-            os.path.join(UPLOAD_FOLDER, pdf_name, 'audio_files', f"{pdf_name}_page_{page_num}.mp3"),  # Standard format
-            os.path.join(UPLOAD_FOLDER, pdf_name, 'audio_files', f"page_{page_num}.mp3"),  # Alternate format
-            os.path.join(UPLOAD_FOLDER, pdf_name, 'audio_files', f"{pdf_name.split('_')[0]}_page_{page_num}.mp3")  # Format with base name
+            pdf_path(pdf_name, 'audio_files', f"{pdf_name}_page_{page_num}.mp3"),  # Standard format
+            pdf_path(pdf_name, 'audio_files', f"page_{page_num}.mp3"),  # Alternate format
+            pdf_path(pdf_name, 'audio_files', f"{pdf_name.split('_')[0]}_page_{page_num}.mp3")  # Format with base name
         ]
         
         for audio_path in possible_paths:
-            print(f"Checking local path: {audio_path}")
+            logger.debug("Checking local path: %s", audio_path)
             if os.path.exists(audio_path):
-                print(f"Found audio file at: {audio_path}")
+                logger.debug("Found audio file at: %s", audio_path)
                 
                 # Check if the file is valid
                 if os.path.getsize(audio_path) == 0:
-                    print(f"Warning: Audio file is empty: {audio_path}")
+                    logger.warning("Audio file is empty: %s", audio_path)
                     continue
                 
-                # Try to upload to GCS for future requests if GCS is available
+                # Copy to GCS for future requests without making this one wait
                 if gcs_available and not gcs_exists:
-                    try:
-                        print(f"Uploading to GCS: {gcs_path}")
-                        result = upload_from_filename(audio_path, gcs_path, content_type='audio/mpeg')
-                        print(f"Upload result: {result}")
-                        
-                        if result:
-                            signed_url = generate_signed_url(gcs_path, expiration_minutes=30)
-                            if signed_url:
-                                print(f"Redirecting to signed URL after upload: {signed_url[:50]}...")
-                                return redirect(signed_url)
-                    except Exception as e:
-                        print(f"Error uploading audio to GCS: {str(e)}")
-                        traceback.print_exc()
+                    logger.debug("Queueing upload to GCS: %s", gcs_path)
+                    copy_to_gcs_in_background(audio_path, gcs_path, content_type='audio/mpeg')
                 
-                # Fallback to serving the local file
-                print(f"Serving local file: {audio_path}")
-                return send_file(audio_path, mimetype='audio/mpeg')
+                # Serve the local file
+                logger.debug("Serving local file: %s", audio_path)
+                return send_file(audio_path, mimetype='audio/mpeg', conditional=True)
         
         # If we still haven't found the audio, try to regenerate it
-        print(f"Audio file not found for PDF: {pdf_name}, Page: {page_num}")
+        logger.warning("Audio file not found for PDF: %s, Page: %s", pdf_name, page_num)
         
         # Try to regenerate the audio from the text file
-        text_path = os.path.join(UPLOAD_FOLDER, pdf_name, 'text_files', f"{pdf_name}_page_{page_num}.md")
+        text_path = pdf_path(pdf_name, 'text_files', f"{pdf_name}_page_{page_num}.md")
         if os.path.exists(text_path):
             try:
-                print(f"Attempting to regenerate audio from text: {text_path}")
+                logger.debug("Attempting to regenerate audio from text: %s", text_path)
                 with open(text_path, 'r') as f:
                     explanation = f.read()
                 
-                # Use the Google Cloud Text-to-Speech REST API directly with API key
-                tts_url = f"https://texttospeech.googleapis.com/v1/text:synthesize?key={GOOGLE_API_KEY}"
-                
-                # Remove special markdown characters for speech but keep for display
-                speech_text = re.sub(r'\*\*(.*?)\*\*', r'\1', explanation)
-                speech_text = speech_text.replace("*", "")
-                
-                # Ensure the text is not empty
-                if not speech_text.strip():
-                    speech_text = f"Page {page_num} content could not be processed properly."
-                
-                # If speech text is too long, truncate it to avoid API limits
-                if len(speech_text) > 5000:
-                    print(f"Warning: Speech text is very long ({len(speech_text)} chars), truncating...")
-                    speech_text = speech_text[:5000] + "... The rest of the content has been truncated for processing."
-                
-                payload = {
-                    "input": {
-                        "text": speech_text
-                    },
-                    "voice": {
-                        "languageCode": "en-IN",
-                        "name": "en-IN-Chirp3-HD-Achernar", 
-                        "ssmlGender": "NEUTRAL"
-                    },
-                    "audioConfig": {
-                        "audioEncoding": "MP3",
-                        "effectsProfileId": [
-                            "large-automotive-class-device"
-                        ],
-                        "speakingRate": 1
-                    }
-                }
+                audio_data = synthesize_speech(explanation, page_num)
                 
-                print(f"Sending TTS request for page {page_num}...")
-                tts_response = requests.post(tts_url, json=payload)
-                tts_response.raise_for_status()  # Will raise an exception for 4XX/5XX responses
-                
-                # Log the response
-                print(f"TTS response status: {tts_response.status_code}")
-                if tts_response.status_code != 200:
-                    print(f"TTS error response: {tts_response.text}")
-                
-                # Extract audio content from response
-                response_json = tts_response.json()
-                if "audioContent" not in response_json:
-                    print(f"Error: No audioContent in TTS response. Response: {response_json}")
-                    raise Exception("No audioContent in TTS response")
-                        
-                audio_data = base64.b64decode(response_json["audioContent"])
-                
-                # Check if audio data is valid
-                if len(audio_data) == 0:
-                    print(f"Error: Empty audio data returned from TTS API")
-                    raise Exception("Empty audio data returned from TTS API")
-                
-                print(f"Received audio data: {len(audio_data)} bytes")
+                logger.debug("Received audio data: %s bytes", len(audio_data))
                 
                 # Make sure the audio directory exists
-                audio_dir = os.path.join(UPLOAD_FOLDER, pdf_name, 'audio_files')
+                audio_dir = pdf_path(pdf_name, 'audio_files')
                 os.makedirs(audio_dir, exist_ok=True)
                 
                 # Save the audio file locally
                 local_audio_path = os.path.join(audio_dir, f"{pdf_name}_page_{page_num}.mp3")
                 with open(local_audio_path, 'wb') as f:
                     f.write(audio_data)
-                print(f"Audio saved locally to {local_audio_path}, size: {len(audio_data)} bytes")
+                AUDIO_INDEX[os.path.basename(local_audio_path)] = local_audio_path
+                logger.debug("Audio saved locally to %s, size: %s bytes", local_audio_path, len(audio_data))
                 
-                # Upload audio to GCS
+                # Upload audio to GCS, streaming it from the file just written
                 gcs_audio_path = f"{GCS_AUDIO_PREFIX}{pdf_name}/page_{page_num}.mp3"
                 try:
-                    upload_file(audio_data, gcs_audio_path, content_type='audio/mpeg')
-                    print(f"Audio uploaded to GCS: {gcs_audio_path}")
+                    upload_from_filename(local_audio_path, gcs_audio_path, content_type='audio/mpeg')
+                    logger.debug("Audio uploaded to GCS: %s", gcs_audio_path)
                 except Exception as e:
-                    print(f"Error uploading audio to GCS: {str(e)}")
-                    traceback.print_exc()
+                    logger.exception("Error uploading audio to GCS: %s", e)
+                
+                return send_file(local_audio_path, mimetype='audio/mpeg', conditional=True)
                 
             except Exception as e:
-                print(f"Error regenerating audio: {str(e)}")
-                traceback.print_exc()
+                logger.exception("Error regenerating audio: %s", e)
         
         return jsonify({'error': 'Audio file not found and could not be generated'}), 404
         
     except Exception as e:
-        print(f"Error serving audio: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error serving audio: %s", e)
         return jsonify({'error': f'Error serving audio: {str(e)}'}), 500
 
 @app.route('/pdf/<path:pdf_name>/image/<int:page_num>', methods=['GET'])
 def get_pdf_image(pdf_name, page_num):
     try:
+        # Names that would resolve outside UPLOAD_FOLDER can't be a PDF
+        if pdf_path(pdf_name) is None:
+            return jsonify({'error': 'PDF not found'}), 404
         # Log request details
-        print(f"Image request for PDF: {pdf_name}, Page: {page_num}")
+        logger.debug("Image request for PDF: %s, Page: %s", pdf_name, page_num)
         
         # GCS path for the image file
         gcs_path = f"{GCS_IMAGE_PREFIX}{pdf_name}/page_{page_num}.jpg"
-        print(f"Checking GCS path: {gcs_path}")
+        logger.debug("Checking GCS path: %s", gcs_path)
         
         # Check if GCS is available
         gcs_available = get_storage_client() is not None
@@ -743,66 +1117,48 @@ def get_pdf_image(pdf_name, page_num):
         
         if gcs_available:
             # Check if file exists in GCS
-            gcs_exists = check_if_file_exists(gcs_path)
-            print(f"File exists in GCS: {gcs_exists}")
+            gcs_exists = cached_exists(gcs_path)
+            logger.debug("File exists in GCS: %s", gcs_exists)
             
             if gcs_exists:
                 try:
                     # Generate a signed URL for the image file
-                    signed_url = generate_signed_url(gcs_path, expiration_minutes=30)
-                    print(f"Generated signed URL: {signed_url[:50]}...") if signed_url else print("Failed to generate signed URL")
+                    signed_url = cached_signed_url(gcs_path, expiration_minutes=30)
+                    if signed_url:
+                        logger.debug("Generated signed URL: %s...", signed_url[:50])
+                    else:
+                        logger.error("Failed to generate signed URL")
                     
                     if signed_url:
                         return redirect(signed_url)
                 except Exception as e:
-                    print(f"Error generating signed URL: {str(e)}")
-                    traceback.print_exc()
+                    logger.exception("Error generating signed URL: %s", e)
         
         # Fallback to checking local files
         # Try different potential local paths
         possible_paths = [
-            os.path.join(UPLOAD_FOLDER, pdf_name, 'image_files', f"{pdf_name}_page_{page_num}.jpg"),  # Standard format
-            os.path.join(UPLOAD_FOLDER, pdf_name, 'image_files', f"page_{page_num}.jpg")  # Alternate format
+            pdf_path(pdf_name, 'image_files', f"{pdf_name}_page_{page_num}.jpg"),  # Standard format
+            pdf_path(pdf_name, 'image_files', f"page_{page_num}.jpg")  # Alternate format
         ]
         
         for image_path in possible_paths:
-            print(f"Checking local path: {image_path}")
+            logger.debug("Checking local path: %s", image_path)
             if os.path.exists(image_path):
-                print(f"Found image at: {image_path}")
+                logger.debug("Found image at: %s", image_path)
                 
-                # Try to upload to GCS for future requests if GCS is available
+                # Copy to GCS for future requests without making this one wait
                 if gcs_available and not gcs_exists:
-                    try:
-                        print(f"Uploading to GCS: {gcs_path}")
-                        result = upload_from_filename(image_path, gcs_path, content_type='image/jpeg')
-                        print(f"Upload result: {result}")
-                        
-                        if result:
-                            signed_url = generate_signed_url(gcs_path, expiration_minutes=30)
-                            if signed_url:
-                                return redirect(signed_url)
-                    except Exception as e:
-                        print(f"Error uploading image to GCS: {str(e)}")
-                        traceback.print_exc()
+                    logger.debug("Queueing upload to GCS: %s", gcs_path)
+                    copy_to_gcs_in_background(image_path, gcs_path, content_type='image/jpeg')
                 
-                # Fallback to local file
-                print(f"Serving local file: {image_path}")
-                return send_file(image_path, mimetype='image/jpeg')
+                # Serve the local file
+                logger.debug("Serving local file: %s", image_path)
+                return send_file(image_path, mimetype='image/jpeg', conditional=True)
 
-        # If we still haven't found the image, check if a generic image exists in GCS
-        if gcs_available:
-            generic_path = f"{GCS_IMAGE_PREFIX}{pdf_name}/page_{page_num}.jpg"
-            if check_if_file_exists(generic_path) and generic_path != gcs_path:
-                print(f"Found generic image in GCS: {generic_path}")
-                signed_url = generate_signed_url(generic_path, expiration_minutes=30)
-                if signed_url:
-                    return redirect(signed_url)
-        
-        print(f"Image not found for PDF: {pdf_name}, Page: {page_num}")
+        logger.warning("Image not found for PDF: %s, Page: %s", pdf_name, page_num)
         return jsonify({'error': 'Image file not found'}), 404
     except Exception as e:
-        print(f"Error serving image: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error serving image: %s", e)
         return jsonify({'error': f'Error serving image: {str(e)}'}), 500
 
 @app.route('/get-audio/<path:filename>', methods=['GET'])
@@ -811,24 +1167,17 @@ def get_audio(filename):
     gcs_path = f"{GCS_AUDIO_PREFIX}{filename}"
     
     # Check if file exists in GCS
-    if check_if_file_exists(gcs_path):
+    if cached_exists(gcs_path):
         # Generate a signed URL for the audio file
-        signed_url = generate_signed_url(gcs_path, expiration_minutes=30)
+        signed_url = cached_signed_url(gcs_path, expiration_minutes=30)
         return redirect(signed_url)
     
-    # Fallback to searching in local files
-    for pdf_folder in os.listdir(UPLOAD_FOLDER):
-        audio_path = os.path.join(UPLOAD_FOLDER, pdf_folder, 'audio_files', filename)
-        if os.path.exists(audio_path):
-            # Upload to GCS for future requests
-            try:
-                upload_from_filename(audio_path, gcs_path, content_type='audio/mpeg')
-                signed_url = generate_signed_url(gcs_path, expiration_minutes=30)
-                return redirect(signed_url)
-            except Exception as e:
-                print(f"Error uploading audio to GCS: {str(e)}")
-                # Fallback to local file if upload fails
-            return send_file(audio_path, mimetype='audio/mpeg')
+    # Fallback to the local file, if there is one
+    audio_path = AUDIO_INDEX.get(filename)
+    if audio_path and os.path.exists(audio_path):
+        # Copy to GCS for future requests without making this one wait
+        copy_to_gcs_in_background(audio_path, gcs_path, content_type='audio/mpeg')
+        return send_file(audio_path, mimetype='audio/mpeg', conditional=True)
     
     return jsonify({'error': 'Audio file not found'}), 404
 
@@ -838,27 +1187,45 @@ def get_image(filename):
     gcs_path = f"{GCS_IMAGE_PREFIX}{filename}"
     
     # Check if file exists in GCS
-    if check_if_file_exists(gcs_path):
+    if cached_exists(gcs_path):
         # Generate a signed URL for the image file
-        signed_url = generate_signed_url(gcs_path, expiration_minutes=30)
+        signed_url = cached_signed_url(gcs_path, expiration_minutes=30)
         return redirect(signed_url)
     
-    # Fallback to searching in local files
-    for pdf_folder in os.listdir(UPLOAD_FOLDER):
-        image_path = os.path.join(UPLOAD_FOLDER, pdf_folder, 'image_files', filename)
-        if os.path.exists(image_path):
-            # Upload to GCS for future requests
-            try:
-                upload_from_filename(image_path, gcs_path, content_type='image/jpeg')
-                signed_url = generate_signed_url(gcs_path, expiration_minutes=30)
-                return redirect(signed_url)
-            except Exception as e:
-                print(f"Error uploading image to GCS: {str(e)}")
-                # Fallback to local file if upload fails
-            return send_file(image_path, mimetype='image/jpeg')
+    # Fallback to the local file, if there is one
+    image_path = IMAGE_INDEX.get(filename)
+    if image_path and os.path.exists(image_path):
+        # Copy to GCS for future requests without making this one wait
+        copy_to_gcs_in_background(image_path, gcs_path, content_type='image/jpeg')
+        return send_file(image_path, mimetype='image/jpeg', conditional=True)
     
     return jsonify({'error': 'Image file not found'}), 404
 
+def stream_answer(prompt):
+    """Yield an answer to the question prompt as Server-Sent Events"""
+    def event(payload, name=None):
+        prefix = f"event: {name}\n" if name else ""
+        return f"{prefix}data: {orjson.dumps(payload).decode()}\n\n"
+    
+    try:
+        # Hold back the start of the answer until the "Think and Response"
+        # style prefix can be stripped from it
+        head = ""
+        for piece in stream_text_cached([prompt]):
+            if head is None:
+                yield event({'text': piece})
+                continue
+            head += piece
+            if len(head.lstrip()) >= ANSWER_PREFIX_HOLD_CHARS:
+                yield event({'text': _ANSWER_PREFIX_RE.sub('', head.lstrip())})
+                head = None
+        if head is not None:
+            yield event({'text': _ANSWER_PREFIX_RE.sub('', head.strip())})
+        yield event({}, name='done')
+    except Exception as e:
+        logger.exception("Error answering question: %s", e)
+        yield event({'error': str(e)}, name='error')
+
 @app.route('/ask-question', methods=['POST'])
 def ask_question():
     try:
@@ -869,8 +1236,10 @@ def ask_question():
         question = data['question']
         context = data['context']
         pdf_name = data.get('pdf_name', '')
+        if pdf_name and pdf_path(pdf_name) is None:
+            pdf_name = ''
         
-        print(f"Received question: '{question}' for PDF: {pdf_name}")
+        logger.debug("Received question: '%s' for PDF: %s", question, pdf_name)
         
         # Check if we have additional context from the PDF in GCS
         additional_context = ""
@@ -880,10 +1249,10 @@ def ask_question():
                 if gcs_available:
                     # Get all text files for this PDF
                     text_prefix = f"{GCS_TEXT_PREFIX}{pdf_name}/"
-                    text_files = list_files_with_prefix(text_prefix)
+                    text_files = cached_list_files(text_prefix)
                     
                     if text_files:
-                        print(f"Found {len(text_files)} additional context files in GCS")
+                        logger.debug("Found %s additional context files in GCS", len(text_files))
                         # Get content from up to 3 files (to avoid overloading)
                         for text_file in text_files[:3]:
                             content = download_as_string(text_file)
@@ -892,66 +1261,70 @@ def ask_question():
                 
                 # If no GCS content, try local files
                 if not additional_context:
-                    pdf_folder = os.path.join(UPLOAD_FOLDER, pdf_name)
+                    pdf_folder = pdf_path(pdf_name)
                     text_folder = os.path.join(pdf_folder, 'text_files')
                     
-                    if os.path.exists(text_folder):
-                        text_files = [f for f in os.listdir(text_folder) if f.endswith('.md')][:3]
-                        print(f"Found {len(text_files)} additional context files locally")
+                    text_files = [f for f in list_files_cached(text_folder) if f.endswith('.md')][:3]
+                    if text_files:
+                        logger.debug("Found %s additional context files locally", len(text_files))
                         
                         for text_file in text_files:
                             with open(os.path.join(text_folder, text_file), 'r') as f:
                                 additional_context += f.read() + "\n\n"
             
             except Exception as e:
-                print(f"Error getting additional context: {str(e)}")
+                logger.error("Error getting additional context: %s", e)
                 # Continue with the original context
         
         # Combine the original context with any additional context
         full_context = context
         if additional_context:
-            print("Adding additional context from PDF files")
+            logger.debug("Adding additional context from PDF files")
             full_context = full_context + "\n\n" + additional_context
         
         # Use Gemini to answer the question based on the context
-        print("Sending question to Gemini API")
-        response = model.generate_content(
-            contents=[
-                f"""
-                # Context: {full_context}
-                
-                # Question: {question}
-                
-                # Answer the question based on the provided context. Be comprehensive and accurate.
-                # If the answer is not in the context, say "I don't have enough information to answer this question accurately."
-                # Don't be afraid to give detailed technical explanations if the question asks for them.
-                # Avoid starting with phrases like "Think and Response" or similar templates.
-                # Always cite page numbers if you know them.
-                """
-            ]
-        )
+        logger.debug("Sending question to Gemini API")
+        prompt = f"""
+            # Context: {full_context}
+            
+            # Question: {question}
+            
+            # Answer the question based on the provided context. Be comprehensive and accurate.
+            # If the answer is not in the context, say "I don't have enough information to answer this question accurately."
+            # Don't be afraid to give detailed technical explanations if the question asks for them.
+            # Avoid starting with phrases like "Think and Response" or similar templates.
+            # Always cite page numbers if you know them.
+            """
+        
+        # Clients that accept Server-Sent Events get the answer as it is generated
+        if 'text/event-stream' in request.headers.get('Accept', ''):
+            return Response(stream_with_context(stream_answer(prompt)), mimetype='text/event-stream')
+        
+        answer_text = generate_text_cached([prompt])
         
         # Process the response to remove any unwanted prefixes or formatting issues
-        answer_text = response.text.strip()
+        answer_text = answer_text.strip()
         
         # Remove "Think and Response" prefix and similar phrases
-        answer_text = re.sub(r'^(Think and Response\.?|Based on the context,|According to the context,)\s*', '', answer_text, flags=re.IGNORECASE)
+        answer_text = _ANSWER_PREFIX_RE.sub('', answer_text)
         
-        print(f"Generated answer: {answer_text[:100]}...")
+        logger.debug("Generated answer: %s...", answer_text[:100])
         
         return jsonify({
             'answer': answer_text
         })
     
     except Exception as e:
-        print(f"Error answering question: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error answering question: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/generate-quiz/<path:pdf_name>', methods=['POST'])
 def generate_quiz(pdf_name):
     try:
-        print(f"Generating quiz for PDF: {pdf_name}")
+        # Names that would resolve outside UPLOAD_FOLDER can't be a PDF
+        if pdf_path(pdf_name) is None:
+            return jsonify({'error': 'PDF not found'}), 404
+        logger.debug("Generating quiz for PDF: %s", pdf_name)
         
         # Check if we need to verify user authentication
         # (Uncomment this if quiz generation should be restricted to authenticated users)
@@ -964,109 +1337,103 @@ def generate_quiz(pdf_name):
         gcs_quiz_path = None
         
         if gcs_available:
-            # Check if PDF exists in GCS
-            gcs_pdf_path = f"{GCS_PDF_PREFIX}{pdf_name}/original.pdf"
-            gcs_pdf_exists = check_if_file_exists(gcs_pdf_path)
-            print(f"PDF exists in GCS: {gcs_pdf_exists}")
-            
-            # Check if quiz already exists in GCS
+            # Return the existing quiz from GCS if there is one
             gcs_quiz_path = f"{GCS_QUIZ_PREFIX}{pdf_name}/quiz.json"
-            gcs_quiz_exists = check_if_file_exists(gcs_quiz_path)
-            print(f"Quiz exists in GCS: {gcs_quiz_exists}")
+            quiz_content = try_download(gcs_quiz_path)
+            logger.debug("Quiz exists in GCS: %s", quiz_content is not None)
             
-            if gcs_quiz_exists:
-                # Return existing quiz from GCS
-                print(f"Returning existing quiz from GCS")
-                quiz_content = download_as_string(gcs_quiz_path)
-                if quiz_content:
-                    quiz_data = json.loads(quiz_content)
-                    return jsonify(quiz_data)
+            if quiz_content:
+                logger.debug("Returning existing quiz from GCS")
+                # Stored quizzes are already serialized JSON, so they are sent as-is
+                return Response(quiz_content, mimetype='application/json')
+            
+            # Check if PDF exists in GCS
+            gcs_pdf_path = f"{GCS_PDF_PREFIX}{pdf_name}/original.pdf"
+            gcs_pdf_exists = cached_exists(gcs_pdf_path)
+            logger.debug("PDF exists in GCS: %s", gcs_pdf_exists)
                     
         # Check local storage for PDF and quiz
-        pdf_folder = os.path.join(UPLOAD_FOLDER, pdf_name)
-        pdf_exists = os.path.exists(pdf_folder)
-        print(f"PDF exists in local storage: {pdf_exists}")
+        pdf_folder = pdf_path(pdf_name)
+        pdf_exists = path_exists_cached(pdf_folder)
+        logger.debug("PDF exists in local storage: %s", pdf_exists)
         
         if not pdf_exists and not gcs_pdf_exists:
-            print(f"PDF not found: {pdf_name}")
+            logger.warning("PDF not found: %s", pdf_name)
             return jsonify({'error': 'PDF folder not found'}), 404
             
         # Create local quiz folder if needed
         quiz_folder = os.path.join(pdf_folder, 'quiz_data')
-        if not os.path.exists(quiz_folder) and pdf_exists:
-            os.makedirs(quiz_folder)
+        if pdf_exists and not path_exists_cached(quiz_folder):
+            os.makedirs(quiz_folder, exist_ok=True)
+            forget_local_path(quiz_folder)
             
         # Check if quiz already exists locally
         local_quiz_path = os.path.join(quiz_folder, f"{pdf_name}_quiz.json")
-        if os.path.exists(local_quiz_path):
+        if path_exists_cached(local_quiz_path):
             # Return existing quiz
-            print(f"Returning existing quiz from local storage")
-            with open(local_quiz_path, 'r') as f:
-                quiz_data = json.load(f)
-                
-                # Upload to GCS if available
-                if gcs_available and gcs_quiz_path:
-                    try:
-                        upload_file(json.dumps(quiz_data), gcs_quiz_path, content_type='application/json')
-                        print(f"Uploaded existing quiz to GCS: {gcs_quiz_path}")
-                    except Exception as e:
-                        print(f"Error uploading quiz to GCS: {str(e)}")
-                
-            return jsonify(quiz_data)
+            logger.debug("Returning existing quiz from local storage")
+            
+            # Copy it to GCS in the background, unless it is already there
+            # (e.g. uploaded by a concurrent request)
+            if gcs_available and gcs_quiz_path and not cached_exists(gcs_quiz_path):
+                copy_to_gcs_in_background(local_quiz_path, gcs_quiz_path, content_type='application/json')
+                logger.debug("Queued upload of existing quiz to GCS: %s", gcs_quiz_path)
+            
+            # The file is already serialized JSON, so it is sent as is
+            return send_file(local_quiz_path, mimetype='application/json', conditional=True)
         
         # Collect explanations for the PDF from both GCS and local storage
         all_explanations = []
         
         # Get explanations from GCS if available
         if gcs_available:
-            print(f"Checking GCS for explanations")
+            logger.debug("Checking GCS for explanations")
             # List all text files in GCS
             text_prefix = f"{GCS_TEXT_PREFIX}{pdf_name}/"
-            text_files = list_files_with_prefix(text_prefix)
+            text_files = cached_list_files(text_prefix)
             
             if text_files:
                 # Sort by page number
-                text_files.sort(key=lambda f: int(re.search(r'page_(\d+)\.md$', f).group(1)))
+                text_files.sort(key=lambda f: int(_PAGE_MD_RE.search(f).group(1)))
                 
-                # Get content for each file
-                for text_file in text_files:
-                    try:
-                        content = download_as_string(text_file)
+                # Download all files concurrently (map keeps page order)
+                try:
+                    contents = list(io_pool.map(download_as_string, text_files))
+                    for text_file, content in zip(text_files, contents):
                         if content:
                             all_explanations.append(content.decode('utf-8'))
-                            print(f"Loaded explanation from GCS: {text_file}")
-                    except Exception as e:
-                        print(f"Error loading explanation from GCS: {str(e)}")
+                            logger.debug("Loaded explanation from GCS: %s", text_file)
+                except Exception as e:
+                    logger.error("Error loading explanation from GCS: %s", e)
         
         # Get explanations from local storage if needed
         if not all_explanations and pdf_exists:
-            print(f"Checking local storage for explanations")
+            logger.debug("Checking local storage for explanations")
             text_folder = os.path.join(pdf_folder, 'text_files')
-        if os.path.exists(text_folder):
-            text_files = sorted([f for f in os.listdir(text_folder) if f.endswith('.md')],
-                               key=lambda f: int(f.split('_page_')[1].split('.')[0]))
+            text_files = sorted([f for f in list_files_cached(text_folder) if f.endswith('.md')],
+                               key=lambda f: int(_PAGE_MD_RE.search(f).group(1)))
             
             for text_file in text_files:
                 with open(os.path.join(text_folder, text_file), 'r') as f:
                     all_explanations.append(f.read())
-                    print(f"Loaded explanation from local file: {text_file}")
+                    logger.debug("Loaded explanation from local file: %s", text_file)
         
         # If no text files, use images to regenerate summaries
         if not all_explanations:
-            print(f"No explanations found, generating from images")
+            logger.debug("No explanations found, generating from images")
             image_files = []
             
             # Check GCS for images
             if gcs_available:
                 image_prefix = f"{GCS_IMAGE_PREFIX}{pdf_name}/"
-                image_files_gcs = list_files_with_prefix(image_prefix)
+                image_files_gcs = cached_list_files(image_prefix)
                 
                 # Extract page numbers from file paths and sort
                 if image_files_gcs:
                     # Convert to list of tuples (file_path, page_number)
                     image_files = []
                     for file_path in image_files_gcs:
-                        match = re.search(r'page_(\d+)\.jpg$', file_path)
+                        match = _PAGE_JPG_RE.search(file_path)
                         if match:
                             page_num = int(match.group(1))
                             image_files.append((file_path, page_num, True))  # True = GCS file
@@ -1077,61 +1444,72 @@ def generate_quiz(pdf_name):
             # Check local storage for images if needed
             if not image_files and pdf_exists:
                 image_folder = os.path.join(pdf_folder, 'image_files')
-                if os.path.exists(image_folder):
-                    local_image_files = sorted([f for f in os.listdir(image_folder) if f.endswith('.jpg')],
-                                    key=lambda f: int(re.search(r'_page_(\d+)\.jpg$', f).group(1) 
-                                                    if '_page_' in f 
-                                                    else re.search(r'page_(\d+)\.jpg$', f).group(1)))
-                    
-                    image_files = [(os.path.join(image_folder, f), 
-                                  int(re.search(r'_page_(\d+)\.jpg$', f).group(1) 
-                                      if '_page_' in f 
-                                      else re.search(r'page_(\d+)\.jpg$', f).group(1)), 
-                                  False)  # False = local file
-                                for f in local_image_files]
+                if path_exists_cached(image_folder):
+                    # "<name>_page_N.jpg" and "page_N.jpg" both end in page_N.jpg,
+                    # so one match gives the page number used for sorting too
+                    image_files = sorted((
+                        (os.path.join(image_folder, f), int(match.group(1)), False)  # False = local file
+                        for f in list_files_cached(image_folder)
+                        if (match := _PAGE_JPG_RE.search(f))
+                    ), key=lambda item: item[1])
             
             # Generate summaries from images
             if image_files:
-                print(f"Generating summaries from {len(image_files)} images")
-                for file_path, page_num, is_gcs in image_files:
+                logger.debug("Generating summaries from %s images", len(image_files))
+                
+                def summarize_pages(batch):
+                    """Summarize a batch of page images with one Gemini request"""
+                    contents = [
+                        "Provide a comprehensive summary of the key concepts on each of the following pages that would be useful for quiz generation. Label each summary with its page number."
+                    ]
+                    for file_path, page_num, is_gcs in batch:
+                        try:
+                            # Get image data
+                            if is_gcs:
+                                image_data = download_as_string(file_path)
+                            else:
+                                with open(file_path, 'rb') as img_file:
+                                    image_data = img_file.read()
+                            
+                            if not image_data:
+                                logger.debug("No image data for page %s", page_num)
+                                continue
+                            
+                            contents.extend([f"Page {page_num}:", jpeg_part(image_data)])
+                        except Exception as e:
+                            logger.error("Error loading image for page %s: %s", page_num, e)
+                    
+                    if len(contents) == 1:
+                        return None
+                    
+                    pages = f"{batch[0][1]}-{batch[-1][1]}"
                     try:
-                        # Get image data
-                        if is_gcs:
-                            image_data = download_as_string(file_path)
-                        else:
-                            with open(file_path, 'rb') as img_file:
-                                image_data = img_file.read()
-                        
-                        if not image_data:
-                            print(f"No image data for page {page_num}")
-                            continue
-                        
-                        # Load image
-                        image = Image.open(BytesIO(image_data))
-                        
-                        # Get a brief summary of the page for quiz generation
-                        print(f"Generating summary for page {page_num}")
-                        response = model.generate_content(
-                            contents=[
-                                "Provide a comprehensive summary of the key concepts on this page that would be useful for quiz generation.",
-                                image
-                            ]
-                        )
-                        
-                        all_explanations.append(response.text)
-                        print(f"Generated summary for page {page_num}")
+                        logger.debug("Generating summary for pages %s", pages)
+                        summary = generate_text_cached(contents)
+                        logger.debug("Generated summary for pages %s", pages)
+                        return summary
                     except Exception as e:
-                        print(f"Error generating summary for page {page_num}: {str(e)}")
-                        traceback.print_exc()
-                        continue
+                        logger.exception("Error generating summary for pages %s: %s", pages, e)
+                        return None
+                
+                # The summaries are only concatenated into the quiz prompt, so
+                # several pages can share one request; batches run concurrently
+                batches = [
+                    image_files[i:i + QUIZ_SUMMARY_BATCH_SIZE]
+                    for i in range(0, len(image_files), QUIZ_SUMMARY_BATCH_SIZE)
+                ]
+                all_explanations.extend(
+                    summary for summary in io_pool.map(summarize_pages, batches) if summary
+                )
         
         if not all_explanations:
-            print(f"No content found to generate quiz")
+            logger.debug("No content found to generate quiz")
             return jsonify({'error': 'No content found to generate quiz'}), 404
         
         # Generate quiz based on all explanations
-        print(f"Generating quiz from {len(all_explanations)} explanations")
-        combined_text = "\n\n".join(all_explanations)
+        logger.debug("Generating quiz from %s explanations", len(all_explanations))
+        # Only the head of the content fits in the prompt; the fallback uses a shorter prefix of it
+        quiz_source = head_join(all_explanations, "\n\n", 8000)
         
         response = model.generate_content(
             contents=[
@@ -1157,31 +1535,30 @@ def generate_quiz(pdf_name):
                 Make sure to provide 5 questions and use the EXACT format above. Return ONLY valid JSON data, nothing else.
                 
                 Content:
-                {combined_text[:8000]}
+                {quiz_source}
                 """
             ]
         )
         
         # Extract JSON from response
         quiz_text = response.text
-        print(f"Raw response: {quiz_text[:100]}...")
+        logger.debug("Raw response: %s...", quiz_text[:100])
         
         try:
             # Try to extract JSON if it's wrapped in markdown code blocks
             if "```json" in quiz_text:
                 quiz_text = quiz_text.split("```json")[1].split("```")[0].strip()
-                print("Extracted JSON from markdown code block")
+                logger.debug("Extracted JSON from markdown code block")
             elif "```" in quiz_text:
                 quiz_text = quiz_text.split("```")[1].split("```")[0].strip()
-                print("Extracted JSON from code block")
+                logger.debug("Extracted JSON from code block")
             
             # Try to clean up the JSON to handle common formatting issues
             # Remove potential trailing commas
-            quiz_text = re.sub(r',\s*}', '}', quiz_text)
-            quiz_text = re.sub(r',\s*]', ']', quiz_text)
+            quiz_text = _TRAILING_COMMA_RE.sub(r'\1', quiz_text)
             
-            print(f"Cleaned JSON: {quiz_text[:100]}...")
-            quiz_data = json.loads(quiz_text)
+            logger.debug("Cleaned JSON: %s...", quiz_text[:100])
+            quiz_data = orjson.loads(quiz_text)
             
             # Validate the quiz data has the right structure
             if not isinstance(quiz_data, list):
@@ -1193,30 +1570,32 @@ def generate_quiz(pdf_name):
                 if 'question' not in item or 'options' not in item or 'correctAnswer' not in item:
                     raise ValueError("Quiz item is missing required fields")
             
+            quiz_bytes = orjson.dumps(quiz_data)
+            
             # Save quiz to local file if PDF exists locally
             if pdf_exists:
-                with open(local_quiz_path, 'w') as f:
-                    json.dump(quiz_data, f)
-                print(f"Saved quiz to local file: {local_quiz_path}")
+                with open(local_quiz_path, 'wb') as f:
+                    f.write(quiz_bytes)
+                forget_local_path(local_quiz_path)
+                logger.debug("Saved quiz to local file: %s", local_quiz_path)
             
             # Upload quiz to GCS if available
             if gcs_available and gcs_quiz_path:
                 try:
-                    upload_file(json.dumps(quiz_data), gcs_quiz_path, content_type='application/json')
-                    print(f"Uploaded quiz to GCS: {gcs_quiz_path}")
+                    upload_file(quiz_bytes, gcs_quiz_path, content_type='application/json')
+                    logger.debug("Uploaded quiz to GCS: %s", gcs_quiz_path)
                 except Exception as e:
-                    print(f"Error uploading quiz to GCS: {str(e)}")
+                    logger.error("Error uploading quiz to GCS: %s", e)
             
-            return jsonify(quiz_data)
+            return Response(quiz_bytes, mimetype='application/json')
         
-        except json.JSONDecodeError as e:
-            print(f"Error parsing quiz JSON: {str(e)}")
-            print(f"Raw quiz text: {quiz_text}")
-            traceback.print_exc()
+        except orjson.JSONDecodeError as e:
+            logger.exception("Error parsing quiz JSON: %s", e)
+            logger.debug("Raw quiz text: %s", quiz_text)
             
             # Try one more time with a simpler prompt
             try:
-                print("Trying again with simpler prompt")
+                logger.debug("Trying again with simpler prompt")
                 simple_response = model.generate_content(
                     contents=[
                         f"""
@@ -1226,7 +1605,7 @@ def generate_quiz(pdf_name):
                         Return ONLY valid JSON, nothing else.
                         
                         Content:
-                        {combined_text[:4000]}
+                        {quiz_source[:4000]}
                         """
                     ]
                 )
@@ -1237,81 +1616,84 @@ def generate_quiz(pdf_name):
                 elif "```" in simple_text:
                     simple_text = simple_text.split("```")[1].split("```")[0].strip()
                 
-                simple_text = re.sub(r',\s*}', '}', simple_text)
-                simple_text = re.sub(r',\s*]', ']', simple_text)
+                simple_text = _TRAILING_COMMA_RE.sub(r'\1', simple_text)
                 
-                simple_data = json.loads(simple_text)
+                simple_bytes = orjson.dumps(orjson.loads(simple_text))
                 
                 # Save and upload the quiz data
                 if pdf_exists:
-                    with open(local_quiz_path, 'w') as f:
-                        json.dump(simple_data, f)
+                    with open(local_quiz_path, 'wb') as f:
+                        f.write(simple_bytes)
+                    forget_local_path(local_quiz_path)
                 
                 if gcs_available and gcs_quiz_path:
-                    upload_file(json.dumps(simple_data), gcs_quiz_path, content_type='application/json')
+                    upload_file(simple_bytes, gcs_quiz_path, content_type='application/json')
                 
-                return jsonify(simple_data)
+                return Response(simple_bytes, mimetype='application/json')
             
             except Exception as backup_error:
-                print(f"Second attempt also failed: {str(backup_error)}")
-                traceback.print_exc()
+                logger.exception("Second attempt also failed: %s", backup_error)
             return jsonify({'error': 'Failed to generate valid quiz format'}), 500
         
     except Exception as e:
-        print(f"Error generating quiz: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error generating quiz: %s", e)
         return jsonify({'error': str(e)}), 500
 
+# Text members are the only ones that shrink; level 1 gets most of the
+# ratio for a fraction of the CPU
+ZIP_DEFLATE_SUFFIXES = ('.md', '.json')
+
+def zip_member_options(name):
+    if name.endswith(ZIP_DEFLATE_SUFFIXES):
+        return {'compress_type': ZIP_DEFLATED, 'compress_level': 1}
+    return {}
+
 @app.route('/download-materials/<path:pdf_name>', methods=['GET'])
 def download_materials(pdf_name):
     try:
-        pdf_folder = os.path.join(UPLOAD_FOLDER, pdf_name)
-        if not os.path.exists(pdf_folder):
+        # Names that would resolve outside UPLOAD_FOLDER can't be a PDF
+        if pdf_path(pdf_name) is None:
+            return jsonify({'error': 'PDF not found'}), 404
+        pdf_folder = pdf_path(pdf_name)
+        if not path_exists_cached(pdf_folder):
             return jsonify({'error': 'PDF folder not found'}), 404
             
-        # Create in-memory zip file
-        memory_file = io.BytesIO()
-        with zipfile.ZipFile(memory_file, 'w') as zf:
-            # Add all related files
-            for folder_name in ['audio_files', 'image_files', 'text_files']:
-                folder_path = os.path.join(pdf_folder, folder_name)
-                if os.path.exists(folder_path):
-                    for file in os.listdir(folder_path):
-                        file_path = os.path.join(folder_path, file)
-                        if os.path.isfile(file_path):
-                            zf.write(file_path, f"{folder_name}/{file}")
-            
-            # Add quiz if it exists
-            quiz_folder = os.path.join(pdf_folder, 'quiz_data')
-            if os.path.exists(quiz_folder):
-                for file in os.listdir(quiz_folder):
-                    file_path = os.path.join(quiz_folder, file)
-                    if os.path.isfile(file_path):
-                        zf.write(file_path, f"quiz_data/{file}")
-            
-            # Add original PDF file if it exists
-            original_pdf_path = os.path.join(pdf_folder, 'original.pdf')
-            if os.path.exists(original_pdf_path):
-                zf.write(original_pdf_path, f"{pdf_name}.pdf")
-            
-            # Add metadata file if it exists
-            metadata_path = os.path.join(pdf_folder, 'metadata.json')
-            if os.path.exists(metadata_path):
-                zf.write(metadata_path, "metadata.json")
+        # Stream the zip as it is written instead of building it in memory.
+        # JPEG/MP3 (and the PDF's own streams) are already compressed, so
+        # they are stored; only the text members are deflated.
+        zf = ZipStream(compress_type=ZIP_STORED)
+        
+        # Add all related files
+        for folder_name in ['audio_files', 'image_files', 'text_files']:
+            folder_path = os.path.join(pdf_folder, folder_name)
+            for file in list_files_cached(folder_path):
+                zf.add_path(os.path.join(folder_path, file), f"{folder_name}/{file}", **zip_member_options(file))
+        
+        # Add quiz if it exists
+        quiz_folder = os.path.join(pdf_folder, 'quiz_data')
+        for file in list_files_cached(quiz_folder):
+            zf.add_path(os.path.join(quiz_folder, file), f"quiz_data/{file}", **zip_member_options(file))
+        
+        # Add original PDF file if it exists
+        original_pdf_path = os.path.join(pdf_folder, 'original.pdf')
+        if path_exists_cached(original_pdf_path):
+            zf.add_path(original_pdf_path, f"{pdf_name}.pdf")
         
-        # Seek to the beginning of the stream
-        memory_file.seek(0)
+        # Add metadata file if it exists
+        metadata_path = os.path.join(pdf_folder, 'metadata.json')
+        if path_exists_cached(metadata_path):
+            zf.add_path(metadata_path, "metadata.json", **zip_member_options(metadata_path))
         
-        return send_file(
-            memory_file,
+        return Response(
+            zf,
             mimetype='application/zip',
-            as_attachment=True,
-            download_name=f"{pdf_name}_study_materials.zip"
+            headers={
+                'Content-Disposition': f'attachment; filename="{pdf_name}_study_materials.zip"'
+            }
         )
     
     except Exception as e:
-        print(f"Error creating zip file: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error creating zip file: %s", e)
         return jsonify({'error': str(e)}), 500
 
 # Process PDF with deduplication
@@ -1330,13 +1712,24 @@ def process_pdf():
     
     # Get the difficulty level from the form data, default to "detailed" if not provided
     difficulty_level = request.form.get('difficulty_level', 'detailed')
-    print(f"Processing PDF with difficulty level: {difficulty_level}")
+    logger.debug("Processing PDF with difficulty level: %s", difficulty_level)
+    # Clients that load pages through image_url/audio_url can send
+    # inline_media=false to leave the base64 copies out of the stream
+    inline_media = request.form.get('inline_media', 'true').lower() != 'false'
+    # format=msgpack streams concatenated MessagePack objects instead of
+    # NDJSON; inline image/audio then travel as raw bin fields, not base64
+    use_msgpack = request.form.get('format', 'ndjson').lower() == 'msgpack'
+
+    def encode_message(message):
+        if use_msgpack:
+            return msgpack.packb(message, use_bin_type=True)
+        return orjson.dumps(message, option=orjson.OPT_APPEND_NEWLINE)
 
     # Get PDF name without extension for saving files
     original_pdf_name = os.path.splitext(os.path.basename(file.filename))[0]
     
     # Clean the PDF name (replace spaces with underscores, remove special characters)
-    pdf_name = re.sub(r'[^\w\-]', '_', original_pdf_name).lower()
+    pdf_name = _CLEAN_NAME_RE.sub('_', original_pdf_name).lower()
     
     # Get the current user's ID
     user_id = request.user['user_id']
@@ -1344,18 +1737,17 @@ def process_pdf():
     # Create a temp file for PDF processing
     with NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
         temp_pdf_path = temp_file.name
-        file.save(temp_pdf_path)
-        print(f"PDF temporarily saved to {temp_pdf_path}")
-    
-    # Calculate the file's hash to check for duplicates
-    pdf_hash = calculate_file_hash(temp_pdf_path)
-    print(f"PDF hash: {pdf_hash}")
+        # Hash the upload while it is written, to check for duplicates
+        # without reading the file back
+        pdf_hash = copy_and_hash(file.stream, temp_file)
+        logger.debug("PDF temporarily saved to %s", temp_pdf_path)
+    logger.debug("PDF hash: %s", pdf_hash)
     
     # Check if this exact PDF has been uploaded before
     existing_pdf = get_pdf_by_hash(pdf_hash)
     
     if existing_pdf:
-        print(f"PDF with hash {pdf_hash} already exists in the database")
+        logger.debug("PDF with hash %s already exists in the database", pdf_hash)
         
         # Associate this PDF with the current user
         associate_pdf_with_user(user_id, existing_pdf['pdf_id'])
@@ -1383,45 +1775,46 @@ def process_pdf():
     temp_folder = os.path.join(UPLOAD_FOLDER, pdf_id)
     os.makedirs(temp_folder, exist_ok=True)
     
+    # Open the PDF - pages are rasterized one at a time in generate() below
+    logger.debug("Opening PDF for rendering...")
+    doc = fitz.open(temp_pdf_path)
+    page_count = doc.page_count
+    logger.debug("PDF has %s pages", page_count)
+    
     # Save metadata
     metadata = {
         'date_processed': time.strftime('%Y-%m-%d %H:%M:%S'),
         'original_filename': file.filename,
         'difficulty_level': difficulty_level,
-        'user_id': user_id
+        'user_id': user_id,
+        'page_count': page_count
     }
     
     # Upload original PDF to GCS
     gcs_pdf_path = f"{GCS_PDF_PREFIX}{pdf_id}/original.pdf"
     try:
         upload_from_filename(temp_pdf_path, gcs_pdf_path, content_type='application/pdf')
-        print(f"PDF uploaded to GCS: {gcs_pdf_path}")
+        logger.debug("PDF uploaded to GCS: %s", gcs_pdf_path)
     except Exception as e:
-        print(f"Error uploading PDF to GCS: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error uploading PDF to GCS: %s", e)
         # Continue with local processing if GCS upload fails
     
     # Upload metadata to GCS
     gcs_metadata_path = f"{GCS_PDF_PREFIX}{pdf_id}/metadata.json"
     try:
-        upload_file(json.dumps(metadata), gcs_metadata_path, content_type='application/json')
+        if upload_file(orjson.dumps(metadata), gcs_metadata_path, content_type='application/json'):
+            remember_pdf_metadata(pdf_id, metadata)
     except Exception as e:
-        print(f"Error uploading metadata to GCS: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error uploading metadata to GCS: %s", e)
     
     # Get file size
     file_size = os.path.getsize(temp_pdf_path)
 
     def generate():
         try:
-            # Convert PDF to images
-            print("Converting PDF to images...")
-            images = convert_from_path(temp_pdf_path)
-            page_count = len(images)
-            print(f"Converted {page_count} pages")
-            
-            # Add the PDF to the database
-            pdf_db_id = add_pdf(
+            # Add the PDF to the database and associate it with the user
+            add_pdf_for_user(
+                user_id,
                 title=original_pdf_name,
                 file_path=pdf_id,
                 pdf_hash=pdf_hash,
@@ -1429,145 +1822,222 @@ def process_pdf():
                 page_count=page_count
             )
             
-            # Associate the PDF with the user
-            associate_pdf_with_user(user_id, pdf_db_id)
-            
             # Send total page count to frontend
-            yield json.dumps({
+            yield encode_message({
                 'type': 'info',
                 'total_pages': page_count,
                 'pdf_name': pdf_id
-            }) + '\n'
+            })
 
-            for i, image in enumerate(images):
-                page_number = i + 1
-                print(f"Processing page {page_number}...")
+            explanation_prompt = f"Please explain this page in {difficulty_level}, including any formulas or mathematical expressions. Make sure to explain them in a way that would be easy to read aloud. Give a '.' after a long pause and a ';' after a medium pause based on the importance of the words. Preserve all formatting, including paragraph breaks. Also dont use any sub scripting symbols or special characters, instead read it aloud. Dont repeat content from the previous page and useless information in the header and footer."
+            
+            # With a context cache the whole PDF and the instructions are sent
+            # once, and each request only names the pages to explain
+            explain_model = None
+            cache = create_pdf_context_cache(temp_pdf_path, pdf_id, explanation_prompt)
+            if cache:
+                set_pdf_cache_name(pdf_id, cache.name)
+                explain_model = genai.GenerativeModel.from_cached_content(
+                    cached_content=cache,
+                    generation_config=json_generation_config,
+                    safety_settings=safety_settings
+                )
+
+            def explain_batch(batch):
+                """Explain several pages with a single Gemini request.
                 
-                # Calculate progress based on the current page
-                # Map progress from 30-95% (upload was 0-30%, final processing will be 95-100%)
-                progress_percentage = 30 + int((page_number - 1) * 65 / page_count)
+                batch is a list of (page_number, jpeg_bytes) tuples. Returns a dict
+                of page_number -> explanation for the pages the answer covered.
+                """
+                page_list = ', '.join(str(page_number) for page_number, _ in batch)
+                answer_format = f"Return a JSON object whose keys are the page numbers ({page_list}) and whose values are the explanation of that page."
                 
-                # Send progress update
-                yield json.dumps({
-                    'type': 'progress',
-                    'progress': progress_percentage,
-                    'page': page_number,
-                    'total_pages': page_count
-                }) + '\n'
+                if cache:
+                    response = explain_model.generate_content(
+                        contents=[f"Explain pages {page_list} of the document. {answer_format}"]
+                    )
+                    answer = response.text
+                else:
+                    contents = [f"{explanation_prompt}\n\nDo this separately for each of the following pages. {answer_format}"]
+                    for page_number, jpeg_bytes in batch:
+                        contents.extend([f"Page {page_number}:", jpeg_part(jpeg_bytes)])
+                    answer = generate_text_cached(contents, gen_model=json_model, config=json_generation_config)
                 
-                # Save image temporarily for processing
-                img_filename = f"page_{page_number}.jpg"
-                temp_img_path = os.path.join(temp_folder, img_filename)
-                image.save(temp_img_path, 'JPEG')
-                print(f"Image temporarily saved to {temp_img_path}")
-
-                # Upload image to GCS
-                gcs_img_path = f"{GCS_IMAGE_PREFIX}{pdf_id}/page_{page_number}.jpg"
                 try:
-                    upload_from_filename(temp_img_path, gcs_img_path, content_type='image/jpeg')
-                    print(f"Image uploaded to GCS: {gcs_img_path}")
-                except Exception as e:
-                    print(f"Error uploading image to GCS: {str(e)}")
-                    traceback.print_exc()
+                    parsed = orjson.loads(answer)
+                except orjson.JSONDecodeError:
+                    logger.debug("Could not parse batched explanation for pages %s", page_list)
+                    return {}
+                
+                if not isinstance(parsed, dict):
+                    return {}
+                return {
+                    int(key): value for key, value in parsed.items()
+                    if str(key).isdigit() and isinstance(value, str)
+                }
+
+            # Rendering, explaining and speaking run as a three-stage pipeline:
+            # pages are rendered while Gemini explains the previous batch and
+            # TTS speaks the pages before that. The bounded queues keep only a
+            # few pages in memory at a time.
+            render_queue = queue.Queue(maxsize=2 * EXPLAIN_BATCH_SIZE)
+            speech_queue = queue.Queue(maxsize=2 * EXPLAIN_BATCH_SIZE)
+            output_queue = queue.Queue(maxsize=2 * EXPLAIN_BATCH_SIZE)
+            # Set when the client disconnects, so the stages stop early
+            stop = threading.Event()
+
+            def put(q, item):
+                """Queue an item, giving up if the pipeline was stopped"""
+                while not stop.is_set():
+                    try:
+                        q.put(item, timeout=1)
+                        return True
+                    except queue.Full:
+                        pass
+                return False
+
+            def take(q):
+                """Take the next item, or None at the end of the stream"""
+                while not stop.is_set():
+                    try:
+                        return q.get(timeout=1)
+                    except queue.Empty:
+                        pass
+                return None
+
+            # Page images, explanations and audio are uploaded to GCS beside the
+            # pipeline, so no stage waits on a PUT
+            uploads = []
 
-                # Convert image to base64 for sending to frontend
-                buffered = BytesIO()
-                image.save(buffered, format="JPEG")
-                img_str = base64.b64encode(buffered.getvalue()).decode()
+            def upload_later(content, gcs_path, content_type):
+                uploads.append(io_pool.submit(upload_file, content, gcs_path, content_type=content_type))
 
-                # Get AI explanation
-                print(f"Getting AI explanation for page {page_number}...")
+            def rendered_pages():
+                """Yield (page_number, jpeg_bytes) for every page, in order"""
+                pool = get_render_pool() if page_count >= PARALLEL_RENDER_MIN_PAGES else None
+                if pool is None:
+                    # Render the page straight into memory (no temp image file)
+                    for i in range(page_count):
+                        yield i + 1, render_page(doc[i], RENDER_DPI)
+                    return
+                
+                # Long PDFs are split into page ranges rendered by separate processes
+                ranges = [
+                    (first, min(first + RENDER_CHUNK_PAGES - 1, page_count))
+                    for first in range(1, page_count + 1, RENDER_CHUNK_PAGES)
+                ]
+                futures = [
+                    pool.submit(render_page_range, temp_pdf_path, first, last, RENDER_DPI)
+                    for first, last in ranges
+                ]
                 try:
-                    response = model.generate_content(
-                        contents=[
-                            f"Please explain this page in {difficulty_level}, including any formulas or mathematical expressions. Make sure to explain them in a way that would be easy to read aloud. Give a '.' after a long pause and a ';' after a medium pause based on the importance of the words. Preserve all formatting, including paragraph breaks. Also dont use any sub scripting symbols or special characters, instead read it aloud. Dont repeat content from the previous page and useless information in the header and footer.",
-                            image
-                        ]
-                    )
-                    
-                    explanation = response.text
-                    print(f"AI explanation received for page {page_number}")
-                    
-                    # Save explanation as Markdown file
-                    text_path = os.path.join(temp_folder, f"{pdf_id}_page_{page_number}.md")
-                    with open(text_path, 'w') as f:
-                        f.write(explanation)
-                    
-                    # Upload explanation to GCS
-                    gcs_text_path = f"{GCS_TEXT_PREFIX}{pdf_id}/page_{page_number}.md"
-                    print(f"Explanation content type: {type(explanation).__name__}, length: {len(explanation)}")
-                    upload_file(explanation, gcs_text_path, content_type='text/markdown')
-                    print(f"Explanation uploaded to GCS: {gcs_text_path}")
-                    
-                except Exception as e:
-                    print(f"Error generating explanation for page {page_number}: {str(e)}")
-                    explanation = f"Failed to generate explanation for page {page_number}: {str(e)}"
-                    
-                    # Save error message
-                    text_path = os.path.join(temp_folder, f"{pdf_id}_page_{page_number}.md")
-                    with open(text_path, 'w') as f:
-                        f.write(explanation)
+                    for (first, _), future in zip(ranges, futures):
+                        yield from enumerate(future.result(), start=first)
+                finally:
+                    for future in futures:
+                        future.cancel()
 
-                # Generate audio using Google Text-to-Speech API (REST API with API key)
-                print(f"Generating audio for page {page_number}...")
+            def render_stage():
                 try:
-                    # Use the Google Cloud Text-to-Speech REST API directly with API key
-                    tts_url = f"https://texttospeech.googleapis.com/v1/text:synthesize?key={GOOGLE_API_KEY}"
-                    
-                    # Remove special markdown characters for speech but keep for display
-                    speech_text = re.sub(r'\*\*(.*?)\*\*', r'\1', explanation)
-                    speech_text = speech_text.replace("*", "")
-                    
-                    # Ensure the text is not empty
-                    if not speech_text.strip():
-                        speech_text = f"Page {page_number} content could not be processed properly."
-                    
-                    # If speech text is too long, truncate it to avoid API limits
-                    if len(speech_text) > 5000:
-                        print(f"Warning: Speech text is very long ({len(speech_text)} chars), truncating...")
-                        speech_text = speech_text[:5000] + "... The rest of the content has been truncated for processing."
-                    
-                    payload = {
-                        "input": {
-                            "text": speech_text
-                        },
-                        "voice": {
-                            "languageCode": "en-IN",
-                            "name": "en-IN-Chirp3-HD-Achernar", 
-                            "ssmlGender": "NEUTRAL"
-                        },
-                        "audioConfig": {
-                            "audioEncoding": "MP3",
-                            "effectsProfileId": [
-                                "large-automotive-class-device"
-                            ],
-                            "speakingRate": 1
+                    for page_number, jpeg_bytes in rendered_pages():
+                        logger.debug("Processing page %s...", page_number)
+                        
+                        # Calculate progress based on the current page
+                        # Map progress from 30-95% (upload was 0-30%, final processing will be 95-100%)
+                        progress_percentage = 30 + int((page_number - 1) * 65 / page_count)
+                        
+                        # Send progress update
+                        put(output_queue, encode_message({
+                            'type': 'progress',
+                            'progress': progress_percentage,
+                            'page': page_number,
+                            'total_pages': page_count
+                        }))
+                        
+                        logger.debug("Rendered page %s: %s bytes", page_number, len(jpeg_bytes))
+
+                        # Upload image to GCS
+                        upload_later(jpeg_bytes, f"{GCS_IMAGE_PREFIX}{pdf_id}/page_{page_number}.jpg", 'image/jpeg')
+                        
+                        if not put(render_queue, (page_number, jpeg_bytes)):
+                            return
+                finally:
+                    put(render_queue, None)
+
+            def explain_stage():
+                try:
+                    finished = False
+                    while not finished:
+                        # Collect the next batch of rendered pages
+                        batch = []
+                        while len(batch) < EXPLAIN_BATCH_SIZE:
+                            item = take(render_queue)
+                            if item is None:
+                                finished = True
+                                break
+                            batch.append(item)
+                        if not batch:
+                            break
+                        
+                        # A page that renders to exactly the same image as one explained
+                        # before (e.g. the same page in another edition of a book) reuses
+                        # the stored explanation
+                        page_keys = {
+                            page_number: page_explanation_key(model.model_name, explanation_prompt, jpeg_bytes)
+                            for page_number, jpeg_bytes in batch
+                        }
+                        stored = io_pool.map(lambda key: get_cached_response('page', key), page_keys.values())
+                        reused = {
+                            page_number: text.decode('utf-8')
+                            for page_number, text in zip(page_keys, stored) if text
                         }
-                    }
-                    
-                    print(f"Sending TTS request for page {page_number}...")
-                    tts_response = requests.post(tts_url, json=payload)
-                    tts_response.raise_for_status()  # Will raise an exception for 4XX/5XX responses
-                    
-                    # Log the response
-                    print(f"TTS response status: {tts_response.status_code}")
-                    if tts_response.status_code != 200:
-                        print(f"TTS error response: {tts_response.text}")
-                    
-                    # Extract audio content from response
-                    response_json = tts_response.json()
-                    if "audioContent" not in response_json:
-                        print(f"Error: No audioContent in TTS response. Response: {response_json}")
-                        raise Exception("No audioContent in TTS response")
                         
-                    audio_data = base64.b64decode(response_json["audioContent"])
-                    
-                    # Check if audio data is valid
-                    if len(audio_data) == 0:
-                        print(f"Error: Empty audio data returned from TTS API")
-                        raise Exception("Empty audio data returned from TTS API")
+                        # Get AI explanations for the rest of the batch in one request
+                        explanations = {}
+                        missing = [(page_number, jpeg_bytes) for page_number, jpeg_bytes in batch if page_number not in reused]
+                        if missing:
+                            first_page, last_page = missing[0][0], missing[-1][0]
+                            logger.debug("Getting AI explanations for pages %s-%s...", first_page, last_page)
+                            try:
+                                explanations = explain_batch(missing)
+                            except Exception as e:
+                                logger.exception("Error generating explanations for pages %s-%s: %s", first_page, last_page, e)
+
+                        for page_number, jpeg_bytes in batch:
+                            try:
+                                explanation = reused.get(page_number) or explanations.get(page_number)
+                                if not explanation:
+                                    # The batched answer skipped this page - ask for it on its own
+                                    logger.debug("Requesting explanation for page %s separately", page_number)
+                                    explanation = explain_batch([(page_number, jpeg_bytes)]).get(page_number)
+                                if not explanation:
+                                    raise Exception("No explanation returned")
+                                logger.debug("AI explanation received for page %s", page_number)
+                                
+                                # Upload explanation to GCS
+                                gcs_text_path = f"{GCS_TEXT_PREFIX}{pdf_id}/page_{page_number}.md"
+                                logger.debug("Explanation content type: %s, length: %s", type(explanation).__name__, len(explanation))
+                                upload_later(explanation, gcs_text_path, 'text/markdown')
+                                if page_number not in reused:
+                                    uploads.append(io_pool.submit(store_cached_response, 'page', page_keys[page_number], explanation, content_type='text/plain'))
+                                
+                            except Exception as e:
+                                logger.error("Error generating explanation for page %s: %s", page_number, e)
+                                explanation = f"Failed to generate explanation for page {page_number}: {str(e)}"
+
+                            if not put(speech_queue, (page_number, jpeg_bytes, explanation)):
+                                return
+                finally:
+                    put(speech_queue, None)
+
+            def speak_page(page_number, jpeg_bytes, explanation):
+                """Synthesize and store one page's audio; returns the page message for the client"""
+                # Generate audio using Google Text-to-Speech API (REST API with API key)
+                logger.debug("Generating audio for page %s...", page_number)
+                try:
+                    audio_data = synthesize_speech(explanation, page_number)
                     
-                    print(f"Received audio data: {len(audio_data)} bytes")
+                    logger.debug("Received audio data: %s bytes", len(audio_data))
                     
                     # Make sure the audio directory exists
                     audio_dir = os.path.join(temp_folder, 'audio_files')
@@ -1577,66 +2047,103 @@ def process_pdf():
                     local_audio_path = os.path.join(audio_dir, f"{pdf_id}_page_{page_number}.mp3")
                     with open(local_audio_path, 'wb') as f:
                         f.write(audio_data)
-                    print(f"Audio saved locally to {local_audio_path}, size: {len(audio_data)} bytes")
+                    logger.debug("Audio saved locally to %s, size: %s bytes", local_audio_path, len(audio_data))
                     
                     # Upload audio to GCS
-                    gcs_audio_path = f"{GCS_AUDIO_PREFIX}{pdf_id}/page_{page_number}.mp3"
-                    try:
-                        upload_file(audio_data, gcs_audio_path, content_type='audio/mpeg')
-                        print(f"Audio uploaded to GCS: {gcs_audio_path}")
-                    except Exception as e:
-                        print(f"Error uploading audio to GCS: {str(e)}")
-                        traceback.print_exc()
+                    upload_later(audio_data, f"{GCS_AUDIO_PREFIX}{pdf_id}/page_{page_number}.mp3", 'audio/mpeg')
                     
                 except Exception as e:
-                    print(f"Error generating audio: {str(e)}")
-                    traceback.print_exc()
+                    logger.exception("Error generating audio: %s", e)
                     # Return a dummy audio string in case of error
                     audio_data = b""
 
-                # Convert audio to base64 for sending to frontend
-                audio_str = base64.b64encode(audio_data).decode()
-
-                # Send this page's result to frontend immediately
-                yield json.dumps({
-                    'type': 'page',
-                    'page_data': {
-                        'page_number': page_number,
-                        'image': img_str,
-                        'explanation': explanation,
-                        'audio': audio_str,
-                        'audio_url': f"/pdf/{pdf_id}/audio/{page_number}",
-                        'image_url': f"/pdf/{pdf_id}/image/{page_number}"
-                    }
-                }) + '\n'
+                page_data = {
+                    'page_number': page_number,
+                    'explanation': explanation,
+                    'audio_url': f"/pdf/{pdf_id}/audio/{page_number}",
+                    'image_url': f"/pdf/{pdf_id}/image/{page_number}"
+                }
+                if inline_media and use_msgpack:
+                    page_data['image'] = jpeg_bytes
+                    page_data['audio'] = audio_data
+                elif inline_media:
+                    page_data['image'] = pybase64.b64encode(jpeg_bytes).decode()
+                    page_data['audio'] = pybase64.b64encode(audio_data).decode()
+                return encode_message({'type': 'page', 'page_data': page_data})
 
-            # Clean up temporary files
-            try:
-                shutil.rmtree(temp_folder)
-                os.remove(temp_pdf_path)
-                print(f"Temporary files cleaned up")
-            except Exception as e:
-                print(f"Error cleaning up temporary files: {str(e)}")
-                traceback.print_exc()
+            def speech_stage():
+                # Several pages are spoken at once; their messages are still
+                # sent to the client in page order
+                try:
+                    with ThreadPoolExecutor(max_workers=SPEECH_PAGE_WORKERS) as speakers:
+                        pending = deque()
+                        while (item := take(speech_queue)) is not None:
+                            pending.append(speakers.submit(speak_page, *item))
+                            if len(pending) >= SPEECH_PAGE_WORKERS:
+                                if not put(output_queue, pending.popleft().result()):
+                                    return
+                        while pending:
+                            if not put(output_queue, pending.popleft().result()):
+                                return
+                finally:
+                    put(output_queue, None)
 
-            # Send completion message
-            yield json.dumps({
-                'type': 'complete',
-                'message': 'All pages processed successfully',
-                'pdf_name': pdf_id
-            }) + '\n'
+            with ThreadPoolExecutor(max_workers=3) as pipeline:
+                stages = [
+                    pipeline.submit(render_stage),
+                    pipeline.submit(explain_stage),
+                    pipeline.submit(speech_stage)
+                ]
+                try:
+                    finished = False
+                    while not finished:
+                        # Write the next message together with any others that are
+                        # already queued (e.g. a page and the next progress update),
+                        # so they go out in one chunk instead of one write each
+                        messages = [output_queue.get()]
+                        while messages[-1] is not None:
+                            try:
+                                messages.append(output_queue.get_nowait())
+                            except queue.Empty:
+                                break
+                        if messages[-1] is None:
+                            finished = True
+                            messages.pop()
+                        if messages:
+                            yield b''.join(messages)
+                finally:
+                    stop.set()
+                # Re-raise anything that broke a stage
+                for stage in stages:
+                    stage.result()
+            
+            # The uploads have to land before the local copies are cleaned up
+            wait(uploads)
+
+            # Send completion message. The temporary files are removed on a
+            # background thread afterwards, so the client doesn't wait for it.
+            try:
+                yield encode_message({
+                    'type': 'complete',
+                    'message': 'All pages processed successfully',
+                    'pdf_name': pdf_id
+                })
+            finally:
+                threading.Thread(target=remove_temp_files, args=(temp_folder, temp_pdf_path), daemon=True).start()
 
         except Exception as e:
-            print(f"Error processing PDF: {str(e)}")
-            traceback.print_exc()
+            logger.exception("Error processing PDF: %s", e)
             # Send error message
-            yield json.dumps({
+            yield encode_message({
                 'type': 'error',
                 'error': str(e)
-            }) + '\n'
+            })
+        finally:
+            doc.close()
 
-    # Return a streaming response
-    return Response(generate(), mimetype='text/plain')
+    # Return a streaming response; the generator already yields whole
+    # messages, so Werkzeug passes them through as they are
+    return Response(generate(), mimetype='application/x-msgpack' if use_msgpack else 'text/plain', direct_passthrough=True)
 
 # Test route for GCS connection
 @app.route('/test-gcs', methods=['GET'])
@@ -1650,7 +2157,7 @@ def test_gcs():
             }), 500
             
         bucket_name = os.getenv('GCS_BUCKET_NAME', 'studybuddy-pdf-storage')
-        bucket = client.bucket(bucket_name)
+        bucket = get_bucket(bucket_name)
         
         # Test if we can list blobs in the bucket
         blobs = list(bucket.list_blobs(max_results=5))
@@ -1659,7 +2166,8 @@ def test_gcs():
             'success': True,
             'message': 'Successfully connected to GCS bucket',
             'bucket_name': bucket_name,
-            'files_sample': [blob.name for blob in blobs][:5]
+            'files_sample': [blob.name for blob in blobs][:5],
+            'exists_cache': dict(exists_cache_stats)
         })
         
     except Exception as e:
@@ -1,20 +1,25 @@
-from flask import Flask, request, jsonify, Response, send_file
+from flask import Flask, request, jsonify, Response, send_file, send_from_directory, stream_with_context
+from werkzeug.exceptions import NotFound
+from werkzeug.utils import safe_join
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-from pdf2image import convert_from_path
+import fitz
 import os
-from PIL import Image
 from google import genai
+from google.genai import types
 from elevenlabs.client import ElevenLabs
-import base64
-from io import BytesIO
 import time
-import traceback
-import json
+import logging
+import logging.handlers
+import queue
+import atexit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 from dotenv import load_dotenv
 import shutil
 import re
-import zipfile
-import io
+from zipstream import ZipStream, ZIP_STORED, ZIP_DEFLATED
 
 # # Configure API keys
 ELEVENLABS_API_KEY = os.getenv('ELEVENLABS_API_KEY')
@@ -25,12 +30,42 @@ eleven_client = ElevenLabs(api_key=ELEVENLABS_API_KEY)
 
 load_dotenv()
 
+# Same setup as app.py: debug output locally, warnings and errors only in
+# production, and records written out by a listener thread
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'WARNING' if os.getenv('FLASK_ENV') == 'production' else 'DEBUG'),
+    handlers=[queue_handler]
+)
+log_listener.start()
+atexit.register(log_listener.stop)
+logger = logging.getLogger(__name__)
+
+class ORJSONProvider(JSONProvider):
+    """Flask JSON provider backed by orjson (jsonify, request.json)"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+# Behind a proxy that understands X-Sendfile, let it serve local media files.
+# Otherwise send_file hands the open file to the server's wsgi.file_wrapper,
+# which gunicorn serves with sendfile(2).
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', 'false').lower() == 'true'
 CORS(app)
 
 # Configure API keys
 GOOGLE_API_KEY = os.getenv('GEMINI_API_KEY')
-print(f"Google API Key: {GOOGLE_API_KEY[:10]}...")
+logger.debug("Google API Key: %s...", GOOGLE_API_KEY[:10])
 
 # Configure Google Generative AI
 genai_client = genai.Client(api_key=GOOGLE_API_KEY)
@@ -40,48 +75,125 @@ UPLOAD_FOLDER = 'uploads'
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# Rasterization DPI for uploaded PDFs
+RENDER_DPI = int(os.getenv('RENDER_DPI', '110'))
+
+# Gemini + ElevenLabs work for uploaded pages runs on this shared pool; its
+# size also caps how many ElevenLabs requests are in flight at once
+PAGE_WORKERS = int(os.getenv('PAGE_WORKERS', '4'))
+page_pool = ThreadPoolExecutor(max_workers=PAGE_WORKERS, thread_name_prefix='page')
+atexit.register(page_pool.shutdown, wait=False)
+
+# Page images/audio are only ever fetched by URL, so let browsers keep them
+PAGE_MEDIA_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def send_page_media(path, mimetype):
+    """Send a page file given its path under UPLOAD_FOLDER; raises NotFound if it is missing."""
+    # send_from_directory refuses paths that escape UPLOAD_FOLDER, and
+    # conditional lets If-None-Match / If-Modified-Since / Range requests
+    # be answered without resending the file
+    response = send_from_directory(os.path.abspath(UPLOAD_FOLDER), path, mimetype=mimetype, conditional=True, etag=True)
+    response.headers['Cache-Control'] = PAGE_MEDIA_CACHE_CONTROL
+    return response
+
+# Used to turn uploaded file names into folder names
+_CLEAN_NAME_RE = re.compile(r'[^\w\-]')
+# Page files are named {pdf_name}_page_{n}.{ext}, so the page number, and
+# usually the folder they live in, can be read straight off the name
+_PAGE_NUMBER_RE = re.compile(r'_page_(\d+)\.')
+_PAGE_FILE_RE = re.compile(r'([^/]+)_page_\d+\.(?:mp3|jpg)$')
+# Separates the per-page summaries in a batched quiz summary reply
+_PAGE_MARKER_RE = re.compile(r'^\s*---PAGE (\d+)---\s*$', re.MULTILINE)
+
+def pdf_path(pdf_name, *parts):
+    """Local path of a PDF's upload folder or a file in it, or None if pdf_name would escape UPLOAD_FOLDER"""
+    return safe_join(UPLOAD_FOLDER, pdf_name, *parts)
+
+def sorted_page_files(folder, extension):
+    """Return (page_number, file name) pairs for the page files in folder, in page order."""
+    page_files = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.endswith(extension) and entry.is_file(follow_symlinks=False):
+                match = _PAGE_NUMBER_RE.search(name)
+                if match:
+                    page_files.append((int(match.group(1)), name))
+    page_files.sort()
+    return page_files
+
+def count_page_images(image_folder):
+    with os.scandir(image_folder) as entries:
+        return sum(1 for entry in entries if entry.name.endswith('.jpg') and entry.is_file(follow_symlinks=False))
+
+# /existing-pdfs listing caches. Folder names are keyed on the uploads
+# folder's mtime; each PDF's entry on its image_files mtime, which moves
+# whenever a page image is added or removed.
+_upload_folders_cache = (None, [])
+_pdf_entry_cache = {}
+
+def list_upload_folders():
+    global _upload_folders_cache
+    mtime = os.stat(UPLOAD_FOLDER).st_mtime_ns
+    cached_mtime, folders = _upload_folders_cache
+    if cached_mtime != mtime:
+        with os.scandir(UPLOAD_FOLDER) as entries:
+            folders = [entry.name for entry in entries if entry.is_dir(follow_symlinks=False)]
+        _upload_folders_cache = (mtime, folders)
+    return folders
+
+def existing_pdf_entry(folder):
+    """Return the /existing-pdfs entry for an upload folder, or None if it is incomplete."""
+    folder_path = os.path.join(UPLOAD_FOLDER, folder)
+    image_folder = os.path.join(folder_path, 'image_files')
+    try:
+        mtime = os.stat(image_folder).st_mtime_ns
+    except FileNotFoundError:
+        _pdf_entry_cache.pop(folder, None)
+        return None
+    
+    cached = _pdf_entry_cache.get(folder)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    
+    # Check if it has the required structure
+    has_text = os.path.exists(os.path.join(folder_path, 'text_files'))
+    has_audio = os.path.exists(os.path.join(folder_path, 'audio_files'))
+    entry = None
+    
+    if has_text and has_audio:
+        # Get metadata if exists
+        metadata_path = os.path.join(folder_path, 'metadata.json')
+        metadata = {}
+        if os.path.exists(metadata_path):
+            with open(metadata_path, 'rb') as f:
+                metadata = orjson.loads(f.read())
+        
+        entry = {
+            'name': folder,
+            'total_pages': count_page_images(image_folder),
+            'date_processed': metadata.get('date_processed', 'Unknown'),
+            'original_filename': metadata.get('original_filename', folder)
+        }
+    
+    _pdf_entry_cache[folder] = (mtime, entry)
+    return entry
+
 # Route to get a list of existing PDFs
 @app.route('/existing-pdfs', methods=['GET'])
 def get_existing_pdfs():
     try:
         pdfs = []
         # Check all folders in uploads directory
-        for folder in os.listdir(UPLOAD_FOLDER):
-            folder_path = os.path.join(UPLOAD_FOLDER, folder)
-            if os.path.isdir(folder_path):
-                # Check if it has the required structure
-                has_images = os.path.exists(os.path.join(folder_path, 'image_files'))
-                has_text = os.path.exists(os.path.join(folder_path, 'text_files'))
-                has_audio = os.path.exists(os.path.join(folder_path, 'audio_files'))
-                
-                if has_images and has_text and has_audio:
-                    # Get metadata if exists
-                    metadata_path = os.path.join(folder_path, 'metadata.json')
-                    metadata = {}
-                    if os.path.exists(metadata_path):
-                        with open(metadata_path, 'r') as f:
-                            metadata = json.load(f)
-                    
-                    # Count pages
-                    total_pages = 0
-                    image_folder = os.path.join(folder_path, 'image_files')
-                    if os.path.exists(image_folder):
-                        for file in os.listdir(image_folder):
-                            if file.endswith('.jpg'):
-                                total_pages += 1
-                    
-                    pdfs.append({
-                        'name': folder,
-                        'total_pages': total_pages,
-                        'date_processed': metadata.get('date_processed', 'Unknown'),
-                        'original_filename': metadata.get('original_filename', folder)
-                    })
+        for folder in list_upload_folders():
+            entry = existing_pdf_entry(folder)
+            if entry:
+                pdfs.append(entry)
         
-        print(f"Found {len(pdfs)} existing PDFs")
+        logger.debug("Found %s existing PDFs", len(pdfs))
         return jsonify({'pdfs': pdfs})
     except Exception as e:
-        print(f"Error getting existing PDFs: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error getting existing PDFs: %s", e)
         return jsonify({'error': str(e)}), 500
 
 # Route to check if a PDF exists by path
@@ -89,8 +201,8 @@ def get_existing_pdfs():
 def check_pdf_exists(pdf_name):
     try:
         # Check if the PDF folder exists
-        pdf_folder = os.path.join(UPLOAD_FOLDER, pdf_name)
-        if os.path.exists(pdf_folder) and os.path.isdir(pdf_folder):
+        pdf_folder = pdf_path(pdf_name)
+        if pdf_folder and os.path.isdir(pdf_folder):
             # Check if it has the required structure
             has_images = os.path.exists(os.path.join(pdf_folder, 'image_files'))
             has_text = os.path.exists(os.path.join(pdf_folder, 'text_files'))
@@ -101,10 +213,18 @@ def check_pdf_exists(pdf_name):
         
         return jsonify({'exists': False})
     except Exception as e:
-        print(f"Error checking if PDF exists: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error checking if PDF exists: %s", e)
         return jsonify({'error': str(e)}), 500
 
+def numbered_versions(clean_name, existing):
+    """clean_name, clean_name_2, clean_name_3, ... for as long as each one is in existing"""
+    versions = [clean_name]
+    counter = 2
+    while f"{clean_name}_{counter}" in existing:
+        versions.append(f"{clean_name}_{counter}")
+        counter += 1
+    return versions
+
 # Route to check if a PDF exists by original filename
 @app.route('/check-pdf-by-filename/<path:filename>', methods=['GET'])
 def check_pdf_exists_by_filename(filename):
@@ -116,7 +236,7 @@ def check_pdf_exists_by_filename(filename):
             filename_no_ext = filename
             
         # Clean the name (same logic as in process-pdf)
-        clean_name = re.sub(r'[^\w\-]', '_', filename_no_ext).lower()
+        clean_name = _CLEAN_NAME_RE.sub('_', filename_no_ext).lower()
         
         # Check if this base name exists
         base_path = os.path.join(UPLOAD_FOLDER, clean_name)
@@ -124,11 +244,7 @@ def check_pdf_exists_by_filename(filename):
         
         if exists:
             # Get all versions (including this one and ones with _2, _3, etc.)
-            versions = [clean_name]
-            counter = 2
-            while os.path.exists(os.path.join(UPLOAD_FOLDER, f"{clean_name}_{counter}")):
-                versions.append(f"{clean_name}_{counter}")
-                counter += 1
+            versions = numbered_versions(clean_name, set(list_upload_folders()))
                 
             return jsonify({
                 'exists': True,
@@ -138,129 +254,137 @@ def check_pdf_exists_by_filename(filename):
         
         return jsonify({'exists': False})
     except Exception as e:
-        print(f"Error checking if PDF exists by filename: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error checking if PDF exists by filename: %s", e)
         return jsonify({'error': str(e)}), 500
 
 # Use existing PDF content
 @app.route('/use-existing/<path:pdf_name>', methods=['GET'])
 def use_existing_pdf(pdf_name):
-    try:
-        print(f"Request to use existing PDF: {pdf_name}")
-        pdf_folder = os.path.join(UPLOAD_FOLDER, pdf_name)
-        
-        if not os.path.exists(pdf_folder) or not os.path.isdir(pdf_folder):
-            print(f"Error: PDF folder not found at {pdf_folder}")
-            return jsonify({'error': 'PDF not found'}), 404
-        
-        print(f"Loading PDF from {pdf_folder}")
-        
-        # Load pages
-        image_folder = os.path.join(pdf_folder, 'image_files')
-        text_folder = os.path.join(pdf_folder, 'text_files')
-        audio_folder = os.path.join(pdf_folder, 'audio_files')
-        
-        if not os.path.exists(image_folder) or not os.path.exists(text_folder) or not os.path.exists(audio_folder):
-            print(f"Error: PDF structure is incomplete. Missing folders in {pdf_folder}")
-            return jsonify({'error': 'PDF structure is incomplete'}), 400
-        
-        # Get page count
-        total_pages = 0
-        pages = []
-        
-        page_files = []
-        for file in os.listdir(image_folder):
-            if file.endswith('.jpg') and '_page_' in file:
-                page_files.append(file)
-        
-        print(f"Found {len(page_files)} page files")
-        
-        # Sort page files by page number
-        page_files.sort(key=lambda f: int(f.split('_page_')[1].split('.')[0]))
+    logger.debug("Request to use existing PDF: %s", pdf_name)
+    pdf_folder = pdf_path(pdf_name)
+    
+    if not pdf_folder or not os.path.isdir(pdf_folder):
+        logger.error("Error: PDF folder not found at %s", pdf_folder)
+        return jsonify({'error': 'PDF not found'}), 404
+    
+    logger.debug("Loading PDF from %s", pdf_folder)
+    
+    # Load pages
+    image_folder = os.path.join(pdf_folder, 'image_files')
+    text_folder = os.path.join(pdf_folder, 'text_files')
+    audio_folder = os.path.join(pdf_folder, 'audio_files')
+    
+    if not os.path.exists(image_folder) or not os.path.exists(text_folder) or not os.path.exists(audio_folder):
+        logger.error("Error: PDF structure is incomplete. Missing folders in %s", pdf_folder)
+        return jsonify({'error': 'PDF structure is incomplete'}), 400
+    
+    page_files = sorted_page_files(image_folder, '.jpg')
+    
+    logger.debug("Found %s page files", len(page_files))
+    
+    def generate():
+        # One JSON object per line: an info line first, then each page as
+        # soon as it is read, so only one page is held in memory at a time
+        total_pages = page_files[-1][0] if page_files else 0
+        yield orjson.dumps({'type': 'info', 'total_pages': total_pages, 'pdf_name': pdf_name}, option=orjson.OPT_APPEND_NEWLINE)
         
-        for page_file in page_files:
-            page_num = int(page_file.split('_page_')[1].split('.')[0])
-            total_pages = max(total_pages, page_num)
-            
-            print(f"Processing page {page_num}")
-            
-            # Get image
-            img_path = os.path.join(image_folder, page_file)
-            with open(img_path, 'rb') as img_file:
-                img_data = base64.b64encode(img_file.read()).decode()
-            
-            # Get text
-            text_path = os.path.join(text_folder, page_file.replace('.jpg', '.md'))
-            explanation = ""
-            if os.path.exists(text_path):
-                with open(text_path, 'r') as text_file:
-                    explanation = text_file.read()
-            
-            # Get audio
-            audio_path = os.path.join(audio_folder, page_file.replace('.jpg', '.mp3'))
-            audio_data = b""
-            if os.path.exists(audio_path):
-                with open(audio_path, 'rb') as audio_file:
-                    audio_data = audio_file.read()
-            
-            audio_str = base64.b64encode(audio_data).decode()
+        try:
+            for page_num, page_file in page_files:
+                logger.debug("Processing page %s", page_num)
+                
+                # Get text
+                text_path = os.path.join(text_folder, page_file.replace('.jpg', '.md'))
+                explanation = ""
+                if os.path.exists(text_path):
+                    with open(text_path, 'r') as text_file:
+                        explanation = text_file.read()
+                
+                yield orjson.dumps({
+                    'type': 'page',
+                    'page_number': page_num,
+                    'explanation': explanation,
+                    'audio_url': f"/pdf/{pdf_name}/audio/{page_num}",
+                    'image_url': f"/pdf/{pdf_name}/image/{page_num}"
+                }, option=orjson.OPT_APPEND_NEWLINE)
             
-            pages.append({
-                'page_number': page_num,
-                'image': img_data,
-                'explanation': explanation,
-                'audio': audio_str,
-                'audio_url': f"/pdf/{pdf_name}/audio/{page_num}",
-                'image_url': f"/pdf/{pdf_name}/image/{page_num}"
-            })
-        
-        print(f"Successfully loaded {len(pages)} pages for PDF {pdf_name}")
-        
-        return jsonify({
-            'total_pages': total_pages,
-            'pdf_name': pdf_name,
-            'pages': pages
-        })
-    except Exception as e:
-        print(f"Error using existing PDF: {str(e)}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+            logger.debug("Successfully loaded %s pages for PDF %s", len(page_files), pdf_name)
+            yield orjson.dumps({'type': 'complete', 'total_pages': total_pages}, option=orjson.OPT_APPEND_NEWLINE)
+        except Exception as e:
+            logger.exception("Error using existing PDF: %s", e)
+            yield orjson.dumps({'type': 'error', 'message': str(e)}, option=orjson.OPT_APPEND_NEWLINE)
+    
+    return Response(generate(), mimetype='application/x-ndjson')
 
 # Routes to serve files from the PDF structure
 @app.route('/pdf/<path:pdf_name>/audio/<int:page_num>', methods=['GET'])
 def get_pdf_audio(pdf_name, page_num):
-    audio_path = os.path.join(UPLOAD_FOLDER, pdf_name, 'audio_files', f"{pdf_name}_page_{page_num}.mp3")
-    if not os.path.exists(audio_path):
+    try:
+        return send_page_media(f"{pdf_name}/audio_files/{pdf_name}_page_{page_num}.mp3", 'audio/mpeg')
+    except NotFound:
         return jsonify({'error': 'Audio file not found'}), 404
-    return send_file(audio_path, mimetype='audio/mpeg')
 
 @app.route('/pdf/<path:pdf_name>/image/<int:page_num>', methods=['GET'])
 def get_pdf_image(pdf_name, page_num):
-    image_path = os.path.join(UPLOAD_FOLDER, pdf_name, 'image_files', f"{pdf_name}_page_{page_num}.jpg")
-    if not os.path.exists(image_path):
+    try:
+        return send_page_media(f"{pdf_name}/image_files/{pdf_name}_page_{page_num}.jpg", 'image/jpeg')
+    except NotFound:
         return jsonify({'error': 'Image file not found'}), 404
-    return send_file(image_path, mimetype='image/jpeg')
+
+_legacy_media_paths = {}
+
+def find_page_media(filename, subfolder):
+    """Locate a page file for the legacy /audio and /image routes, relative to UPLOAD_FOLDER."""
+    match = _PAGE_FILE_RE.match(filename)
+    if match:
+        path = f"{match.group(1)}/{subfolder}/{filename}"
+        if os.path.exists(os.path.join(UPLOAD_FOLDER, path)):
+            return path
+    
+    # Odd names fall back to scanning every upload; remember where they were
+    # found and only scan again if that file goes away
+    path = _legacy_media_paths.get(filename)
+    if path and os.path.exists(os.path.join(UPLOAD_FOLDER, path)):
+        return path
+    for pdf_folder in list_upload_folders():
+        path = f"{pdf_folder}/{subfolder}/{filename}"
+        if os.path.exists(os.path.join(UPLOAD_FOLDER, path)):
+            _legacy_media_paths[filename] = path
+            return path
+    return None
 
 @app.route('/audio/<path:filename>', methods=['GET'])
 def get_audio(filename):
     # This route is kept for backward compatibility
-    for pdf_folder in os.listdir(UPLOAD_FOLDER):
-        audio_path = os.path.join(UPLOAD_FOLDER, pdf_folder, 'audio_files', filename)
-        if os.path.exists(audio_path):
-            return send_file(audio_path, mimetype='audio/mpeg')
+    audio_path = find_page_media(filename, 'audio_files')
+    if audio_path:
+        return send_page_media(audio_path, 'audio/mpeg')
     
     return jsonify({'error': 'Audio file not found'}), 404
 
 @app.route('/image/<path:filename>', methods=['GET'])
 def get_image(filename):
     # This route is kept for backward compatibility
-    for pdf_folder in os.listdir(UPLOAD_FOLDER):
-        image_path = os.path.join(UPLOAD_FOLDER, pdf_folder, 'image_files', filename)
-        if os.path.exists(image_path):
-            return send_file(image_path, mimetype='image/jpeg')
+    image_path = find_page_media(filename, 'image_files')
+    if image_path:
+        return send_page_media(image_path, 'image/jpeg')
     
     return jsonify({'error': 'Image file not found'}), 404
 
+def stream_answer(prompt):
+    """Yield an answer to the question prompt as Server-Sent Events"""
+    def event(payload, name=None):
+        prefix = f"event: {name}\n" if name else ""
+        return f"{prefix}data: {orjson.dumps(payload).decode()}\n\n"
+    
+    try:
+        for chunk in genai_client.models.generate_content_stream(model="gemini-1.5-pro", contents=[prompt]):
+            if chunk.text:
+                yield event({'text': chunk.text})
+        yield event({}, name='done')
+    except Exception as e:
+        logger.exception("Error answering question: %s", e)
+        yield event({'error': str(e)}, name='error')
+
 @app.route('/ask-question', methods=['POST'])
 def ask_question():
     try:
@@ -270,12 +394,7 @@ def ask_question():
         
         question = data['question']
         context = data['context']
-        
-        # Use Gemini to answer the question based on the context
-        response = genai_client.models.generate_content(
-            model="gemini-1.5-pro",
-            contents=[
-                f"""
+        prompt = f"""
                 Context: {context}
                 
                 Question: {question}
@@ -283,7 +402,16 @@ def ask_question():
                 Answer the question based only on the provided context. If the answer is not in the context, 
                 say 'I don't have enough information to answer this question based on the provided content.'
                 """
-            ]
+        
+        # Clients that accept Server-Sent Events get the answer as it is
+        # generated instead of waiting for all of it
+        if 'text/event-stream' in request.headers.get('Accept', ''):
+            return Response(stream_with_context(stream_answer(prompt)), mimetype='text/event-stream')
+        
+        # Use Gemini to answer the question based on the context
+        response = genai_client.models.generate_content(
+            model="gemini-1.5-pro",
+            contents=[prompt]
         )
         
         return jsonify({
@@ -291,15 +419,62 @@ def ask_question():
         })
     
     except Exception as e:
-        print(f"Error answering question: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error answering question: %s", e)
         return jsonify({'error': str(e)}), 500
 
+# Pages per Gemini call when summarizing page images for a quiz
+SUMMARY_BATCH_PAGES = 16
+
+def summarize_page_images(image_paths):
+    """Summarize page images for quiz generation in one Gemini call.
+    
+    Falls back to one call per page if the reply doesn't have a summary
+    for every page.
+    """
+    pages = []
+    for image_path in image_paths:
+        with open(image_path, 'rb') as img_file:
+            pages.append(types.Part.from_bytes(data=img_file.read(), mime_type='image/jpeg'))
+    
+    if len(pages) > 1:
+        try:
+            response = genai_client.models.generate_content(
+                model="gemini-1.5-pro",
+                contents=[
+                    f"Provide a brief summary of the key concepts on each of the following {len(pages)} pages that would be useful for quiz generation. Start each page's summary with a line containing only ---PAGE n---, numbering the pages from 1 in the order given.",
+                    *pages
+                ]
+            )
+            # split() gives [preamble, number, summary, number, summary, ...]
+            parts = _PAGE_MARKER_RE.split(response.text)
+            summaries = [summary.strip() for summary in parts[2::2]]
+            if len(summaries) == len(pages):
+                return summaries
+            logger.warning("Batched summary returned %s of %s pages, summarizing one at a time", len(summaries), len(pages))
+        except Exception as e:
+            logger.error("Error getting batched summary: %s", e)
+    
+    summaries = []
+    for image_path, page in zip(image_paths, pages):
+        try:
+            # Get a brief summary of the page for quiz generation
+            response = genai_client.models.generate_content(
+                model="gemini-1.5-pro",
+                contents=[
+                    "Provide a brief summary of the key concepts on this page that would be useful for quiz generation.",
+                    page
+                ]
+            )
+            summaries.append(response.text)
+        except Exception as e:
+            logger.error("Error getting summary for page %s: %s", os.path.basename(image_path), e)
+    return summaries
+
 @app.route('/generate-quiz/<path:pdf_name>', methods=['POST'])
 def generate_quiz(pdf_name):
     try:
-        pdf_folder = os.path.join(UPLOAD_FOLDER, pdf_name)
-        if not os.path.exists(pdf_folder):
+        pdf_folder = pdf_path(pdf_name)
+        if not pdf_folder or not os.path.exists(pdf_folder):
             return jsonify({'error': 'PDF folder not found'}), 404
             
         # Create quiz folder if it doesn't exist
@@ -311,10 +486,8 @@ def generate_quiz(pdf_name):
         quiz_path = os.path.join(quiz_folder, f"{pdf_name}_quiz.json")
         
         if os.path.exists(quiz_path):
-            # Return existing quiz
-            with open(quiz_path, 'r') as f:
-                quiz_data = json.load(f)
-            return jsonify(quiz_data)
+            # Return existing quiz; it was stored as JSON, so send it as is
+            return send_file(quiz_path, mimetype='application/json', conditional=True)
         
         # Collect all explanations for the PDF
         text_folder = os.path.join(pdf_folder, 'text_files')
@@ -323,37 +496,19 @@ def generate_quiz(pdf_name):
         
         # Try using text files first
         if os.path.exists(text_folder):
-            text_files = sorted([f for f in os.listdir(text_folder) if f.endswith('.md')],
-                               key=lambda f: int(f.split('_page_')[1].split('.')[0]))
-            
-            for text_file in text_files:
+            for _, text_file in sorted_page_files(text_folder, '.md'):
                 with open(os.path.join(text_folder, text_file), 'r') as f:
                     all_explanations.append(f.read())
         
-        # If no text files, use images to regenerate summaries
+        # If no text files, use images to regenerate summaries, several pages
+        # per Gemini call and the calls themselves in parallel
         if not all_explanations and os.path.exists(image_folder):
-            image_files = sorted([f for f in os.listdir(image_folder) if f.endswith('.jpg')],
-                                key=lambda f: int(f.split('_page_')[1].split('.')[0]))
-            
-            for image_file in image_files:
-                try:
-                    with open(os.path.join(image_folder, image_file), 'rb') as img_file:
-                        image_data = img_file.read()
-                    
-                    image = Image.open(BytesIO(image_data))
-                    
-                    # Get a brief summary of the page for quiz generation
-                    response = genai_client.models.generate_content(
-                        model="gemini-1.5-pro",
-                        contents=[
-                            "Provide a brief summary of the key concepts on this page that would be useful for quiz generation.",
-                            image
-                        ]
-                    )
-                    
-                    all_explanations.append(response.text)
-                except Exception as e:
-                    print(f"Error getting summary for page {image_file}: {str(e)}")
+            image_paths = [os.path.join(image_folder, image_file)
+                           for _, image_file in sorted_page_files(image_folder, '.jpg')]
+            batches = [image_paths[i:i + SUMMARY_BATCH_PAGES]
+                       for i in range(0, len(image_paths), SUMMARY_BATCH_PAGES)]
+            for summaries in page_pool.map(summarize_page_images, batches):
+                all_explanations.extend(summaries)
         
         if not all_explanations:
             return jsonify({'error': 'No content found to generate quiz'}), 404
@@ -398,74 +553,73 @@ def generate_quiz(pdf_name):
             elif "```" in quiz_text:
                 quiz_text = quiz_text.split("```")[1].split("```")[0].strip()
             
-            quiz_data = json.loads(quiz_text)
+            quiz_bytes = orjson.dumps(orjson.loads(quiz_text))
             
             # Save quiz to file
-            with open(quiz_path, 'w') as f:
-                json.dump(quiz_data, f)
+            with open(quiz_path, 'wb') as f:
+                f.write(quiz_bytes)
             
-            return jsonify(quiz_data)
+            return Response(quiz_bytes, mimetype='application/json')
         
-        except json.JSONDecodeError as e:
-            print(f"Error parsing quiz JSON: {str(e)}")
-            print(f"Raw quiz text: {quiz_text}")
+        except orjson.JSONDecodeError as e:
+            logger.error("Error parsing quiz JSON: %s", e)
+            logger.debug("Raw quiz text: %s", quiz_text)
             return jsonify({'error': 'Failed to generate valid quiz format'}), 500
         
     except Exception as e:
-        print(f"Error generating quiz: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error generating quiz: %s", e)
         return jsonify({'error': str(e)}), 500
 
+# Text members are the only ones that shrink; level 1 gets most of the
+# ratio for a fraction of the CPU
+ZIP_DEFLATE_SUFFIXES = ('.md', '.json')
+
+def zip_member_options(name):
+    if name.endswith(ZIP_DEFLATE_SUFFIXES):
+        return {'compress_type': ZIP_DEFLATED, 'compress_level': 1}
+    return {}
+
 @app.route('/download-materials/<path:pdf_name>', methods=['GET'])
 def download_materials(pdf_name):
     try:
-        pdf_folder = os.path.join(UPLOAD_FOLDER, pdf_name)
-        if not os.path.exists(pdf_folder):
+        pdf_folder = pdf_path(pdf_name)
+        if not pdf_folder or not os.path.exists(pdf_folder):
             return jsonify({'error': 'PDF folder not found'}), 404
             
-        # Create in-memory zip file
-        memory_file = io.BytesIO()
-        with zipfile.ZipFile(memory_file, 'w') as zf:
-            # Add all related files
-            for folder_name in ['audio_files', 'image_files', 'text_files']:
-                folder_path = os.path.join(pdf_folder, folder_name)
-                if os.path.exists(folder_path):
-                    for file in os.listdir(folder_path):
-                        file_path = os.path.join(folder_path, file)
-                        if os.path.isfile(file_path):
-                            zf.write(file_path, f"{folder_name}/{file}")
-            
-            # Add quiz if it exists
-            quiz_folder = os.path.join(pdf_folder, 'quiz_data')
-            if os.path.exists(quiz_folder):
-                for file in os.listdir(quiz_folder):
-                    file_path = os.path.join(quiz_folder, file)
-                    if os.path.isfile(file_path):
-                        zf.write(file_path, f"quiz_data/{file}")
-            
-            # Add original PDF file if it exists
-            original_pdf_path = os.path.join(pdf_folder, 'original.pdf')
-            if os.path.exists(original_pdf_path):
-                zf.write(original_pdf_path, f"{pdf_name}.pdf")
-            
-            # Add metadata file if it exists
-            metadata_path = os.path.join(pdf_folder, 'metadata.json')
-            if os.path.exists(metadata_path):
-                zf.write(metadata_path, "metadata.json")
+        # Stream the zip as it is written instead of building it in memory.
+        # JPEG/MP3 (and the PDF's own streams) are already compressed, so
+        # they are stored; only the text members are deflated.
+        zf = ZipStream(compress_type=ZIP_STORED)
+        
+        # Add all related files, and the quiz if it exists
+        for folder_name in ['audio_files', 'image_files', 'text_files', 'quiz_data']:
+            folder_path = os.path.join(pdf_folder, folder_name)
+            if os.path.exists(folder_path):
+                with os.scandir(folder_path) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            zf.add_path(entry.path, f"{folder_name}/{entry.name}", **zip_member_options(entry.name))
+        
+        # Add original PDF file if it exists
+        original_pdf_path = os.path.join(pdf_folder, 'original.pdf')
+        if os.path.exists(original_pdf_path):
+            zf.add_path(original_pdf_path, f"{pdf_name}.pdf")
         
-        # Seek to the beginning of the stream
-        memory_file.seek(0)
+        # Add metadata file if it exists
+        metadata_path = os.path.join(pdf_folder, 'metadata.json')
+        if os.path.exists(metadata_path):
+            zf.add_path(metadata_path, "metadata.json", **zip_member_options(metadata_path))
         
-        return send_file(
-            memory_file,
+        return Response(
+            zf,
             mimetype='application/zip',
-            as_attachment=True,
-            download_name=f"{pdf_name}_study_materials.zip"
+            headers={
+                'Content-Disposition': f'attachment; filename="{pdf_name}_study_materials.zip"'
+            }
         )
     
     except Exception as e:
-        print(f"Error creating zip file: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error creating zip file: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/process-pdf', methods=['POST'])
@@ -482,22 +636,20 @@ def process_pdf():
     
     # Get the difficulty level from the form data, default to "detailed" if not provided
     difficulty_level = request.form.get('difficulty_level', 'detailed')
-    print(f"Processing PDF with difficulty level: {difficulty_level}")
+    logger.debug("Processing PDF with difficulty level: %s", difficulty_level)
 
     # Get PDF name without extension for saving files
     original_pdf_name = os.path.splitext(os.path.basename(file.filename))[0]
     
     # Clean the PDF name (replace spaces with underscores, remove special characters)
-    pdf_name = re.sub(r'[^\w\-]', '_', original_pdf_name).lower()
+    pdf_name = _CLEAN_NAME_RE.sub('_', original_pdf_name).lower()
     
     # Check if this PDF has already been processed
     existing_pdf_path = os.path.join(UPLOAD_FOLDER, pdf_name)
     if os.path.exists(existing_pdf_path):
-        # Find a new unique name by appending a number
-        counter = 2
-        while os.path.exists(os.path.join(UPLOAD_FOLDER, f"{pdf_name}_{counter}")):
-            counter += 1
-        pdf_name = f"{pdf_name}_{counter}"
+        # Find a new unique name by appending the next free number
+        versions = numbered_versions(pdf_name, set(list_upload_folders()))
+        pdf_name = f"{pdf_name}_{len(versions) + 1}"
     
     # Create the PDF folder and subfolders
     pdf_folder = os.path.join(UPLOAD_FOLDER, pdf_name)
@@ -516,125 +668,133 @@ def process_pdf():
         'date_processed': time.strftime('%Y-%m-%d %H:%M:%S'),
         'original_filename': file.filename
     }
-    with open(os.path.join(pdf_folder, 'metadata.json'), 'w') as f:
-        json.dump(metadata, f)
+    with open(os.path.join(pdf_folder, 'metadata.json'), 'wb') as f:
+        f.write(orjson.dumps(metadata))
 
     # Save the PDF temporarily
     temp_pdf_path = os.path.join(pdf_folder, 'original.pdf')
     file.save(temp_pdf_path)
-    print(f"PDF saved to {temp_pdf_path}")
+    logger.debug("PDF saved to %s", temp_pdf_path)
+
+    def explain_and_speak(page_number, jpeg_bytes):
+        """Run the Gemini explanation and ElevenLabs audio for one page; returns its stream message."""
+        # Get AI explanation
+        logger.debug("Getting AI explanation for page %s...", page_number)
+        try:
+            response = genai_client.models.generate_content(
+                model="gemini-1.5-pro",
+                contents=[
+                    f"Please explain this page in {difficulty_level}, including any formulas or mathematical expressions. Make sure to explain them in a way that would be easy to read aloud. Preserve all formatting, including paragraph breaks.",
+                    # The JPEG already written to disk; a PIL image would be
+                    # re-encoded as PNG by the client
+                    types.Part.from_bytes(data=jpeg_bytes, mime_type='image/jpeg')
+                ]
+            )
+            
+            explanation = response.text
+            logger.debug("AI explanation received for page %s", page_number)
+            
+            # Save the explanation as markdown
+            text_path = os.path.join(text_folder, f"{pdf_name}_page_{page_number}.md")
+            with open(text_path, 'w') as f:
+                f.write(explanation)
+            logger.debug("Explanation saved to %s", text_path)
+            
+        except Exception as e:
+            logger.exception("Error getting AI explanation: %s", e)
+            explanation = f"Error analyzing page {page_number}: {str(e)}"
+
+        # Generate audio using ElevenLabs
+        logger.debug("Generating audio for page %s...", page_number)
+        try:
+            # Use the correct API format for text-to-speech
+            audio_generator = eleven_client.text_to_speech.convert(
+                text=explanation,
+                voice_id="HobRzuqtLputbKAXOdTj",  # Use the voice ID instead of name for "Harsh"
+                model_id="eleven_multilingual_v2",  # Use the correct model ID
+                output_format="mp3_44100_128"  # Specify output format
+            )
+            
+            # Write the audio out as it arrives
+            audio_path = os.path.join(audio_folder, f"{pdf_name}_page_{page_number}.mp3")
+            with open(audio_path, "wb") as audio_file:
+                for chunk in audio_generator:
+                    if chunk:
+                        audio_file.write(chunk)
+            
+            logger.debug("Audio generated and saved to %s", audio_path)
+        except Exception as e:
+            logger.exception("Error generating audio: %s", e)
+
+        return orjson.dumps({
+            'type': 'page',
+            'page_data': {
+                'page_number': page_number,
+                'explanation': explanation,
+                'audio_url': f"/pdf/{pdf_name}/audio/{page_number}",
+                'image_url': f"/pdf/{pdf_name}/image/{page_number}"
+            }
+        }, option=orjson.OPT_APPEND_NEWLINE)
 
     def generate():
+        # Pages are rendered here, one at a time, while earlier pages are
+        # still being explained and voiced on page_pool. Results are
+        # yielded in page order as each one finishes.
+        doc = fitz.open(temp_pdf_path)
+        pending = deque()
         try:
-            # Convert PDF to images
-            print("Converting PDF to images...")
-            images = convert_from_path(temp_pdf_path)
-            print(f"Converted {len(images)} pages")
+            page_count = len(doc)
+            logger.debug("PDF has %s pages", page_count)
             
             # Send total page count to frontend
-            yield json.dumps({
+            yield orjson.dumps({
                 'type': 'info',
-                'total_pages': len(images),
+                'total_pages': page_count,
                 'pdf_name': pdf_name
-            }) + '\n'
+            }, option=orjson.OPT_APPEND_NEWLINE)
 
-            for i, image in enumerate(images):
-                print(f"Processing page {i+1}...")
+            for i in range(page_count):
+                logger.debug("Processing page %s...", i+1)
+                pix = doc[i].get_pixmap(dpi=RENDER_DPI, alpha=False)
+                jpeg_bytes = pix.pil_tobytes(format="JPEG", quality=85, optimize=False)
+                
                 # Save image with proper naming
                 img_filename = f"{pdf_name}_page_{i+1}.jpg"
                 img_path = os.path.join(image_folder, img_filename)
-                image.save(img_path, 'JPEG')
-                print(f"Image saved to {img_path}")
-
-                # Convert image to base64 for sending to frontend
-                buffered = BytesIO()
-                image.save(buffered, format="JPEG")
-                img_str = base64.b64encode(buffered.getvalue()).decode()
-
-                # Get AI explanation
-                print(f"Getting AI explanation for page {i+1}...")
-                try:
-                    response = genai_client.models.generate_content(
-                        model="gemini-1.5-pro",
-                        contents=[
-                            f"Please explain this page in {difficulty_level}, including any formulas or mathematical expressions. Make sure to explain them in a way that would be easy to read aloud. Preserve all formatting, including paragraph breaks.",
-                            image
-                        ]
-                    )
-                    
-                    explanation = response.text
-                    print(f"AI explanation received for page {i+1}")
-                    
-                    # Save the explanation as markdown
-                    text_path = os.path.join(text_folder, f"{pdf_name}_page_{i+1}.md")
-                    with open(text_path, 'w') as f:
-                        f.write(explanation)
-                    print(f"Explanation saved to {text_path}")
-                    
-                except Exception as e:
-                    print(f"Error getting AI explanation: {str(e)}")
-                    traceback.print_exc()
-                    explanation = f"Error analyzing page {i+1}: {str(e)}"
-
-                # Generate audio using Google Text-to-Speech API (REST API with API key)
-                print(f"Generating audio for page {i+1}...")
-                try:
-                    # Use the correct API format for text-to-speech
-                    audio_generator = eleven_client.text_to_speech.convert(
-                        text=explanation,
-                        voice_id="HobRzuqtLputbKAXOdTj",  # Use the voice ID instead of name for "Harsh"
-                        model_id="eleven_multilingual_v2",  # Use the correct model ID
-                        output_format="mp3_44100_128"  # Specify output format
-                    )
-                    
-                    # Collect all audio data from the generator
-                    audio_data = b""
-                    for chunk in audio_generator:
-                        if chunk:
-                            audio_data += chunk
-                    audio_filename = f"{pdf_name}_page_{i+1}.mp3"
-                    audio_path = os.path.join(audio_folder, audio_filename)
-                    with open(audio_path, "wb") as audio_file:
-                        audio_file.write(audio_data)
-                    
-                    print(f"Audio generated and saved to {audio_path}")
-                    print(f"Audio generated for page {i+1}")
-                except Exception as e:
-                    print(f"Error generating audio: {str(e)}")
-                    traceback.print_exc()
-                    # Return a dummy audio string in case of error
-                    audio_data = b""
-                    audio_filename = ""
-                # Convert audio to base64
-                audio_str = base64.b64encode(audio_data).decode()
-
-                # Send this page's result to frontend immediately
-                yield json.dumps({
-                    'type': 'page',
-                    'page_data': {
-                        'page_number': i + 1,
-                        'image': img_str,
-                        'explanation': explanation,
-                        'audio': audio_str,
-                        'audio_url': f"/pdf/{pdf_name}/audio/{i+1}",
-                        'image_url': f"/pdf/{pdf_name}/image/{i+1}"
-                    }
-                }) + '\n'
+                with open(img_path, 'wb') as img_file:
+                    img_file.write(jpeg_bytes)
+                logger.debug("Image saved to %s", img_path)
+
+                pending.append(page_pool.submit(explain_and_speak, i + 1, jpeg_bytes))
+                
+                # Send finished pages to the frontend as soon as they are next
+                # in order, and don't render too far ahead of the workers
+                while pending and (pending[0].done() or len(pending) > PAGE_WORKERS):
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
 
             # Send completion message
-            yield json.dumps({
+            yield orjson.dumps({
                 'type': 'complete',
                 'message': 'All pages processed successfully',
                 'pdf_name': pdf_name
-            }) + '\n'
+            }, option=orjson.OPT_APPEND_NEWLINE)
 
         except Exception as e:
-            print(f"Error processing PDF: {str(e)}")
-            traceback.print_exc()
-            yield json.dumps({
+            logger.exception("Error processing PDF: %s", e)
+            yield orjson.dumps({
                 'type': 'error',
                 'error': str(e)
-            }) + '\n'
+            }, option=orjson.OPT_APPEND_NEWLINE)
+        finally:
+            # Pages not started yet are not needed if the client went away
+            for future in pending:
+                future.cancel()
+            doc.close()
+            # Drop the listing entry so /existing-pdfs recounts the finished PDF
+            _pdf_entry_cache.pop(pdf_name, None)
 
     return Response(generate(), mimetype='text/event-stream')
 
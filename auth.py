@@ -1,14 +1,77 @@
 from flask import request, jsonify, session
 import hashlib
-import uuid
+import hmac
+import secrets
 import functools
+import logging
+import os
+import time
+import threading
 import sqlite3
 from datetime import datetime, timedelta
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
+from gevent import monkey
+from gevent.threadpool import ThreadPool
 from database import add_user, get_user_by_username, get_db_connection, sync_db_to_cloud
 
+logger = logging.getLogger(__name__)
+
+# One Argon2id hasher for the whole process, so its parameters are set up once
+_password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=1)
+# Checked against when a login names an unknown user or a legacy SHA-256
+# account, to even out timing; no password matches it
+_DUMMY_PASSWORD_HASH = _password_hasher.hash(secrets.token_urlsafe(32))
+
+# Under gevent, Argon2 runs on native threads so a login doesn't stall every
+# other connection on the worker's hub (argon2-cffi releases the GIL). Each
+# hash holds 64 MiB, so the default keeps one in flight per worker, as before
+PASSWORD_HASH_THREADS = int(os.getenv('PASSWORD_HASH_THREADS', '1'))
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+def _argon2(method, *args):
+    """Call a PasswordHasher method, off the gevent hub when serving under gevent"""
+    global _hash_pool
+    if not monkey.is_module_patched('threading'):
+        return method(*args)
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ThreadPool(PASSWORD_HASH_THREADS)
+    return _hash_pool.apply(method, args)
+
+# Expired sessions are purged at most this often (seconds)
+SESSION_CLEANUP_INTERVAL = 3600
+_last_session_cleanup = float('-inf')
+
 def hash_password(password):
-    """Hash a password using SHA-256"""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hash a password using Argon2id"""
+    return _argon2(_password_hasher.hash, password)
+
+def verify_password(password_hash, password):
+    """Check a password against a stored hash.
+    
+    Returns (matches, needs_rehash). Accounts created before Argon2 hold an
+    unsalted SHA-256 hex digest; those always need rehashing.
+    """
+    if not password_hash.startswith('$argon2'):
+        legacy_hash = hashlib.sha256(password.encode()).hexdigest()
+        matches = hmac.compare_digest(password_hash, legacy_hash)
+        # Spend an Argon2 verify on a wrong password too, so legacy accounts
+        # can't be told apart from Argon2 accounts or unknown usernames by
+        # response time. A match is followed by the rehash, which costs the same
+        if not matches:
+            try:
+                _argon2(_password_hasher.verify, _DUMMY_PASSWORD_HASH, password)
+            except VerificationError:
+                pass
+        return matches, True
+    
+    try:
+        _argon2(_password_hasher.verify, password_hash, password)
+    except (VerificationError, InvalidHash):
+        return False, False
+    return True, _password_hasher.check_needs_rehash(password_hash)
 
 def register_user(username, email, password):
     """Register a new user"""
@@ -23,10 +86,15 @@ def register_user(username, email, password):
     else:
         return {'success': False, 'error': 'Username or email already exists'}
 
-def create_session(user_id, username):
-    """Create a session for the user in the database"""
+def create_session(user_id, username, new_password_hash=None):
+    """Create a session for the user in the database.
+    
+    If new_password_hash is given, the user's stored hash is replaced in the
+    same transaction, so a login costs one commit and one cloud sync.
+    """
+    global _last_session_cleanup
     # Generate a session token
-    session_token = str(uuid.uuid4())
+    session_token = secrets.token_urlsafe(32)
     
     # Set expiration to 7 days from now
     expires_at = datetime.now() + timedelta(days=7)
@@ -36,6 +104,16 @@ def create_session(user_id, username):
     cursor = conn.cursor()
     
     try:
+        if new_password_hash:
+            cursor.execute(
+                'UPDATE users SET password_hash = ? WHERE user_id = ?',
+                (new_password_hash, user_id)
+            )
+        # Expired sessions are never returned by get_current_user, so they
+        # are only cleared out now and then, as part of a login's write
+        if time.monotonic() - _last_session_cleanup > SESSION_CLEANUP_INTERVAL:
+            cursor.execute('DELETE FROM sessions WHERE expires_at <= datetime("now")')
+            _last_session_cleanup = time.monotonic()
         cursor.execute(
             'INSERT INTO sessions (user_id, token, expires_at) VALUES (?, ?, ?)',
             (user_id, session_token, expires_at)
@@ -52,27 +130,32 @@ def create_session(user_id, username):
             'expires_at': expires_at.isoformat()
         }
     except Exception as e:
-        print(f"Error creating session: {str(e)}")
+        logger.error("Error creating session: %s", e)
         return None
     finally:
         conn.close()
 
 def login_user(username, password):
     """Login a user and return a session token"""
-    # Hash the provided password
-    password_hash = hash_password(password)
-    
     # Get the user from the database
     user = get_user_by_username(username)
     
     if not user:
+        # Spend the same Argon2 work as a real check, so response times
+        # don't reveal which usernames exist
+        verify_password(_DUMMY_PASSWORD_HASH, password)
         return {'success': False, 'error': 'Invalid username or password'}
     
-    if user['password_hash'] != password_hash:
+    matches, needs_rehash = verify_password(user['password_hash'], password)
+    if not matches:
         return {'success': False, 'error': 'Invalid username or password'}
     
+    # Upgrade legacy SHA-256 hashes (and older Argon2 parameters) now that
+    # we have the plain password; this is written along with the session
+    new_password_hash = hash_password(password) if needs_rehash else None
+    
     # Create a new session
-    session_data = create_session(user['user_id'], user['username'])
+    session_data = create_session(user['user_id'], user['username'], new_password_hash)
     
     if session_data:
         return {
@@ -101,7 +184,7 @@ def logout_user(session_token):
         else:
             return {'success': False, 'error': 'Invalid session token'}
     except Exception as e:
-        print(f"Error logging out user: {str(e)}")
+        logger.error("Error logging out user: %s", e)
         return {'success': False, 'error': 'Database error'}
     finally:
         conn.close()
@@ -129,10 +212,6 @@ def get_current_user(session_token):
         session_data = cursor.fetchone()
         
         if not session_data:
-            # Clean up expired sessions periodically
-            cursor.execute('DELETE FROM sessions WHERE expires_at <= datetime("now")')
-            conn.commit()
-            sync_db_to_cloud()
             return None
             
         return {
@@ -140,7 +219,7 @@ def get_current_user(session_token):
             'username': session_data['username']
         }
     except Exception as e:
-        print(f"Error getting current user: {str(e)}")
+        logger.error("Error getting current user: %s", e)
         return None
     finally:
         conn.close()
@@ -1,40 +1,135 @@
 from google.cloud import storage
+from google.oauth2 import service_account
+from google.api_core.exceptions import NotFound
 import os
 import datetime
-import uuid
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
 
 # Default bucket name - should be set in environment variable in production
 DEFAULT_BUCKET_NAME = os.getenv('GCS_BUCKET_NAME', 'studybuddy-pdf-storage')
 
+# Uploads larger than 8 MiB go through the resumable API in 8 MiB chunks
+# (smaller ones stay single-request multipart uploads)
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Page images and audio are only ever replaced by a regenerated copy, which is
+# served under a newly signed URL, so responses for a given URL never change
+MEDIA_CONTENT_TYPES = ('image/', 'audio/')
+MEDIA_CACHE_CONTROL = 'public, max-age=86400, immutable'
+
+# Warm-up copies of local files into GCS are written off the request path
+_background_uploads = ThreadPoolExecutor(max_workers=4)
+# Warm-up copies already queued, so repeated misses don't upload the same file again
+_pending_uploads = set()
+_pending_lock = threading.Lock()
+
+# Cache misses being filled right now, keyed by operation and object. Concurrent
+# misses for the same object wait for the first one instead of repeating the call.
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Objects found by existence checks are remembered for 30 seconds. Uploads and deletes
+# through this module update the cache, so it only lags behind changes
+# made elsewhere.
+_exists_cache = TTLCache(maxsize=4096, ttl=30)
+# Misses are kept for a shorter time, since pages that are still being
+# processed are polled until they appear
+_neg_exists_cache = TTLCache(maxsize=8192, ttl=10)
+_exists_lock = threading.Lock()
+exists_cache_stats = {'hits': 0, 'misses': 0}
+
+# Signed URLs are reused until shortly before they expire instead of being
+# re-signed on every request
+_signed_url_cache = TTLCache(maxsize=8192, ttl=25 * 60)
+_signed_url_lock = threading.Lock()
+SIGNED_URL_MARGIN_SECONDS = 5 * 60
+
+# Prefix listings change only when a PDF is ingested; uploads and deletes
+# through this module drop the listings that cover them
+_list_cache = TTLCache(maxsize=1024, ttl=60)
+_list_lock = threading.Lock()
+
+# One storage client per process, so its authorized session and connection
+# pool (and TLS connections to GCS) are reused by every request. The server
+# runs gevent workers, where requests are greenlets sharing one OS thread, so
+# sharing the session is safe. The service account key is parsed once too.
+_client = None
+# Bucket handles of that client, by name
+_buckets = {}
+_credentials = None
+# Reentrant: get_storage_client holds it while calling load_credentials
+_credentials_lock = threading.RLock()
+
+# Set once we know GCS cannot be used, so later calls skip the credential checks
+_gcs_unavailable = False
+
+def load_credentials(credentials_path):
+    """Service account credentials from the key file, loaded once per process."""
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            logger.debug("Using credentials from: %s", credentials_path)
+            _credentials = service_account.Credentials.from_service_account_file(credentials_path)
+        return _credentials
+
 def get_storage_client():
-    """Get a Google Cloud Storage client."""
-    try:
-        # Get credentials file path from environment variable
-        credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
-        
-        if not credentials_path:
-            print("No Google Cloud credentials path set in environment variables")
-            return None
+    """Get the process-wide Google Cloud Storage client."""
+    global _client, _gcs_unavailable
+    if _client is not None:
+        return _client
+    if _gcs_unavailable:
+        return None
+    
+    with _credentials_lock:
+        if _client is not None:
+            return _client
+        try:
+            # Get credentials file path from environment variable
+            credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
             
-        if not os.path.exists(credentials_path):
-            print(f"Credentials file not found at {credentials_path}")
-            print("Please make sure the file exists at the specified path.")
+            if not credentials_path:
+                logger.warning("No Google Cloud credentials path set in environment variables")
+                _gcs_unavailable = True
+                return None
+                
+            if not os.path.exists(credentials_path):
+                logger.warning("Credentials file not found at %s", credentials_path)
+                logger.warning("Please make sure the file exists at the specified path.")
+                _gcs_unavailable = True
+                return None
+                
+            credentials = load_credentials(credentials_path)
+            _client = storage.Client(project=credentials.project_id, credentials=credentials)
+            return _client
+        except Exception as e:
+            logger.error("Error creating storage client: %s", e)
+            logger.warning("GCS credentials not found - falling back to local storage")
+            # Return None to indicate that GCS is not available
             return None
-            
-        print(f"Using credentials from: {credentials_path}")
-        return storage.Client.from_service_account_json(credentials_path)
-    except Exception as e:
-        print(f"Error creating storage client: {str(e)}")
-        print("WARNING: GCS credentials not found - falling back to local storage")
-        # Return None to indicate that GCS is not available
+
+def get_bucket(bucket_name=DEFAULT_BUCKET_NAME):
+    """Get a bucket handle (cached for the process, like the client)."""
+    client = get_storage_client()
+    if client is None:
         return None
+    
+    bucket = _buckets.get(bucket_name)
+    if bucket is None:
+        bucket = _buckets.setdefault(bucket_name, client.bucket(bucket_name))
+    return bucket
 
 def create_bucket_if_not_exists(bucket_name=DEFAULT_BUCKET_NAME):
     """Create a Google Cloud Storage bucket if it doesn't exist."""
     client = get_storage_client()
     
     if client is None:
-        print("GCS not available, skipping bucket creation")
+        logger.debug("GCS not available, skipping bucket creation")
         return None
     
     if not client.lookup_bucket(bucket_name):
@@ -49,13 +144,21 @@ def create_bucket_if_not_exists(bucket_name=DEFAULT_BUCKET_NAME):
                 "maxAgeSeconds": 3600
             }
         ]
+        # Expire cached Gemini/TTS responses after 30 days
+        bucket.add_lifecycle_delete_rule(age=30, matches_prefix=['cache/'])
         bucket.patch()
         
-        print(f"Created bucket {bucket_name}")
+        logger.info("Created bucket %s", bucket_name)
     else:
-        print(f"Bucket {bucket_name} already exists")
+        logger.debug("Bucket %s already exists", bucket_name)
     
-    return client.bucket(bucket_name)
+    return get_bucket(bucket_name)
+
+def _cache_control_for(content_type):
+    """Cache-Control for an uploaded object: page images and audio may be cached by browsers and CDNs."""
+    if content_type and content_type.startswith(MEDIA_CONTENT_TYPES):
+        return MEDIA_CACHE_CONTROL
+    return None
 
 def upload_file(file_content, file_path, bucket_name=DEFAULT_BUCKET_NAME, content_type=None):
     """Upload a file to Google Cloud Storage.
@@ -72,61 +175,80 @@ def upload_file(file_content, file_path, bucket_name=DEFAULT_BUCKET_NAME, conten
     client = get_storage_client()
     
     if client is None:
-        print(f"GCS not available, skipping upload of {file_path}")
+        logger.debug("GCS not available, skipping upload of %s", file_path)
         return None
     
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(file_path)
+    bucket = get_bucket(bucket_name)
+    blob = bucket.blob(file_path, chunk_size=UPLOAD_CHUNK_SIZE)
     
-    print(f"Uploading file to GCS: path={file_path}, content_type={content_type}, content_is_string={isinstance(file_content, str)}")
+    logger.debug("Uploading file to GCS: path=%s, content_type=%s, content_is_string=%s", file_path, content_type, isinstance(file_content, str))
     
     if content_type:
         blob.content_type = content_type
-        print(f"Set content type for {file_path} to {content_type}")
+        blob.cache_control = _cache_control_for(content_type)
+        logger.debug("Set content type for %s to %s", file_path, content_type)
     
     try:
-        if isinstance(file_content, str):
-            # For string content, explicitly set the content type
-            print(f"Uploading string content of length {len(file_content)} with content_type={content_type}")
-            if content_type and content_type.startswith('text/'):
-                # For text content types, encode to bytes and set content type
-                blob.upload_from_string(file_content, content_type=content_type)
-            else:
-                # For other content types, default behavior
-                blob.upload_from_string(file_content, content_type=content_type)
-        else:
-            # For binary content
-            print(f"Uploading binary content with content_type={content_type}")
-            blob.upload_from_string(file_content, content_type=content_type)
+        # Strings are encoded as UTF-8 by the client
+        blob.upload_from_string(file_content, content_type=content_type)
         
-        print(f"Successfully uploaded {file_path} to GCS")
+        logger.debug("Successfully uploaded %s to GCS", file_path)
+        _object_changed(file_path, bucket_name, True)
         return blob.name
     except Exception as e:
-        print(f"Error uploading {file_path} to GCS: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error uploading %s to GCS: %s", file_path, e)
         return None
 
-def upload_from_file(file_object, file_path, bucket_name=DEFAULT_BUCKET_NAME, content_type=None):
-    """Upload a file object to Google Cloud Storage."""
+def upload_in_background(upload, *args, **kwargs):
+    """Run one of the upload helpers on a background thread without waiting for it."""
+    return _background_uploads.submit(upload, *args, **kwargs)
+
+def copy_to_gcs_in_background(local_file_path, file_path, bucket_name=DEFAULT_BUCKET_NAME, content_type=None):
+    """Queue a warm-up upload of a local file, at most once while it is pending."""
+    key = (bucket_name, file_path)
+    with _pending_lock:
+        if key in _pending_uploads:
+            return None
+        _pending_uploads.add(key)
+    
+    def run():
+        try:
+            return upload_from_filename(local_file_path, file_path, bucket_name, content_type)
+        finally:
+            with _pending_lock:
+                _pending_uploads.discard(key)
+    
+    return _background_uploads.submit(run)
+
+def upload_from_file(file_object, file_path, bucket_name=DEFAULT_BUCKET_NAME, content_type=None, content_encoding=None,
+                     size=None):
+    """Upload a file object to Google Cloud Storage.
+    
+    Pass size when it is known: without it the client can't tell a small
+    upload from a large one and always starts a resumable session.
+    """
     client = get_storage_client()
     
     if client is None:
-        print(f"GCS not available, skipping upload of {file_path}")
+        logger.debug("GCS not available, skipping upload of %s", file_path)
         return None
     
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(file_path)
+    bucket = get_bucket(bucket_name)
+    blob = bucket.blob(file_path, chunk_size=UPLOAD_CHUNK_SIZE)
     
     if content_type:
         blob.content_type = content_type
+        blob.cache_control = _cache_control_for(content_type)
+    if content_encoding:
+        blob.content_encoding = content_encoding
     
     try:
-        blob.upload_from_file(file_object, content_type=content_type)
-        print(f"Successfully uploaded {file_path} to GCS")
+        blob.upload_from_file(file_object, content_type=content_type, size=size)
+        logger.debug("Successfully uploaded %s to GCS", file_path)
+        _object_changed(file_path, bucket_name, True)
         return blob.name
     except Exception as e:
-        print(f"Error uploading {file_path} to GCS: {str(e)}")
+        logger.error("Error uploading %s to GCS: %s", file_path, e)
         return None
 
 def upload_from_filename(local_file_path, file_path, bucket_name=DEFAULT_BUCKET_NAME, content_type=None):
@@ -134,68 +256,122 @@ def upload_from_filename(local_file_path, file_path, bucket_name=DEFAULT_BUCKET_
     client = get_storage_client()
     
     if client is None:
-        print(f"GCS not available, skipping upload of {file_path}")
+        logger.debug("GCS not available, skipping upload of %s", file_path)
         return None
     
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(file_path)
+    bucket = get_bucket(bucket_name)
+    blob = bucket.blob(file_path, chunk_size=UPLOAD_CHUNK_SIZE)
     
     if content_type:
         blob.content_type = content_type
+        blob.cache_control = _cache_control_for(content_type)
     
     try:
         blob.upload_from_filename(local_file_path)
-        print(f"Successfully uploaded {file_path} to GCS from {local_file_path}")
+        logger.debug("Successfully uploaded %s to GCS from %s", file_path, local_file_path)
+        _object_changed(file_path, bucket_name, True)
         return blob.name
     except Exception as e:
-        print(f"Error uploading {file_path} to GCS from {local_file_path}: {str(e)}")
+        logger.error("Error uploading %s to GCS from %s: %s", file_path, local_file_path, e)
         return None
 
 def generate_signed_url(file_path, bucket_name=DEFAULT_BUCKET_NAME, expiration_minutes=15):
-    """Generate a signed URL for temporary access to a file."""
+    """Generate a signed URL for temporary access to a file.
+    
+    Signing is done locally and doesn't check that the object exists.
+    """
     client = get_storage_client()
     
     if client is None:
-        print(f"GCS not available, cannot generate signed URL for {file_path}")
+        logger.debug("GCS not available, cannot generate signed URL for %s", file_path)
         return None
     
-    bucket = client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name)
     blob = bucket.blob(file_path)
     
     try:
-        # First check if blob exists
-        if not blob.exists():
-            print(f"File does not exist in GCS: {file_path}")
-            return None
-            
         # Generate the signed URL
-        print(f"Generating signed URL for: {file_path} with expiration: {expiration_minutes} minutes")
+        logger.debug("Generating signed URL for: %s with expiration: %s minutes", file_path, expiration_minutes)
         url = blob.generate_signed_url(
             version="v4",
             expiration=datetime.timedelta(minutes=expiration_minutes),
-            method="GET"
+            method="GET",
+            virtual_hosted_style=True
         )
         
-        print(f"Generated signed URL: {url[:50]}..." if url else "Failed to generate URL")
+        if url:
+            logger.debug("Generated signed URL: %s...", url[:50])
+        else:
+            logger.error("Failed to generate URL")
         return url
     except Exception as e:
-        print(f"Error generating signed URL for {file_path}: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error generating signed URL for %s: %s", file_path, e)
         return None
 
-def download_file(file_path, local_path, bucket_name=DEFAULT_BUCKET_NAME):
-    """Download a file from Google Cloud Storage to a local path."""
+def _coalesced(key, work):
+    """Run work() once for concurrent callers with the same key; the rest wait for its result."""
+    with _inflight_lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _inflight[key] = (threading.Event(), [None])
+    done, result = call
+    
+    if not leader:
+        done.wait()
+        return result[0]
+    
+    try:
+        result[0] = work()
+        return result[0]
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        done.set()
+
+def cached_signed_url(file_path, expiration_minutes=15, bucket_name=DEFAULT_BUCKET_NAME, must_exist=False):
+    """generate_signed_url, reusing a previously signed URL while it stays valid.
+    
+    With must_exist, returns None (and caches nothing) for missing objects;
+    callers that have already checked existence leave it off.
+    """
+    key = (bucket_name, file_path)
+    now = time.monotonic()
+    with _signed_url_lock:
+        entry = _signed_url_cache.get(key)
+    if entry is not None:
+        minutes, url, valid_until = entry
+        if minutes == expiration_minutes and now < valid_until:
+            return url
+    
+    def sign():
+        if must_exist and not cached_exists(file_path, bucket_name):
+            logger.debug("File does not exist in GCS: %s", file_path)
+            return None
+        url = generate_signed_url(file_path, bucket_name, expiration_minutes)
+        if url:
+            valid_until = now + max(expiration_minutes * 60 - SIGNED_URL_MARGIN_SECONDS, 0)
+            with _signed_url_lock:
+                _signed_url_cache[key] = (expiration_minutes, url, valid_until)
+        return url
+    
+    return _coalesced(('sign', expiration_minutes) + key, sign)
+
+def download_file(file_path, local_path, bucket_name=DEFAULT_BUCKET_NAME, raw_download=False):
+    """Download a file from Google Cloud Storage to a local path.
+    
+    With raw_download, gzip-encoded objects are saved exactly as stored.
+    """
     client = get_storage_client()
     
     if client is None:
-        print(f"GCS not available, cannot download {file_path}")
+        logger.debug("GCS not available, cannot download %s", file_path)
         return None
     
-    bucket = client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name)
     blob = bucket.blob(file_path)
     
-    blob.download_to_filename(local_path)
+    blob.download_to_filename(local_path, raw_download=raw_download)
     
     return local_path
 
@@ -204,16 +380,46 @@ def download_as_string(file_path, bucket_name=DEFAULT_BUCKET_NAME):
     client = get_storage_client()
     
     if client is None:
-        print(f"GCS not available, cannot download {file_path}")
+        logger.debug("GCS not available, cannot download %s", file_path)
         return None
     
-    bucket = client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name)
     blob = bucket.blob(file_path)
     
     try:
         return blob.download_as_bytes()
     except Exception as e:
-        print(f"Error downloading {file_path} from GCS: {str(e)}")
+        logger.error("Error downloading %s from GCS: %s", file_path, e)
+        return None
+
+def try_download(file_path, bucket_name=DEFAULT_BUCKET_NAME):
+    """Download a file as bytes, or return None if it does not exist.
+    
+    Unlike check_if_file_exists + download_as_string this is a single
+    GET request.
+    """
+    client = get_storage_client()
+    
+    if client is None:
+        return None
+    
+    # Skip the request for objects that were just found to be missing
+    with _exists_lock:
+        if (bucket_name, file_path) in _neg_exists_cache:
+            return None
+    
+    bucket = get_bucket(bucket_name)
+    blob = bucket.blob(file_path)
+    
+    try:
+        content = blob.download_as_bytes()
+        _remember_exists(file_path, bucket_name, True)
+        return content
+    except NotFound:
+        _remember_exists(file_path, bucket_name, False)
+        return None
+    except Exception as e:
+        logger.error("Error downloading %s from GCS: %s", file_path, e)
         return None
 
 def check_if_file_exists(file_path, bucket_name=DEFAULT_BUCKET_NAME):
@@ -221,70 +427,108 @@ def check_if_file_exists(file_path, bucket_name=DEFAULT_BUCKET_NAME):
     client = get_storage_client()
     
     if client is None:
-        print(f"GCS not available, assuming {file_path} does not exist")
+        logger.debug("GCS not available, assuming %s does not exist", file_path)
         return False
     
-    bucket = client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name)
     blob = bucket.blob(file_path)
     
     try:
         return blob.exists()
     except Exception as e:
-        print(f"Error checking if file exists in GCS: {str(e)}")
+        logger.error("Error checking if file exists in GCS: %s", e)
         return False
 
+def _remember_exists(file_path, bucket_name, exists):
+    key = (bucket_name, file_path)
+    with _exists_lock:
+        if exists:
+            _exists_cache[key] = True
+            _neg_exists_cache.pop(key, None)
+        else:
+            _neg_exists_cache[key] = True
+            _exists_cache.pop(key, None)
+
+def _object_changed(file_path, bucket_name, exists):
+    """Write-through for uploads and deletes made by this module."""
+    _remember_exists(file_path, bucket_name, exists)
+    # A new upload or a delete makes any URL signed for the old object stale
+    with _signed_url_lock:
+        _signed_url_cache.pop((bucket_name, file_path), None)
+    # ...and any listing that would include it
+    with _list_lock:
+        for key in [key for key in _list_cache if key[0] == bucket_name and file_path.startswith(key[1])]:
+            _list_cache.pop(key, None)
+
+def cached_exists(file_path, bucket_name=DEFAULT_BUCKET_NAME):
+    """check_if_file_exists with a short-lived cache in front of it."""
+    key = (bucket_name, file_path)
+    with _exists_lock:
+        if key in _exists_cache or key in _neg_exists_cache:
+            exists_cache_stats['hits'] += 1
+            return key in _exists_cache
+        exists_cache_stats['misses'] += 1
+    
+    def check():
+        exists = check_if_file_exists(file_path, bucket_name)
+        _remember_exists(file_path, bucket_name, exists)
+        return exists
+    
+    return _coalesced(('exists',) + key, check)
+
 def list_files_with_prefix(prefix, bucket_name=DEFAULT_BUCKET_NAME):
     """List all files in the bucket with a given prefix."""
     client = get_storage_client()
     
     if client is None:
-        print(f"GCS not available, cannot list files with prefix {prefix}")
+        logger.debug("GCS not available, cannot list files with prefix %s", prefix)
         return []
     
-    bucket = client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name)
     
     try:
-        blobs = bucket.list_blobs(prefix=prefix)
+        # Only names are used, so ask for nothing else; the iterator follows
+        # nextPageToken across pages of up to 1000 names
+        blobs = bucket.list_blobs(prefix=prefix, fields='items(name),nextPageToken', page_size=1000)
         return [blob.name for blob in blobs]
     except Exception as e:
-        print(f"Error listing files in GCS: {str(e)}")
+        logger.error("Error listing files in GCS: %s", e)
         return []
 
-def generate_unique_filepath(filename, prefix=""):
-    """Generate a unique filepath with the given filename and optional prefix.
-    
-    Args:
-        filename: The original filename
-        prefix: Optional directory prefix
+def cached_list_files(prefix, bucket_name=DEFAULT_BUCKET_NAME):
+    """list_files_with_prefix with a short-lived cache in front of it."""
+    key = (bucket_name, prefix)
+    with _list_lock:
+        names = _list_cache.get(key)
+    
+    if names is None:
+        def fetch():
+            # Failed listings come back empty and are not cached
+            names = list_files_with_prefix(prefix, bucket_name)
+            if names:
+                with _list_lock:
+                    _list_cache[key] = names
+            return names
         
-    Returns:
-        A unique filepath in the format: prefix/uuid_filename
-    """
-    unique_id = str(uuid.uuid4())
-    base_name, ext = os.path.splitext(filename)
-    
-    # Clean the filename
-    clean_base_name = ''.join(c for c in base_name if c.isalnum() or c in '-_').lower()
+        names = _coalesced(('list',) + key, fetch)
     
-    unique_filename = f"{clean_base_name}_{unique_id}{ext}"
-    if prefix:
-        if not prefix.endswith('/'):
-            prefix += '/'
-        return f"{prefix}{unique_filename}"
-    return unique_filename
+    # Callers may sort or extend the list they get
+    return list(names)
 
 def delete_file(file_path, bucket_name=DEFAULT_BUCKET_NAME):
     """Delete a file from Google Cloud Storage."""
     client = get_storage_client()
     
     if client is None:
-        print(f"GCS not available, cannot delete {file_path}")
+        logger.debug("GCS not available, cannot delete %s", file_path)
         return False
     
-    bucket = client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name)
     blob = bucket.blob(file_path)
     
-    if blob.exists():
+    try:
         blob.delete()
-        return True
-    return False 
\ No newline at end of file
+    except NotFound:
+        return False
+    _object_changed(file_path, bucket_name, False)
+    return True 
\ No newline at end of file
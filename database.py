@@ -1,18 +1,26 @@
 import sqlite3
 import os
 import hashlib
+import logging
 import tempfile
+import gzip
+import shutil
 import threading
+import queue
+import time
+import atexit
 from datetime import datetime
 
 # Add imports for Google Cloud Storage
 from cloud_storage import (
     download_file, 
-    upload_from_filename, 
+    upload_from_file, 
     check_if_file_exists,
     get_storage_client
 )
 
+logger = logging.getLogger(__name__)
+
 # Define constants for GCS
 GCS_DB_PATH = 'database/studybuddy.db'
 
@@ -20,74 +28,197 @@ GCS_DB_PATH = 'database/studybuddy.db'
 LOCAL_DB_PATH = 'instance/studybuddy.db'
 DB_PATH = LOCAL_DB_PATH
 
-# Lock for database operations
-db_lock = threading.Lock()
+# Files are hashed in 1 MiB blocks
+HASH_BLOCK_SIZE = 1 << 20
 
-def sync_db_to_cloud():
-    """Upload the local database to GCS"""
+# Idle connections kept for reuse; extras beyond this are closed
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '16'))
+_connection_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+# Writes within this many seconds of each other share a single upload
+DB_SYNC_DELAY = float(os.getenv('DB_SYNC_DELAY', '2'))
+
+# Set by writers, consumed by the background sync thread
+_db_dirty = threading.Event()
+_sync_thread = None
+_sync_thread_lock = threading.Lock()
+
+# Compressed database uploads stay in memory up to this size, then spill to disk
+DB_SPOOL_SIZE = 32 * 1024 * 1024
+
+# Pages copied per backup step; writers can get in between steps
+DB_BACKUP_PAGES = 256
+
+def upload_db_to_cloud():
+    """Upload the local database to GCS right away"""
     try:
         # Check if GCS is available
         if get_storage_client() is None:
-            print("GCS not available, skipping database sync")
+            logger.debug("GCS not available, skipping database sync")
             return False
-            
-        print(f"Syncing database to GCS: {GCS_DB_PATH}")
-        result = upload_from_filename(LOCAL_DB_PATH, GCS_DB_PATH, content_type='application/x-sqlite3')
+
+        logger.debug("Syncing database to GCS: %s", GCS_DB_PATH)
+        with tempfile.TemporaryDirectory(dir='instance') as tmp_dir:
+            snapshot_path = snapshot_db(os.path.join(tmp_dir, 'snapshot.db'))
+            # SQLite files compress well; level 1 already gets most of the gain
+            with tempfile.SpooledTemporaryFile(max_size=DB_SPOOL_SIZE) as buf:
+                with open(snapshot_path, 'rb') as f, gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1) as gz:
+                    shutil.copyfileobj(f, gz, HASH_BLOCK_SIZE)
+                size = buf.tell()
+                buf.seek(0)
+                result = upload_from_file(buf, GCS_DB_PATH, content_type='application/x-sqlite3',
+                                          content_encoding='gzip', size=size)
         if result:
-            print("Database successfully synced to GCS")
+            logger.debug("Database successfully synced to GCS")
             return True
         else:
-            print("Failed to sync database to GCS")
+            logger.error("Failed to sync database to GCS")
             return False
     except Exception as e:
-        print(f"Error syncing database to GCS: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error syncing database to GCS: %s", e)
         return False
 
+def snapshot_db(snapshot_path):
+    """Copy a consistent snapshot of the database (WAL included) to snapshot_path.
+    
+    Uses SQLite's online backup, so writers carry on while it runs and the
+    copy never contains half of a transaction.
+    """
+    target = sqlite3.connect(snapshot_path)
+    source = get_db_connection()
+    try:
+        source.backup(target, pages=DB_BACKUP_PAGES)
+        # Store the copy as a self-contained rollback-journal database
+        target.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        source.close()
+        target.close()
+    return snapshot_path
+
+def download_db(local_path):
+    """Download the database from GCS, unpacking it if it was stored gzipped"""
+    packed_path = local_path + '.download'
+    try:
+        download_file(GCS_DB_PATH, packed_path, raw_download=True)
+        with open(packed_path, 'rb') as f:
+            gzipped = f.read(2) == b'\x1f\x8b'
+        # Databases uploaded before compression was added are stored as-is
+        if not gzipped:
+            os.replace(packed_path, local_path)
+            return
+        with gzip.open(packed_path, 'rb') as src, open(local_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, HASH_BLOCK_SIZE)
+    finally:
+        if os.path.exists(packed_path):
+            os.remove(packed_path)
+
+def _sync_worker():
+    """Upload the database whenever it has been marked dirty"""
+    while True:
+        _db_dirty.wait()
+        # Let a burst of writes settle so they go up together
+        time.sleep(DB_SYNC_DELAY)
+        _db_dirty.clear()
+        upload_db_to_cloud()
+
+def _flush_pending_sync():
+    """Upload any write the background thread has not picked up yet"""
+    if _db_dirty.is_set():
+        _db_dirty.clear()
+        upload_db_to_cloud()
+
+def sync_db_to_cloud():
+    """Schedule an upload of the local database to GCS"""
+    global _sync_thread
+    if get_storage_client() is None:
+        logger.debug("GCS not available, skipping database sync")
+        return False
+
+    with _sync_thread_lock:
+        if _sync_thread is None:
+            _sync_thread = threading.Thread(target=_sync_worker, name='db-sync', daemon=True)
+            _sync_thread.start()
+            atexit.register(_flush_pending_sync)
+    _db_dirty.set()
+    return True
+
 def ensure_db_exists():
     """Ensure the database exists locally (download from GCS if available)"""
+    _fetch_or_create_db()
+
+    # WAL lets readers run alongside a writer; the mode is stored in the file
+    conn = sqlite3.connect(LOCAL_DB_PATH)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+    finally:
+        conn.close()
+
+def _fetch_or_create_db():
+    """Download the database from GCS, or create a new one"""
     # Make sure the instance directory exists
     os.makedirs('instance', exist_ok=True)
     
     # If DB already exists locally, keep using it
     if os.path.exists(LOCAL_DB_PATH):
-        print(f"Using existing local database: {LOCAL_DB_PATH}")
+        logger.debug("Using existing local database: %s", LOCAL_DB_PATH)
+        migrate_db_schema()
         return
     
     # Check if GCS is available
     if get_storage_client() is None:
-        print("GCS not available, creating new local database")
+        logger.debug("GCS not available, creating new local database")
         init_db_schema()
         return
         
     # Check if a database exists in GCS
     if check_if_file_exists(GCS_DB_PATH):
-        print(f"Database found in GCS, downloading to: {LOCAL_DB_PATH}")
+        logger.debug("Database found in GCS, downloading to: %s", LOCAL_DB_PATH)
         try:
-            download_file(GCS_DB_PATH, LOCAL_DB_PATH)
-            print("Database downloaded successfully")
+            download_db(LOCAL_DB_PATH)
+            logger.info("Database downloaded successfully")
+            migrate_db_schema()
         except Exception as e:
-            print(f"Error downloading database from GCS: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Error downloading database from GCS: %s", e)
             init_db_schema()
     else:
-        print("No database found in GCS, creating new local database")
+        logger.info("No database found in GCS, creating new local database")
         init_db_schema()
         # Upload the new database to GCS
         sync_db_to_cloud()
 
+class PooledConnection(sqlite3.Connection):
+    """Connection whose close() hands it back to the pool"""
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+        try:
+            _connection_pool.put_nowait(self)
+        except queue.Full:
+            super().close()
+
 def get_db_connection():
-    """Create a connection to the SQLite database"""
-    with db_lock:  # Use lock to prevent concurrent access issues
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        return conn
+    """Get a connection to the SQLite database from the pool"""
+    try:
+        return _connection_pool.get_nowait()
+    except queue.Empty:
+        pass
+
+    # Pooled connections move between threads, so the same-thread check is off.
+    # They also live long, so a bigger statement cache means each query is
+    # parsed and planned once per connection
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, factory=PooledConnection,
+                           cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-20000')
+    return conn
 
 def init_db_schema():
     """Initialize the database with required tables"""
-    print("Initializing database schema")
+    logger.debug("Initializing database schema")
     conn = sqlite3.connect(LOCAL_DB_PATH)
     cursor = conn.cursor()
     
@@ -111,7 +242,8 @@ def init_db_schema():
         pdf_hash TEXT UNIQUE NOT NULL,
         file_size INTEGER NOT NULL,
         page_count INTEGER NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        cache_name TEXT
     )
     ''')
     
@@ -139,17 +271,56 @@ def init_db_schema():
     )
     ''')
     
+    create_indexes(cursor)
     conn.commit()
     conn.close()
 
-def calculate_file_hash(file_path):
-    """Calculate SHA-256 hash of a file"""
-    hasher = hashlib.sha256()
-    with open(file_path, 'rb') as f:
-        buf = f.read(65536)  # Read in 64k chunks
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = f.read(65536)
+def create_indexes(cursor):
+    """Create the indexes the lookup queries rely on"""
+    # get_current_user filters on token and expiry together
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_token_exp ON sessions(token, expires_at)')
+    # get_pdf_by_path and the version range scan in get_pdf_versions_by_name
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pdfs_file_path ON pdfs(file_path)')
+    # get_user_pdfs: a user's PDFs, newest upload first
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_pdfs_user ON user_pdfs(user_id, uploaded_at DESC, pdf_id)')
+
+def migrate_db_schema():
+    """Add columns introduced after a database was first created"""
+    conn = sqlite3.connect(LOCAL_DB_PATH)
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('PRAGMA table_info(pdfs)')
+        columns = [row[1] for row in cursor.fetchall()]
+        
+        if 'cache_name' not in columns:
+            logger.info("Adding cache_name column to pdfs table")
+            cursor.execute('ALTER TABLE pdfs ADD COLUMN cache_name TEXT')
+        
+        create_indexes(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+
+def _file_hasher():
+    """New hasher for PDF dedup keys: 128-bit BLAKE2b.
+    
+    hashlib releases the GIL while it hashes each 1 MiB block, so uploads
+    hashed on different request threads don't serialize on it. Changing the
+    algorithm changes every key stored in pdfs.pdf_hash, so existing PDFs
+    would no longer be found as duplicates.
+    """
+    return hashlib.blake2b(digest_size=16)
+
+def copy_and_hash(stream, out):
+    """Copy a stream into an open file and return its dedup hash.
+    
+    Uploads are hashed while they are written, so the file is never read back.
+    """
+    hasher = _file_hasher()
+    while block := stream.read(HASH_BLOCK_SIZE):
+        hasher.update(block)
+        out.write(block)
     return hasher.hexdigest()
 
 def add_user(username, email, password_hash):
@@ -180,7 +351,7 @@ def get_user_by_username(username):
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
+    cursor.execute('SELECT user_id, username, password_hash FROM users WHERE username = ?', (username,))
     user = cursor.fetchone()
     
     conn.close()
@@ -245,6 +416,41 @@ def associate_pdf_with_user(user_id, pdf_id):
     finally:
         conn.close()
 
+def add_pdf_for_user(user_id, title, file_path, pdf_hash, file_size, page_count):
+    """Add a PDF (unless one with the same hash exists) and associate it with a user.
+    
+    Both writes happen in one transaction, and the database is synced to GCS
+    once instead of after each of them. Returns the PDF's ID.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(
+            'INSERT OR IGNORE INTO pdfs (title, file_path, pdf_hash, file_size, page_count) VALUES (?, ?, ?, ?, ?)',
+            (title, file_path, pdf_hash, file_size, page_count)
+        )
+        changed = cursor.rowcount > 0
+        
+        cursor.execute('SELECT pdf_id FROM pdfs WHERE pdf_hash = ?', (pdf_hash,))
+        pdf_id = cursor.fetchone()['pdf_id']
+        
+        cursor.execute(
+            '''INSERT INTO user_pdfs (user_id, pdf_id)
+               SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM user_pdfs WHERE user_id = ? AND pdf_id = ?)''',
+            (user_id, pdf_id, user_id, pdf_id)
+        )
+        changed = changed or cursor.rowcount > 0
+        conn.commit()
+        
+        # Sync to GCS after write operation
+        if changed:
+            sync_db_to_cloud()
+        
+        return pdf_id
+    finally:
+        conn.close()
+
 def get_user_pdfs(user_id):
     """Get all PDFs uploaded by a specific user"""
     conn = get_db_connection()
@@ -268,7 +474,7 @@ def get_pdf_by_hash(pdf_hash):
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute('SELECT * FROM pdfs WHERE pdf_hash = ?', (pdf_hash,))
+    cursor.execute('SELECT pdf_id, file_path FROM pdfs WHERE pdf_hash = ?', (pdf_hash,))
     pdf = cursor.fetchone()
     
     conn.close()
@@ -280,45 +486,59 @@ def get_pdf_by_path(file_path):
     cursor = conn.cursor()
 
     try:
-        cursor.execute("SELECT * FROM pdfs WHERE file_path = ?", (file_path,))
+        # Columns are named rather than taken by position, so migrations that
+        # append columns don't shift them
+        cursor.execute(
+            """SELECT pdf_id, title, file_path, pdf_hash, file_size, page_count,
+                      created_at AS uploaded_at, cache_name
+               FROM pdfs WHERE file_path = ?""",
+            (file_path,)
+        )
         pdf_row = cursor.fetchone()
 
-        if pdf_row:
-            return {
-                'pdf_id': pdf_row[0],
-                'title': pdf_row[1],
-                'file_path': pdf_row[2],
-                'pdf_hash': pdf_row[3],
-                'file_size': pdf_row[4],
-                'page_count': pdf_row[5],
-                'uploaded_at': pdf_row[6]
-            }
-        else:
-            return None
+        return dict(pdf_row) if pdf_row else None
     except Exception as e:
-        print(f"Error getting PDF by path: {str(e)}")
+        logger.error("Error getting PDF by path: %s", e)
         return None
     finally:
         cursor.close()
         conn.close()
 
+def set_pdf_cache_name(file_path, cache_name):
+    """Store the Gemini context cache name for a PDF"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(
+            'UPDATE pdfs SET cache_name = ? WHERE file_path = ?',
+            (cache_name, file_path)
+        )
+        conn.commit()
+        
+        # Sync to GCS after write operation
+        sync_db_to_cloud()
+    finally:
+        conn.close()
+
 def get_pdf_versions_by_name(base_name):
     """Get all versions of a PDF by its base name."""
     conn = get_db_connection()
     cursor = conn.cursor()
 
     try:
-        # First try exact match
-        cursor.execute("SELECT file_path FROM pdfs WHERE file_path = ?", (base_name,))
-        versions = [row[0] for row in cursor.fetchall()]
-        
-        # Then try with '_N' versions
-        cursor.execute("SELECT file_path FROM pdfs WHERE file_path LIKE ?", (base_name + '_%',))
-        versions.extend([row[0] for row in cursor.fetchall()])
-        
-        return versions
+        # The exact name plus its '_N' versions, from one range scan of
+        # idx_pdfs_file_path (a case-insensitive LIKE can't use the index).
+        # '`' sorts right after '_', and the exact name sorts first since it
+        # is a prefix of the others
+        cursor.execute(
+            "SELECT file_path FROM pdfs WHERE file_path >= ? AND file_path < ? "
+            "AND (file_path = ? OR file_path >= ?) ORDER BY file_path",
+            (base_name, base_name + '`', base_name, base_name + '_')
+        )
+        return [row[0] for row in cursor.fetchall()]
     except Exception as e:
-        print(f"Error getting PDF versions: {str(e)}")
+        logger.error("Error getting PDF versions: %s", e)
         return []
     finally:
         cursor.close()
@@ -0,0 +1,20 @@
+import fitz
+
+def render_page(page, dpi):
+    """Render a PDF page to JPEG bytes.
+    
+    Text-only pages (text layer, no embedded images) are rendered in
+    grayscale, which is a third of the pixel data of RGB.
+    """
+    text_only = not page.get_images() and bool(page.get_text().strip())
+    colorspace = fitz.csGRAY if text_only else fitz.csRGB
+    pix = page.get_pixmap(dpi=dpi, colorspace=colorspace, alpha=False)
+    return pix.pil_tobytes(format="JPEG", optimize=False)
+
+def render_page_range(pdf_path, first_page, last_page, dpi):
+    """Render pages first_page..last_page (1-based, inclusive) to JPEG bytes.
+    
+    Runs in a render process, so it only imports what rendering needs.
+    """
+    with fitz.open(pdf_path) as doc:
+        return [render_page(doc[i], dpi) for i in range(first_page - 1, last_page)]
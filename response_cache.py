@@ -0,0 +1,61 @@
+import hashlib
+import json
+import logging
+from PIL import Image
+
+from cloud_storage import (
+    try_download,
+    upload_file,
+    get_storage_client
+)
+
+logger = logging.getLogger(__name__)
+
+# GCS folder for cached Gemini and TTS responses. The bucket expires objects
+# under this prefix (see create_bucket_if_not_exists).
+GCS_CACHE_PREFIX = 'cache/'
+
+def _part_fingerprint(part):
+    """Turn a prompt part into a JSON-serializable value for the cache key"""
+    if isinstance(part, Image.Image):
+        return {
+            'image': hashlib.sha256(part.tobytes()).hexdigest(),
+            'mode': part.mode,
+            'size': list(part.size)
+        }
+    if isinstance(part, (bytes, bytearray)):
+        return {'bytes': hashlib.sha256(part).hexdigest()}
+    if isinstance(part, dict) and 'data' in part:
+        # Inline blob, e.g. {'mime_type': 'image/jpeg', 'data': b'...'}
+        return {'mime_type': part.get('mime_type'), 'bytes': hashlib.sha256(part['data']).hexdigest()}
+    return part
+
+def gemini_cache_key(model_name, contents, config):
+    """Build the cache key for a Gemini prompt (model, prompt parts and sampling params)"""
+    payload = {
+        'model': model_name,
+        'contents': [_part_fingerprint(part) for part in contents],
+        'config': config
+    }
+    return hashlib.blake2b(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+def page_explanation_key(model_name, prompt, jpeg_bytes):
+    """Build the cache key for the explanation of one rendered page image"""
+    return gemini_cache_key(model_name, [prompt, jpeg_bytes], None)
+
+def tts_cache_key(speech_text):
+    """Build the cache key for a TTS request - the voice settings are constant"""
+    return hashlib.sha256(speech_text.encode()).hexdigest()
+
+def get_cached_response(kind, key):
+    """Return the cached response bytes, or None on a miss"""
+    if get_storage_client() is None:
+        return None
+    return try_download(f"{GCS_CACHE_PREFIX}{kind}/{key}")
+
+def store_cached_response(kind, key, data, content_type=None):
+    """Store a response in the cache (no-op if GCS is not available)"""
+    try:
+        upload_file(data, f"{GCS_CACHE_PREFIX}{kind}/{key}", content_type=content_type)
+    except Exception as e:
+        logger.error("Error storing cached %s response: %s", kind, e)
@@ -0,0 +1,11 @@
+# gevent has to patch sockets/threading before anything else imports them,
+# so this must stay the first import in the process
+from gevent import monkey
+monkey.patch_all()
+
+# gRPC (Text-to-Speech) runs its own I/O threads; this makes its calls yield
+# to other greenlets instead of blocking the whole worker
+from grpc.experimental import gevent as grpc_gevent
+grpc_gevent.init_gevent()
+
+from app import app